@@ -0,0 +1,101 @@
+"""
+Keeps the app in step with writes made by other processes (another app
+window, a script, the server) sharing the database.
+
+Triggers record every write to songs, playlists and playlist_songs in
+Database's change log, playlist_songs once per playlist per transaction. ChangeFeed checks PRAGMA data_version from the Tk
+thread, which costs microseconds while nothing commits. After a commit
+it fetches only the log entries since the last one it saw
+(Database.get_changes) on the DbWorker and passes them to on_changes.
+Entries the app's own DbWorker wrote are skipped, as the tabs redraw
+after their own writes; those of Maintenance, which refreshes smart
+playlists, are not.
+When the log no longer reaches back that far, on_reset is called
+instead, and the tabs reload.
+
+The log is trimmed (Database.compact_change_log) after each fetch here,
+and by every process at init_db().
+"""
+
+import Database
+
+# How often the Tk thread checks PRAGMA data_version.
+CHANGE_POLL_MS = 500
+
+
+def _fetch_changes(seq):
+    # Runs on the DbWorker.
+    result = Database.get_changes(seq, skip_own=True)
+    Database.compact_change_log()
+    return result
+
+
+class ChangeFeed:
+    def __init__(self, root, db, on_changes, on_reset, poll_ms=CHANGE_POLL_MS):
+        self.root = root
+        self.db = db
+        self.on_changes = on_changes
+        self.on_reset = on_reset
+        self.poll_ms = poll_ms
+        self.data_version = Database.data_version_watcher()
+        self.version = self.data_version()
+        self.seq = None  # newest change-log entry seen
+        self._after_id = None
+        # Read before the tabs load, so no write can fall in between.
+        self._fetch_seq()
+
+    def stop(self):
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+            self._after_id = None
+        self.db.cancel("changes")
+
+    def _fetch_seq(self):
+        self.db.submit(
+            Database.get_change_seq,
+            channel="changes",
+            on_done=self._start,
+            on_error=self._retry,
+        )
+
+    def _start(self, seq):
+        self.seq = seq
+        self._schedule()
+
+    def _schedule(self):
+        self._after_id = self.root.after(self.poll_ms, self._poll)
+
+    def _poll(self):
+        self._after_id = None
+        if self.seq is None:
+            self._fetch_seq()
+            return
+        version = self.data_version()
+        if version == self.version:
+            self._schedule()
+            return
+
+        # Read before fetching: a commit racing the fetch changes it again.
+        self.version = version
+        self.db.submit(
+            _fetch_changes,
+            self.seq,
+            channel="changes",
+            on_done=self._apply,
+            on_error=self._retry,
+        )
+
+    def _apply(self, result):
+        self.seq, changes = result
+        try:
+            if changes is None:
+                self.on_reset()
+            elif any(changes.values()):
+                self.on_changes(changes)
+        finally:
+            self._schedule()
+
+    def _retry(self, error):
+        # Usually a busy database; try again on the next poll.
+        self.version = None
+        self._schedule()
@@ -1,205 +1,3086 @@
+import datetime
+import heapq
+import json
+import os
+import re
 import sqlite3
+import threading
+import time
+import unicodedata
+from contextlib import contextmanager
+from itertools import groupby, islice
+from operator import itemgetter
 from pathlib import Path
 
+from QueryStats import InstrumentedConnection
+
 # Always use DB in same folder as Database.py
 DB_PATH = Path(__file__).resolve().parent / "music_organizer.db"
 
+# Time every statement (see QueryStats.py). Cheap enough to leave on.
+INSTRUMENT_QUERIES = True
+
+# Size of each connection's prepared-statement cache.
+STATEMENT_CACHE_SIZE = 256
+
+# One long-lived connection per thread (sqlite3 connections are not
+# shareable across threads by default).
+_local = threading.local()
+
+# Leading words ignored when sorting names: "The Beatles" sorts as "beatles".
+SORT_ARTICLES = ("the ", "a ", "an ")
+
+
+def sort_key(name):
+    """
+    The form names are sorted by, stored in the sort_name columns:
+    casefolded, accents removed, leading article dropped, so "The Beatles"
+    -> "beatles" and "Édith Piaf" sorts with "edith". Registered as the
+    SQL function sort_key() on every connection.
+    """
+    key = name or ""
+    if not key.isascii():
+        key = "".join(c for c in unicodedata.normalize("NFKD", key) if not unicodedata.combining(c))
+    key = key.casefold().strip()
+    for article in SORT_ARTICLES:
+        # A name that is only an article ("The") keeps it.
+        if key.startswith(article) and key[len(article):].strip():
+            return key[len(article):].lstrip()
+    return key
+
+
+def _open_connection():
+    # Other libraries (see bind_thread) must exist: opening one in read-write
+    # mode never creates an empty library in its place.
+    path = getattr(_local, "path", None)
+    conn = sqlite3.connect(
+        f"{Path(path).as_uri()}?mode=rw" if path else DB_PATH,
+        uri=path is not None,
+        isolation_level=None,  # autocommit; transactions are explicit
+        cached_statements=STATEMENT_CACHE_SIZE,
+        factory=InstrumentedConnection if INSTRUMENT_QUERIES else sqlite3.Connection,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.create_function("sort_key", 1, sort_key, deterministic=True)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+def get_connection():
+    """
+    Returns the calling thread's shared connection, opening and configuring
+    it on first use. Callers must not close it; use close_connection().
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _open_connection()
+        _local.conn = conn
+    return conn
+
+
+def close_connection():
+    """Closes the calling thread's connection, if one is open."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        _local.conn = None
+        conn.close()
+
+
+def bind_thread(path):
+    """
+    Points every function here, when called from the calling thread, at
+    the library file path instead of DB_PATH (None goes back to DB_PATH).
+    Meant for worker threads that serve one library each (see
+    Libraries.py).
+    """
+    close_connection()
+    _local.path = path
+
+
+def data_version_watcher():
+    """
+    Returns a function giving a number that changes whenever any
+    connection, in this process or another, commits to the database. It
+    reads PRAGMA data_version on a connection of its own that never
+    writes (its own commits would not count), so a call costs
+    microseconds. Use it from the thread that created it.
+    """
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
+    return lambda: conn.execute("PRAGMA data_version").fetchone()[0]
+
+
+@contextmanager
+def transaction(immediate=False):
+    """
+    Runs the block inside a single transaction on the shared connection.
+    Commits on success, rolls back on error. Nested uses join the
+    outermost transaction. immediate=True takes the write lock up front.
+    """
+    conn = get_connection()
+    if conn.in_transaction:
+        yield conn
+        return
+
+    conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    written = conn.total_changes
+    try:
+        yield conn
+        logged = _seal_change_log(conn) if conn.total_changes != written else None
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+        if logged and getattr(_local, "own_changes", False):
+            with _own_changes_lock:
+                _own_changes.append(logged)
+
+
+# ---------------------------------------------------------
+# SCHEMA MIGRATIONS
+# ---------------------------------------------------------
+
+def _fts5_available(conn):
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp._fts5_probe USING fts5(x)")
+    except sqlite3.OperationalError:
+        return False
+    conn.execute("DROP TABLE temp._fts5_probe")
+    return True
+
+
+def _create_song_fts(conn):
+    """
+    External-content FTS5 table mirroring songs, kept in sync by triggers.
+    Skipped when SQLite was built without FTS5; search_songs() then falls
+    back to LIKE.
+    """
+    if not _fts5_available(conn):
+        return
+
+    script = """
+    CREATE VIRTUAL TABLE songs_fts USING fts5(
+        name, artist, genre,
+        content = 'songs',
+        content_rowid = 'id',
+        tokenize = 'unicode61 remove_diacritics 2'
+    );
+
+    CREATE TRIGGER songs_fts_insert AFTER INSERT ON songs BEGIN
+        INSERT INTO songs_fts (rowid, name, artist, genre)
+        VALUES (new.id, new.name, new.artist, new.genre);
+    END;
+
+    CREATE TRIGGER songs_fts_delete AFTER DELETE ON songs BEGIN
+        INSERT INTO songs_fts (songs_fts, rowid, name, artist, genre)
+        VALUES ('delete', old.id, old.name, old.artist, old.genre);
+    END;
+
+    CREATE TRIGGER songs_fts_update AFTER UPDATE OF name, artist, genre ON songs BEGIN
+        INSERT INTO songs_fts (songs_fts, rowid, name, artist, genre)
+        VALUES ('delete', old.id, old.name, old.artist, old.genre);
+        INSERT INTO songs_fts (rowid, name, artist, genre)
+        VALUES (new.id, new.name, new.artist, new.genre);
+    END;
+
+    INSERT INTO songs_fts (songs_fts) VALUES ('rebuild');
+    """
+    for statement in _split_sql(script):
+        conn.execute(statement)
+
+
+def _normalize_artists_genres(conn):
+    """
+    Moves the free-text songs.artist / songs.genre columns into artists and
+    genres tables referenced by id, with song counts kept up to date by
+    triggers (overall, and per artist within each genre in artist_genres)
+    so facet counts are single-row reads. song_view joins the names back
+    for readers, and the FTS index is rebuilt on top of it.
+
+    Rows in artists and genres are never renamed or deleted: the FTS delete
+    trigger looks up the indexed names by id.
+    """
+    had_fts = _has_song_fts(conn)
+
+    script = """
+    DROP TRIGGER IF EXISTS songs_fts_insert;
+    DROP TRIGGER IF EXISTS songs_fts_delete;
+    DROP TRIGGER IF EXISTS songs_fts_update;
+    DROP TABLE IF EXISTS songs_fts;
+
+    CREATE TABLE artists (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        song_count INTEGER NOT NULL DEFAULT 0
+    );
+
+    CREATE TABLE genres (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        song_count INTEGER NOT NULL DEFAULT 0
+    );
+
+    CREATE TABLE artist_genres (
+        artist_id INTEGER NOT NULL REFERENCES artists(id),
+        genre_id INTEGER NOT NULL REFERENCES genres(id),
+        song_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (artist_id, genre_id)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX idx_artist_genres_genre ON artist_genres (genre_id, artist_id);
+    CREATE INDEX idx_artists_name ON artists (name COLLATE NOCASE);
+    CREATE INDEX idx_genres_name ON genres (name COLLATE NOCASE);
+
+    INSERT INTO artists (name)
+    SELECT DISTINCT artist FROM songs WHERE artist <> '' ORDER BY artist;
+    INSERT INTO genres (name)
+    SELECT DISTINCT genre FROM songs WHERE genre <> '' ORDER BY genre;
+
+    ALTER TABLE songs ADD COLUMN artist_id INTEGER REFERENCES artists(id);
+    ALTER TABLE songs ADD COLUMN genre_id INTEGER REFERENCES genres(id);
+    UPDATE songs SET
+        artist_id = (SELECT id FROM artists WHERE name = songs.artist),
+        genre_id = (SELECT id FROM genres WHERE name = songs.genre);
+    ALTER TABLE songs DROP COLUMN artist;
+    ALTER TABLE songs DROP COLUMN genre;
+
+    CREATE INDEX idx_songs_artist ON songs (artist_id);
+    CREATE INDEX idx_songs_genre ON songs (genre_id);
+
+    DROP INDEX idx_songs_path;
+    CREATE UNIQUE INDEX idx_songs_path ON songs (path) WHERE path IS NOT NULL;
+
+    UPDATE artists SET song_count = (SELECT COUNT(*) FROM songs WHERE artist_id = artists.id);
+    UPDATE genres SET song_count = (SELECT COUNT(*) FROM songs WHERE genre_id = genres.id);
+    INSERT INTO artist_genres (artist_id, genre_id, song_count)
+    SELECT artist_id, genre_id, COUNT(*) FROM songs
+    WHERE artist_id IS NOT NULL AND genre_id IS NOT NULL
+    GROUP BY artist_id, genre_id;
+
+    CREATE VIEW song_view AS
+    SELECT s.id, s.name,
+           COALESCE(a.name, '') AS artist,
+           COALESCE(g.name, '') AS genre,
+           s.artist_id, s.genre_id, s.path, s.mtime, s.size, s.duration
+    FROM songs s
+    LEFT JOIN artists a ON a.id = s.artist_id
+    LEFT JOIN genres g ON g.id = s.genre_id;
+
+    CREATE TRIGGER songs_count_insert AFTER INSERT ON songs BEGIN
+        UPDATE artists SET song_count = song_count + 1 WHERE id = new.artist_id;
+        UPDATE genres SET song_count = song_count + 1 WHERE id = new.genre_id;
+        INSERT INTO artist_genres (artist_id, genre_id, song_count)
+        SELECT new.artist_id, new.genre_id, 1
+        WHERE new.artist_id IS NOT NULL AND new.genre_id IS NOT NULL
+        ON CONFLICT (artist_id, genre_id) DO UPDATE SET song_count = song_count + 1;
+    END;
+
+    CREATE TRIGGER songs_count_delete AFTER DELETE ON songs BEGIN
+        UPDATE artists SET song_count = song_count - 1 WHERE id = old.artist_id;
+        UPDATE genres SET song_count = song_count - 1 WHERE id = old.genre_id;
+        UPDATE artist_genres SET song_count = song_count - 1
+        WHERE artist_id = old.artist_id AND genre_id = old.genre_id;
+    END;
+
+    CREATE TRIGGER songs_count_update AFTER UPDATE OF artist_id, genre_id ON songs BEGIN
+        UPDATE artists SET song_count = song_count - 1 WHERE id = old.artist_id;
+        UPDATE genres SET song_count = song_count - 1 WHERE id = old.genre_id;
+        UPDATE artist_genres SET song_count = song_count - 1
+        WHERE artist_id = old.artist_id AND genre_id = old.genre_id;
+        UPDATE artists SET song_count = song_count + 1 WHERE id = new.artist_id;
+        UPDATE genres SET song_count = song_count + 1 WHERE id = new.genre_id;
+        INSERT INTO artist_genres (artist_id, genre_id, song_count)
+        SELECT new.artist_id, new.genre_id, 1
+        WHERE new.artist_id IS NOT NULL AND new.genre_id IS NOT NULL
+        ON CONFLICT (artist_id, genre_id) DO UPDATE SET song_count = song_count + 1;
+    END;
+    """
+    for statement in _split_sql(script):
+        conn.execute(statement)
+
+    if not had_fts:
+        return
+
+    script = """
+    CREATE VIRTUAL TABLE songs_fts USING fts5(
+        name, artist, genre,
+        content = 'song_view',
+        content_rowid = 'id',
+        tokenize = 'unicode61 remove_diacritics 2',
+        detail = column
+    );
+
+    CREATE TRIGGER songs_fts_insert AFTER INSERT ON songs BEGIN
+        INSERT INTO songs_fts (rowid, name, artist, genre)
+        VALUES (new.id, new.name,
+                COALESCE((SELECT name FROM artists WHERE id = new.artist_id), ''),
+                COALESCE((SELECT name FROM genres WHERE id = new.genre_id), ''));
+    END;
+
+    CREATE TRIGGER songs_fts_delete AFTER DELETE ON songs BEGIN
+        INSERT INTO songs_fts (songs_fts, rowid, name, artist, genre)
+        VALUES ('delete', old.id, old.name,
+                COALESCE((SELECT name FROM artists WHERE id = old.artist_id), ''),
+                COALESCE((SELECT name FROM genres WHERE id = old.genre_id), ''));
+    END;
+
+    CREATE TRIGGER songs_fts_update AFTER UPDATE OF name, artist_id, genre_id ON songs BEGIN
+        INSERT INTO songs_fts (songs_fts, rowid, name, artist, genre)
+        VALUES ('delete', old.id, old.name,
+                COALESCE((SELECT name FROM artists WHERE id = old.artist_id), ''),
+                COALESCE((SELECT name FROM genres WHERE id = old.genre_id), ''));
+        INSERT INTO songs_fts (rowid, name, artist, genre)
+        VALUES (new.id, new.name,
+                COALESCE((SELECT name FROM artists WHERE id = new.artist_id), ''),
+                COALESCE((SELECT name FROM genres WHERE id = new.genre_id), ''));
+    END;
+
+    INSERT INTO songs_fts (songs_fts) VALUES ('rebuild');
+    """
+    for statement in _split_sql(script):
+        conn.execute(statement)
+
+
+def _cluster_playlist_songs(conn):
+    """
+    Rebuilds playlist_songs WITHOUT ROWID, stored in the order of its
+    (playlist_id, song_id) key, so the key is no longer kept twice: once
+    in a rowid table and again in its own index. Indexes and triggers on
+    the table are recreated as they were.
+    """
+    schema = [row[0] for row in conn.execute(
+        """
+        SELECT sql FROM sqlite_master
+        WHERE tbl_name = 'playlist_songs' AND type IN ('index', 'trigger') AND sql IS NOT NULL
+        """
+    )]
+    script = """
+    CREATE TABLE playlist_songs_clustered (
+        playlist_id INTEGER NOT NULL,
+        song_id INTEGER NOT NULL,
+        position INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (playlist_id, song_id),
+        FOREIGN KEY (playlist_id) REFERENCES playlists(id) ON DELETE CASCADE,
+        FOREIGN KEY (song_id) REFERENCES songs(id) ON DELETE CASCADE
+    ) WITHOUT ROWID;
+
+    INSERT INTO playlist_songs_clustered (playlist_id, song_id, position)
+    SELECT playlist_id, song_id, position FROM playlist_songs ORDER BY playlist_id, song_id;
+
+    DROP TABLE playlist_songs;
+    """
+    for statement in _split_sql(script):
+        conn.execute(statement)
+    # Leaves the schema of other tables' triggers, which name
+    # playlist_songs, alone while it does not exist.
+    conn.execute("PRAGMA legacy_alter_table = ON")
+    try:
+        conn.execute("ALTER TABLE playlist_songs_clustered RENAME TO playlist_songs")
+    finally:
+        conn.execute("PRAGMA legacy_alter_table = OFF")
+    for sql in schema:
+        conn.execute(sql)
+
+
+# Step N upgrades a database from user_version N-1 to N. Steps are either an
+# SQL script or a function taking the connection. Released steps must never
+# be edited; append a new one instead.
+MIGRATIONS = [
+    # 1: base tables (IF NOT EXISTS adopts databases from before versioning)
+    """
+    CREATE TABLE IF NOT EXISTS songs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        artist TEXT,
+        genre TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS playlists (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS playlist_songs (
+        playlist_id INTEGER NOT NULL,
+        song_id INTEGER NOT NULL,
+        PRIMARY KEY (playlist_id, song_id),
+        FOREIGN KEY (playlist_id) REFERENCES playlists(id) ON DELETE CASCADE,
+        FOREIGN KEY (song_id) REFERENCES songs(id) ON DELETE CASCADE
+    );
+    """,
+
+    # 2: indexes behind the ORDER BY name COLLATE NOCASE listings
+    """
+    CREATE INDEX IF NOT EXISTS idx_songs_name ON songs (name COLLATE NOCASE);
+    CREATE INDEX IF NOT EXISTS idx_playlists_name ON playlists (name COLLATE NOCASE);
+    """,
+
+    # 3: file metadata for songs found by the library scanner
+    """
+    ALTER TABLE songs ADD COLUMN path TEXT;
+    ALTER TABLE songs ADD COLUMN mtime REAL;
+    ALTER TABLE songs ADD COLUMN size INTEGER;
+    ALTER TABLE songs ADD COLUMN duration REAL;
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_songs_path ON songs (path);
+    """,
+
+    # 4: FTS5 full-text index over name/artist/genre
+    _create_song_fts,
+
+    # 5: running order for playlists (sparse positions, see POSITION_GAP);
+    # existing playlists keep their old by-name order
+    """
+    ALTER TABLE playlist_songs ADD COLUMN position INTEGER NOT NULL DEFAULT 0;
+
+    UPDATE playlist_songs SET position = ranked.n * 65536
+    FROM (
+        SELECT ps.playlist_id, ps.song_id,
+               ROW_NUMBER() OVER (
+                   PARTITION BY ps.playlist_id ORDER BY s.name COLLATE NOCASE, s.id
+               ) AS n
+        FROM playlist_songs ps
+        JOIN songs s ON s.id = ps.song_id
+    ) AS ranked
+    WHERE playlist_songs.playlist_id = ranked.playlist_id
+      AND playlist_songs.song_id = ranked.song_id;
+
+    CREATE INDEX IF NOT EXISTS idx_playlist_songs_position
+        ON playlist_songs (playlist_id, position, song_id);
+    """,
+
+    # 6: artists/genres tables with maintained song counts; songs keep ids.
+    # Also makes idx_songs_path partial, as most songs have no path.
+    _normalize_artists_genres,
+
+    # 7: vocabulary and trigram index for fuzzy search. Triggers queue
+    # written songs in search_terms_pending; update_fuzzy_index() indexes them.
+    """
+    CREATE TABLE search_terms (
+        id INTEGER PRIMARY KEY,
+        term TEXT NOT NULL UNIQUE
+    );
+
+    CREATE TABLE search_trigrams (
+        trigram TEXT NOT NULL,
+        term_id INTEGER NOT NULL REFERENCES search_terms(id),
+        PRIMARY KEY (trigram, term_id)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE search_terms_pending (
+        song_id INTEGER PRIMARY KEY
+    );
+
+    CREATE TRIGGER search_terms_insert AFTER INSERT ON songs BEGIN
+        INSERT OR IGNORE INTO search_terms_pending (song_id) VALUES (new.id);
+    END;
+
+    CREATE TRIGGER search_terms_update AFTER UPDATE OF name, artist_id, genre_id ON songs BEGIN
+        INSERT OR IGNORE INTO search_terms_pending (song_id) VALUES (new.id);
+    END;
+
+    INSERT INTO search_terms_pending (song_id) SELECT id FROM songs;
+    """,
+
+    # 8: smart playlists: rules (JSON) on playlists, materialized into
+    # playlist_songs. While any exist, written songs are queued in
+    # smart_playlist_pending for refresh_smart_playlists(). added_at is
+    # only known for songs added from now on.
+    """
+    ALTER TABLE songs ADD COLUMN added_at INTEGER;
+    ALTER TABLE playlists ADD COLUMN rules TEXT;
+    CREATE INDEX idx_playlists_smart ON playlists (id) WHERE rules IS NOT NULL;
+
+    CREATE TABLE smart_playlist_pending (
+        song_id INTEGER PRIMARY KEY
+    );
+
+    CREATE TRIGGER smart_playlist_insert AFTER INSERT ON songs
+    WHEN EXISTS (SELECT 1 FROM playlists WHERE rules IS NOT NULL) BEGIN
+        INSERT OR IGNORE INTO smart_playlist_pending (song_id) VALUES (new.id);
+    END;
+
+    CREATE TRIGGER smart_playlist_update
+    AFTER UPDATE OF name, artist_id, genre_id, path, duration, added_at ON songs
+    WHEN EXISTS (SELECT 1 FROM playlists WHERE rules IS NOT NULL) BEGIN
+        INSERT OR IGNORE INTO smart_playlist_pending (song_id) VALUES (new.id);
+    END;
+    """,
+
+    # 9: "similar songs": each song's closest neighbours by shared static
+    # playlists. Link writes queue the song and its playlist for
+    # refresh_song_neighbors(); existing playlists are queued so the first
+    # refresh builds everything.
+    """
+    CREATE TABLE song_neighbors (
+        song_id INTEGER NOT NULL,
+        neighbor_id INTEGER NOT NULL,
+        score REAL NOT NULL,
+        PRIMARY KEY (song_id, neighbor_id)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE neighbor_pending_songs (
+        song_id INTEGER PRIMARY KEY
+    );
+
+    CREATE TABLE neighbor_pending_playlists (
+        playlist_id INTEGER PRIMARY KEY
+    );
+
+    CREATE TRIGGER song_neighbors_link AFTER INSERT ON playlist_songs
+    WHEN (SELECT rules FROM playlists WHERE id = new.playlist_id) IS NULL BEGIN
+        INSERT OR IGNORE INTO neighbor_pending_songs (song_id) VALUES (new.song_id);
+        INSERT OR IGNORE INTO neighbor_pending_playlists (playlist_id) VALUES (new.playlist_id);
+    END;
+
+    CREATE TRIGGER song_neighbors_unlink AFTER DELETE ON playlist_songs
+    WHEN (SELECT rules FROM playlists WHERE id = old.playlist_id) IS NULL BEGIN
+        INSERT OR IGNORE INTO neighbor_pending_songs (song_id) VALUES (old.song_id);
+        INSERT OR IGNORE INTO neighbor_pending_playlists (playlist_id) VALUES (old.playlist_id);
+    END;
+
+    CREATE TRIGGER song_neighbors_relink AFTER UPDATE OF song_id ON playlist_songs
+    WHEN (SELECT rules FROM playlists WHERE id = new.playlist_id) IS NULL BEGIN
+        INSERT OR IGNORE INTO neighbor_pending_songs (song_id) VALUES (old.song_id);
+        INSERT OR IGNORE INTO neighbor_pending_songs (song_id) VALUES (new.song_id);
+        INSERT OR IGNORE INTO neighbor_pending_playlists (playlist_id) VALUES (new.playlist_id);
+    END;
+
+    INSERT INTO neighbor_pending_playlists (playlist_id) SELECT id FROM playlists;
+    """,
+
+    # 10: playlist_songs by song: "which playlists is this song in", the
+    # ON DELETE CASCADE from songs, and song merges become index lookups
+    # instead of scans of every link.
+    """
+    CREATE INDEX IF NOT EXISTS idx_playlist_songs_song ON playlist_songs (song_id, playlist_id);
+    """,
+
+    # 11: stored sort keys (see sort_key()) replace ORDER BY name COLLATE
+    # NOCASE, which only folds ASCII. Every listing reads its order
+    # straight off a sort_name index.
+    """
+    ALTER TABLE songs ADD COLUMN sort_name TEXT;
+    ALTER TABLE playlists ADD COLUMN sort_name TEXT;
+    ALTER TABLE artists ADD COLUMN sort_name TEXT;
+    ALTER TABLE genres ADD COLUMN sort_name TEXT;
+
+    UPDATE songs SET sort_name = sort_key(name);
+    UPDATE playlists SET sort_name = sort_key(name);
+    UPDATE artists SET sort_name = sort_key(name);
+    UPDATE genres SET sort_name = sort_key(name);
+
+    CREATE INDEX idx_songs_sort ON songs (sort_name, id);
+    CREATE INDEX idx_playlists_sort ON playlists (sort_name, id);
+    CREATE INDEX idx_artists_sort ON artists (sort_name, id);
+    CREATE INDEX idx_genres_sort ON genres (sort_name, id);
+
+    DROP VIEW song_view;
+    CREATE VIEW song_view AS
+    SELECT s.id, s.name,
+           COALESCE(a.name, '') AS artist,
+           COALESCE(g.name, '') AS genre,
+           s.artist_id, s.genre_id, s.path, s.mtime, s.size, s.duration, s.sort_name
+    FROM songs s
+    LEFT JOIN artists a ON a.id = s.artist_id
+    LEFT JOIN genres g ON g.id = s.genre_id;
+    """,
+
+    # 12: other library files (see Libraries.py), and songs linked in from
+    # them so playlists can hold them. A link remembers its source song;
+    # unregistering the library turns its links into ordinary songs.
+    """
+    CREATE TABLE libraries (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        path TEXT NOT NULL UNIQUE
+    );
+
+    ALTER TABLE songs ADD COLUMN library_id INTEGER REFERENCES libraries (id) ON DELETE SET NULL;
+    ALTER TABLE songs ADD COLUMN library_song_id INTEGER;
+    CREATE UNIQUE INDEX idx_songs_library ON songs (library_id, library_song_id)
+        WHERE library_id IS NOT NULL;
+
+    DROP VIEW song_view;
+    CREATE VIEW song_view AS
+    SELECT s.id, s.name,
+           COALESCE(a.name, '') AS artist,
+           COALESCE(g.name, '') AS genre,
+           s.artist_id, s.genre_id, s.path, s.mtime, s.size, s.duration, s.sort_name,
+           s.library_id
+    FROM songs s
+    LEFT JOIN artists a ON a.id = s.artist_id
+    LEFT JOIN genres g ON g.id = s.genre_id;
+    """,
+
+    # 13: change log, so other processes can catch up with O(changes)
+    # work (see get_changes() and compact_change_log()).
+    """
+    CREATE TABLE change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        row_id INTEGER NOT NULL
+    );
+
+    CREATE TRIGGER change_log_song_insert AFTER INSERT ON songs BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('song', NEW.id);
+    END;
+
+    CREATE TRIGGER change_log_song_update AFTER UPDATE ON songs BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('song', NEW.id);
+    END;
+
+    CREATE TRIGGER change_log_song_delete AFTER DELETE ON songs BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('song', OLD.id);
+    END;
+
+    CREATE TRIGGER change_log_playlist_insert AFTER INSERT ON playlists BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('playlist', NEW.id);
+    END;
+
+    CREATE TRIGGER change_log_playlist_update AFTER UPDATE ON playlists BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('playlist', NEW.id);
+    END;
+
+    CREATE TRIGGER change_log_playlist_delete AFTER DELETE ON playlists BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('playlist', OLD.id);
+    END;
+
+    CREATE TRIGGER change_log_playlist_songs_insert AFTER INSERT ON playlist_songs BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('playlist_songs', NEW.playlist_id);
+    END;
+
+    CREATE TRIGGER change_log_playlist_songs_update AFTER UPDATE ON playlist_songs BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('playlist_songs', NEW.playlist_id);
+        INSERT INTO change_log (kind, row_id)
+        SELECT 'playlist_songs', OLD.playlist_id WHERE OLD.playlist_id <> NEW.playlist_id;
+    END;
+
+    CREATE TRIGGER change_log_playlist_songs_delete AFTER DELETE ON playlist_songs BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('playlist_songs', OLD.playlist_id);
+    END;
+    """,
+
+    # 14: an upsert's DO UPDATE overrides the OR IGNORE of statements in
+    # the triggers it fires, so re-scanning a song still queued failed on
+    # the queue's key. Queue songs only if they are not queued already.
+    """
+    DROP TRIGGER search_terms_insert;
+    DROP TRIGGER search_terms_update;
+    DROP TRIGGER smart_playlist_insert;
+    DROP TRIGGER smart_playlist_update;
+
+    CREATE TRIGGER search_terms_insert AFTER INSERT ON songs BEGIN
+        INSERT INTO search_terms_pending (song_id) SELECT new.id
+        WHERE NOT EXISTS (SELECT 1 FROM search_terms_pending WHERE song_id = new.id);
+    END;
+
+    CREATE TRIGGER search_terms_update AFTER UPDATE OF name, artist_id, genre_id ON songs BEGIN
+        INSERT INTO search_terms_pending (song_id) SELECT new.id
+        WHERE NOT EXISTS (SELECT 1 FROM search_terms_pending WHERE song_id = new.id);
+    END;
+
+    CREATE TRIGGER smart_playlist_insert AFTER INSERT ON songs
+    WHEN EXISTS (SELECT 1 FROM playlists WHERE rules IS NOT NULL) BEGIN
+        INSERT INTO smart_playlist_pending (song_id) SELECT new.id
+        WHERE NOT EXISTS (SELECT 1 FROM smart_playlist_pending WHERE song_id = new.id);
+    END;
+
+    CREATE TRIGGER smart_playlist_update
+    AFTER UPDATE OF name, artist_id, genre_id, path, duration, added_at ON songs
+    WHEN EXISTS (SELECT 1 FROM playlists WHERE rules IS NOT NULL) BEGIN
+        INSERT INTO smart_playlist_pending (song_id) SELECT new.id
+        WHERE NOT EXISTS (SELECT 1 FROM smart_playlist_pending WHERE song_id = new.id);
+    END;
+    """,
+
+    # 15: playlists whose positions are running out of room, queued for
+    # renumber_pending_playlists().
+    """
+    CREATE TABLE playlist_renumber_pending (
+        playlist_id INTEGER PRIMARY KEY
+    );
+    """,
+
+    # 16: playlist_songs without its rowid table (about 40% of its size).
+    _cluster_playlist_songs,
+
+    # 17: idx_songs_sort serves every lookup by name (see _fill_song_lookup),
+    # and the UNIQUE constraint's index every lookup of a playlist by name.
+    """
+    DROP INDEX IF EXISTS idx_songs_name;
+    DROP INDEX IF EXISTS idx_playlists_name;
+    """,
+
+    # 18: one playlist_songs change-log entry per playlist per transaction,
+    # not one per row written. Entries above change_log_mark.seq belong to
+    # the open transaction (see _seal_change_log()), so a write only ever
+    # folds into an entry no reader can have seen yet.
+    """
+    CREATE TABLE change_log_mark (seq INTEGER NOT NULL);
+    INSERT INTO change_log_mark (seq) SELECT COALESCE(MAX(seq), 0) FROM change_log;
+
+    CREATE INDEX idx_change_log_playlist_songs ON change_log (row_id)
+        WHERE kind = 'playlist_songs';
+
+    DROP TRIGGER change_log_playlist_songs_insert;
+    DROP TRIGGER change_log_playlist_songs_update;
+    DROP TRIGGER change_log_playlist_songs_delete;
+
+    CREATE TRIGGER change_log_playlist_songs_insert AFTER INSERT ON playlist_songs BEGIN
+        INSERT INTO change_log (kind, row_id) SELECT 'playlist_songs', NEW.playlist_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM change_log
+            WHERE kind = 'playlist_songs' AND row_id = NEW.playlist_id
+              AND seq > (SELECT seq FROM change_log_mark)
+        );
+    END;
+
+    CREATE TRIGGER change_log_playlist_songs_update AFTER UPDATE ON playlist_songs BEGIN
+        INSERT INTO change_log (kind, row_id) SELECT 'playlist_songs', NEW.playlist_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM change_log
+            WHERE kind = 'playlist_songs' AND row_id = NEW.playlist_id
+              AND seq > (SELECT seq FROM change_log_mark)
+        );
+        INSERT INTO change_log (kind, row_id) SELECT 'playlist_songs', OLD.playlist_id
+        WHERE OLD.playlist_id <> NEW.playlist_id AND NOT EXISTS (
+            SELECT 1 FROM change_log
+            WHERE kind = 'playlist_songs' AND row_id = OLD.playlist_id
+              AND seq > (SELECT seq FROM change_log_mark)
+        );
+    END;
+
+    CREATE TRIGGER change_log_playlist_songs_delete AFTER DELETE ON playlist_songs BEGIN
+        INSERT INTO change_log (kind, row_id) SELECT 'playlist_songs', OLD.playlist_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM change_log
+            WHERE kind = 'playlist_songs' AND row_id = OLD.playlist_id
+              AND seq > (SELECT seq FROM change_log_mark)
+        );
+    END;
+    """,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# After migrating, VACUUM if at least this fraction of the file is free
+# pages (left behind by steps that rewrite tables).
+VACUUM_FREE_RATIO = 0.25
+
+
+def _split_sql(script):
+    """Yields the individual statements of an SQL script (trigger-safe)."""
+    buf = ""
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            yield buf.strip()
+            buf = ""
+    if buf.strip():
+        yield buf.strip()
+
+
+def get_schema_version():
+    return get_connection().execute("PRAGMA user_version").fetchone()[0]
+
+
+# Tables whose rows are listed in (sort_name, id) order.
+_SORTED_TABLES = ("songs", "playlists", "artists", "genres")
+
+
+def backfill_sort_names():
+    """
+    Sets sort_name on rows written without one (by a version of the app
+    from before sort_name, or a script), which keyset pages would skip.
+    Costs one index probe per table when there are none.
+    """
+    conn = get_connection()
+    for table in _SORTED_TABLES:
+        if conn.execute(f"SELECT 1 FROM {table} WHERE sort_name IS NULL LIMIT 1").fetchone():
+            with transaction(immediate=True):
+                conn.execute(f"UPDATE {table} SET sort_name = sort_key(name) WHERE sort_name IS NULL")
+
+
+def init_db():
+    """
+    Brings the schema up to date by applying only the pending MIGRATIONS.
+    Existing data is never dropped. On an up-to-date database this is a
+    PRAGMA read plus compact_change_log() and backfill_sort_names(), so
+    startup cost does not depend on library size.
+    """
+    if get_schema_version() >= SCHEMA_VERSION:
+        compact_change_log()
+        backfill_sort_names()
+        return
+
+    migrated = False
+    for version, step in enumerate(MIGRATIONS, start=1):
+        with transaction(immediate=True) as conn:
+            # Re-check under the write lock: another process may have
+            # migrated while we were waiting.
+            if get_schema_version() >= version:
+                continue
+            if callable(step):
+                step(conn)
+            else:
+                for statement in _split_sql(step):
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version}")
+            migrated = True
+
+    backfill_sort_names()
+    if migrated:
+        conn = get_connection()
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        pages = conn.execute("PRAGMA page_count").fetchone()[0]
+        if free > pages * VACUUM_FREE_RATIO:
+            conn.execute("VACUUM")
+
+
+# ---------------------------------------------------------
+# SONG FUNCTIONS
+# ---------------------------------------------------------
+
+# SQL for songs.added_at on insert (seconds since the epoch).
+_NOW = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+# Adds one song from (name, artist_id, genre_id).
+_INSERT_SONG = f"""
+    INSERT INTO songs (name, sort_name, artist_id, genre_id, added_at)
+    VALUES (?1, sort_key(?1), ?2, ?3, {_NOW})
+"""
+
+# Bumped after every committed write to songs, so in-memory caches can
+# tell that their contents may be stale.
+_song_writes = 0
+_song_writes_lock = threading.Lock()
+
+
+def _songs_changed():
+    global _song_writes
+    with _song_writes_lock:
+        _song_writes += 1
+
+
+def get_song_write_count():
+    return _song_writes
+
+
+def _facet_id(conn, table, name, known=None):
+    """
+    Id of the artists or genres row called name, added if new; None for a
+    blank name. known is an optional {name: id} dict reused across calls.
+    """
+    if not name:
+        return None
+    if known is not None and name in known:
+        return known[name]
+
+    row = conn.execute(f"SELECT id FROM {table} WHERE name = ?", (name,)).fetchone()
+    if row is not None:
+        facet_id = row[0]
+    else:
+        facet_id = conn.execute(
+            f"INSERT INTO {table} (name, sort_name) VALUES (?1, sort_key(?1))", (name,)
+        ).lastrowid
+    if known is not None:
+        known[name] = facet_id
+    return facet_id
+
+
+def create_song(name, artist="", genre=""):
+    if name.strip() == "":
+        raise ValueError("Song name cannot be empty.")
+
+    with transaction() as conn:
+        cur = conn.execute(
+            _INSERT_SONG,
+            (name.strip(), _facet_id(conn, "artists", artist.strip()),
+             _facet_id(conn, "genres", genre.strip()))
+        )
+    _songs_changed()
+    return cur.lastrowid
+
+
+# Rows per executemany() call in import_songs().
+IMPORT_BATCH_SIZE = 5000
+
+# Per-row AFTER INSERT triggers on songs. Past its first batch,
+# import_songs() drops them for the rest of its transaction and does their
+# work once, set-based, in _BULK_INSERT_CATCH_UP.
+_BULK_INSERT_TRIGGERS = (
+    "songs_fts_insert",
+    "songs_count_insert",
+    "search_terms_insert",
+    "smart_playlist_insert",
+    "change_log_song_insert",
+)
+
+# What those triggers would have done for the songs with id > :last_id.
+_BULK_INSERT_CATCH_UP = """
+UPDATE artists SET song_count = song_count + added.n
+FROM (SELECT artist_id, COUNT(*) AS n FROM songs WHERE id > :last_id GROUP BY artist_id) AS added
+WHERE artists.id = added.artist_id;
+
+UPDATE genres SET song_count = song_count + added.n
+FROM (SELECT genre_id, COUNT(*) AS n FROM songs WHERE id > :last_id GROUP BY genre_id) AS added
+WHERE genres.id = added.genre_id;
+
+INSERT INTO artist_genres (artist_id, genre_id, song_count)
+SELECT artist_id, genre_id, COUNT(*) FROM songs
+WHERE id > :last_id AND artist_id IS NOT NULL AND genre_id IS NOT NULL
+GROUP BY artist_id, genre_id
+ON CONFLICT (artist_id, genre_id) DO UPDATE SET song_count = song_count + excluded.song_count;
+
+INSERT OR IGNORE INTO search_terms_pending (song_id)
+SELECT id FROM songs WHERE id > :last_id;
+
+INSERT OR IGNORE INTO smart_playlist_pending (song_id)
+SELECT id FROM songs
+WHERE id > :last_id AND EXISTS (SELECT 1 FROM playlists WHERE rules IS NOT NULL);
+
+INSERT INTO change_log (kind, row_id)
+SELECT 'song', id FROM songs WHERE id > :last_id ORDER BY id;
+"""
+
+# The same for songs_fts, when SQLite has FTS5.
+_BULK_INSERT_FTS_CATCH_UP = """
+INSERT INTO songs_fts (rowid, name, artist, genre)
+SELECT id, name, artist, genre FROM song_view WHERE id > :last_id
+"""
+
+
+def _suspend_insert_triggers(conn):
+    """
+    Drops the _BULK_INSERT_TRIGGERS for the rest of the transaction.
+    Returns what _resume_insert_triggers() needs to put them back.
+    """
+    triggers = conn.execute(
+        f"""
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'trigger' AND name IN ({", ".join("?" * len(_BULK_INSERT_TRIGGERS))})
+        """,
+        _BULK_INSERT_TRIGGERS
+    ).fetchall()
+    for name, _ in triggers:
+        conn.execute(f"DROP TRIGGER {name}")
+    last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM songs").fetchone()[0]
+    return triggers, last_id
+
+
+def _resume_insert_triggers(conn, triggers, last_id):
+    """Catches up on the songs added since _suspend_insert_triggers() and restores the triggers."""
+    for statement in _split_sql(_BULK_INSERT_CATCH_UP):
+        conn.execute(statement, {"last_id": last_id})
+    if any(name == "songs_fts_insert" for name, _ in triggers):
+        conn.execute(_BULK_INSERT_FTS_CATCH_UP, {"last_id": last_id})
+    for _, sql in triggers:
+        conn.execute(sql)
+
+
+def _clean(value):
+    return "" if value is None else str(value).strip()
+
+
+def import_songs(songs, batch_size=IMPORT_BATCH_SIZE, progress=None, on_reject=None):
+    """
+    Bulk-inserts songs from any iterable of dicts with a 'name' key and
+    optional 'artist' / 'genre' keys. The iterable is consumed lazily and
+    written with executemany() in batches, all inside one transaction.
+
+    Rows without a name are skipped and reported as on_reject(index, row,
+    reason). So are exceptions in songs, which a reader yields for records
+    it could not parse; their message is the reason. progress(imported) is
+    called after every batch.
+    Returns (imported, rejected).
+
+    Once a first full batch shows the import is a large one, the per-row
+    triggers on songs are suspended (see _BULK_INSERT_TRIGGERS) and their
+    work is done once at the end, so later batches cost only the inserts.
+    """
+    if batch_size < 1:
+        raise ValueError("Batch size must be at least 1.")
+
+    imported = 0
+    rejected = 0
+
+    def valid_rows():
+        nonlocal rejected
+        for index, row in enumerate(songs):
+            if isinstance(row, Exception):
+                rejected += 1
+                if on_reject is not None:
+                    on_reject(index, row, str(row))
+                continue
+            try:
+                name = _clean(row.get("name"))
+            except AttributeError:
+                name = ""
+                reason = "Row is not a record."
+            else:
+                reason = "Song name cannot be empty."
+            if name == "":
+                rejected += 1
+                if on_reject is not None:
+                    on_reject(index, row, reason)
+                continue
+            yield (name, _clean(row.get("artist")), _clean(row.get("genre")))
+
+    rows = valid_rows()
+    artists, genres = {}, {}
+    suspended = None
+    with transaction(immediate=True) as conn:
+        while True:
+            batch = [
+                (name, _facet_id(conn, "artists", artist, artists),
+                 _facet_id(conn, "genres", genre, genres))
+                for name, artist, genre in islice(rows, batch_size)
+            ]
+            if not batch:
+                break
+            conn.executemany(
+                _INSERT_SONG,
+                batch
+            )
+            imported += len(batch)
+            if progress is not None:
+                progress(imported)
+            if suspended is None and len(batch) == batch_size:
+                suspended = _suspend_insert_triggers(conn)
+
+        if suspended is not None:
+            _resume_insert_triggers(conn, *suspended)
+
+    _songs_changed()
+    return imported, rejected
+
+
+def get_all_songs():
+    conn = get_connection()
+    rows = conn.execute(
+        "SELECT id, name, artist, genre, library_id FROM song_view ORDER BY sort_name, id"
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_song(song_id):
+    """Returns one song as a dict, or None if it does not exist."""
+    row = get_connection().execute(
+        "SELECT id, name, artist, genre, library_id FROM song_view WHERE id = ?", (song_id,)
+    ).fetchone()
+    return dict(row) if row is not None else None
+
+
+# Rows per page for get_songs_page().
+PAGE_SIZE = 200
+
+
+def count_songs(artist_id=None, genre_id=None):
+    """
+    Number of songs, optionally only those by one artist and/or in one
+    genre. Filtered counts are read from the maintained count tables.
+    """
+    conn = get_connection()
+    if artist_id is None and genre_id is None:
+        return conn.execute("SELECT COUNT(*) FROM songs").fetchone()[0]
+
+    if genre_id is None:
+        row = conn.execute("SELECT song_count FROM artists WHERE id = ?", (artist_id,)).fetchone()
+    elif artist_id is None:
+        row = conn.execute("SELECT song_count FROM genres WHERE id = ?", (genre_id,)).fetchone()
+    else:
+        row = conn.execute(
+            "SELECT song_count FROM artist_genres WHERE artist_id = ? AND genre_id = ?",
+            (artist_id, genre_id)
+        ).fetchone()
+    return row[0] if row is not None else 0
+
+
+def _page_by_name_index(conn, artist_id, genre_id, limit):
+    """
+    A filtered page can be found two ways: walk idx_songs_sort skipping
+    songs outside the facet (reads about limit * total / matching rows), or
+    take every matching song from idx_songs_artist/idx_songs_genre and sort
+    them (reads matching rows). Returns True when walking is cheaper, i.e.
+    for facets holding a large share of the library.
+    """
+    matching = count_songs(artist_id, genre_id)
+    # MAX(id) is an O(log n) stand-in for the song count.
+    total = conn.execute("SELECT MAX(id) FROM songs").fetchone()[0] or 0
+    return matching * matching > limit * total
+
+
+def get_songs_page(after=None, before=None, offset=0, limit=PAGE_SIZE,
+                   artist_id=None, genre_id=None):
+    """
+    Returns one page of songs in (sort_name, id) order.
+
+    Keyset pagination: pass the (name, id) of the last row already shown as
+    after= for the next page, or of the first row as before= for the
+    previous page; the name is turned into its sort key here. Both are
+    index seeks, so cost does not grow with depth. offset= is only meant
+    for jumping to an arbitrary position.
+
+    artist_id / genre_id restrict the listing to one artist and/or genre
+    (faceted browsing). See _page_by_name_index() for how those pages are
+    found.
+    """
+    conn = get_connection()
+    where, params = [], []
+    if artist_id is not None or genre_id is not None:
+        # A unary + stops SQLite from using the artist/genre index.
+        plus = "+" if _page_by_name_index(conn, artist_id, genre_id, limit) else ""
+        if artist_id is not None:
+            where.append(f"{plus}artist_id = ?")
+            params.append(artist_id)
+        if genre_id is not None:
+            where.append(f"{plus}genre_id = ?")
+            params.append(genre_id)
+
+    order = "sort_name, id"
+    if after is not None:
+        key = sort_key(after[0])
+        where.append("sort_name >= ? AND (sort_name > ? OR id > ?)")
+        params += [key, key, after[1]]
+        offset = 0
+    elif before is not None:
+        key = sort_key(before[0])
+        where.append("sort_name <= ? AND (sort_name < ? OR id < ?)")
+        params += [key, key, before[1]]
+        order = "sort_name DESC, id DESC"
+        offset = 0
+
+    rows = conn.execute(
+        f"""
+        SELECT id, name, artist, genre, library_id FROM song_view
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY {order}
+        LIMIT ? OFFSET ?
+        """,
+        (*params, limit, offset)
+    ).fetchall()
+    if before is not None:
+        rows.reverse()
+
+    return [dict(row) for row in rows]
+
+
+def get_artists(genre_id=None):
+    """
+    Artists that have songs, by name, as dicts with id, name and songs (the
+    song count, within genre_id if given). Counts come from the maintained
+    count tables, so this does not touch songs.
+    """
+    conn = get_connection()
+    if genre_id is None:
+        rows = conn.execute(
+            """
+            SELECT id, name, song_count AS songs FROM artists
+            WHERE song_count > 0
+            ORDER BY sort_name, id
+            """
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            """
+            SELECT a.id, a.name, ag.song_count AS songs
+            FROM artist_genres ag
+            JOIN artists a ON a.id = ag.artist_id
+            WHERE ag.genre_id = ? AND ag.song_count > 0
+            ORDER BY a.sort_name, a.id
+            """,
+            (genre_id,)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_genres(artist_id=None):
+    """Genres that have songs, like get_artists(); counts within artist_id if given."""
+    conn = get_connection()
+    if artist_id is None:
+        rows = conn.execute(
+            """
+            SELECT id, name, song_count AS songs FROM genres
+            WHERE song_count > 0
+            ORDER BY sort_name, id
+            """
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            """
+            SELECT g.id, g.name, ag.song_count AS songs
+            FROM artist_genres ag
+            JOIN genres g ON g.id = ag.genre_id
+            WHERE ag.artist_id = ? AND ag.song_count > 0
+            ORDER BY g.sort_name, g.id
+            """,
+            (artist_id,)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def update_song(song_id, name, artist="", genre=""):
+    if name.strip() == "":
+        raise ValueError("Song name cannot be empty.")
+
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE songs SET name = ?1, sort_name = sort_key(?1), artist_id = ?2, genre_id = ?3 "
+            "WHERE id = ?4",
+            (name.strip(), _facet_id(conn, "artists", artist.strip()),
+             _facet_id(conn, "genres", genre.strip()), song_id)
+        )
+    _songs_changed()
+
+
+def delete_song(song_id):
+    with transaction() as conn:
+        conn.execute("DELETE FROM songs WHERE id = ?", (song_id,))
+    _songs_changed()
+
+
+# ---------------------------------------------------------
+# PLAYLIST FUNCTIONS
+# ---------------------------------------------------------
+
+def create_playlist(name):
+    if name.strip() == "":
+        raise ValueError("Playlist name cannot be empty.")
+
+    with transaction() as conn:
+        cur = conn.execute(
+            "INSERT INTO playlists (name, sort_name) VALUES (?1, sort_key(?1))", (name.strip(),)
+        )
+        return cur.lastrowid
+
+
+def delete_playlist(playlist_id):
+    with transaction() as conn:
+        # Songs first, while the playlist row still tells the
+        # song_neighbors_unlink trigger whether it was a smart playlist.
+        conn.execute("DELETE FROM playlist_songs WHERE playlist_id = ?", (playlist_id,))
+        conn.execute("DELETE FROM playlists WHERE id = ?", (playlist_id,))
+
+
+def get_all_playlists():
+    """Returns [{'id': ..., 'name': ..., 'smart': bool}] in name order."""
+    rows = get_connection().execute(
+        """
+        SELECT id, name, rules IS NOT NULL AS smart
+        FROM playlists
+        ORDER BY sort_name, id
+        """
+    ).fetchall()
+    return [{**row, "smart": bool(row["smart"])} for row in rows]
+
+
+def get_playlist_id(name):
+    """Id of the playlist called name, or None."""
+    row = get_connection().execute(
+        "SELECT id FROM playlists WHERE name = ?", (name.strip(),)
+    ).fetchone()
+    return row[0] if row is not None else None
+
+
+# Song ids looked up per query by get_playlists_for_songs().
+PLAYLIST_LOOKUP_BATCH_SIZE = 500
+
+
+def get_playlists_for_songs(song_ids, batch_size=PLAYLIST_LOOKUP_BATCH_SIZE):
+    """
+    {song_id: [{'id', 'name', 'smart'}, ...]} for the songs of song_ids
+    that are in any playlist, each list in name order. Every song is one
+    range of idx_playlist_songs_song.
+    """
+    conn = get_connection()
+    found = {}
+    song_ids = iter(song_ids)
+    while True:
+        batch = list(islice(song_ids, batch_size))
+        if not batch:
+            return found
+        rows = conn.execute(
+            f"""
+            SELECT ps.song_id, p.id, p.name, p.rules IS NOT NULL AS smart
+            FROM playlist_songs ps
+            JOIN playlists p ON p.id = ps.playlist_id
+            WHERE ps.song_id IN ({", ".join("?" * len(batch))})
+            ORDER BY ps.song_id, p.sort_name, p.id
+            """,
+            batch
+        )
+        for song_id, playlist_id, name, smart in rows:
+            found.setdefault(song_id, []).append(
+                {"id": playlist_id, "name": name, "smart": bool(smart)}
+            )
+
+
+def get_playlists_for_song(song_id):
+    """The playlists song_id is in, as get_playlists_for_songs() lists them."""
+    return get_playlists_for_songs([song_id]).get(song_id, [])
+
+
+def count_playlist_songs(playlist_id):
+    """Number of songs in a playlist."""
+    return get_connection().execute(
+        "SELECT COUNT(*) FROM playlist_songs WHERE playlist_id = ?", (playlist_id,)
+    ).fetchone()[0]
+
+
+def get_playlist_songs_page(playlist_id, after=None, limit=PAGE_SIZE, before=None, offset=0):
+    """
+    One page of a playlist's songs in running order, as dicts with id,
+    name, artist, genre and position. Keyset pagination like
+    get_songs_page(): after is the (position, id) of the last row shown,
+    before the (position, id) of the first; offset= is only meant for
+    jumping to an arbitrary row.
+    """
+    where, params = "ps.playlist_id = ?", [playlist_id]
+    order = "ps.position, ps.song_id"
+    if after is not None:
+        where += " AND (ps.position, ps.song_id) > (?, ?)"
+        params += after
+        offset = 0
+    elif before is not None:
+        where += " AND (ps.position, ps.song_id) < (?, ?)"
+        params += before
+        order = "ps.position DESC, ps.song_id DESC"
+        offset = 0
+    rows = get_connection().execute(
+        f"""
+        SELECT s.id, s.name, s.artist, s.genre, s.library_id, ps.position
+        FROM playlist_songs ps
+        JOIN song_view s ON s.id = ps.song_id
+        WHERE {where}
+        ORDER BY {order}
+        LIMIT ? OFFSET ?
+        """,
+        (*params, limit, offset)
+    ).fetchall()
+    if before is not None:
+        rows.reverse()
+    return [dict(row) for row in rows]
+
+
+# Playlist order is kept in playlist_songs.position. New songs are spaced
+# POSITION_GAP apart, so a move can take the midpoint between its new
+# neighbours and rewrite only its own row. Once a move or insert leaves
+# less than RENUMBER_BELOW between neighbours, the playlist is queued for
+# renumbering in the background (see run_maintenance); only when there
+# is no room at all is it renumbered on the spot.
+POSITION_GAP = 65536
+RENUMBER_BELOW = 64
+
+
+def _end_position(conn, playlist_id):
+    row = conn.execute(
+        "SELECT MAX(position) FROM playlist_songs WHERE playlist_id = ?",
+        (playlist_id,)
+    ).fetchone()
+    return row[0] or 0
+
+
+def renumber_playlist(playlist_id, index=0, room=0):
+    """
+    Respaces a playlist's positions POSITION_GAP apart, keeping its order.
+    room extra gaps are left before the song at index, so that many songs
+    can be put there.
+    """
+    with transaction() as conn:
+        last_seq = conn.execute("SELECT MAX(seq) FROM change_log").fetchone()[0] or 0
+        conn.execute(
+            """
+            UPDATE playlist_songs SET position = (ranked.n + IIF(ranked.n > ?, ?, 0)) * ?
+            FROM (
+                SELECT song_id, ROW_NUMBER() OVER (ORDER BY position, song_id) AS n
+                FROM playlist_songs
+                WHERE playlist_id = ?
+            ) AS ranked
+            WHERE playlist_songs.playlist_id = ?
+              AND playlist_songs.song_id = ranked.song_id
+            """,
+            (index, room, POSITION_GAP, playlist_id, playlist_id)
+        )
+        conn.execute("DELETE FROM playlist_renumber_pending WHERE playlist_id = ?", (playlist_id,))
+        _log_renumber(conn, playlist_id, last_seq)
+
+
+def renumber_pending_playlists():
+    """
+    Renumbers the playlists queued by moves and inserts that found little
+    room left, one transaction each. Returns the number renumbered.
+    """
+    renumbered = 0
+    while True:
+        with transaction(immediate=True) as conn:
+            row = conn.execute("SELECT playlist_id FROM playlist_renumber_pending LIMIT 1").fetchone()
+            if row is None:
+                return renumbered
+            renumber_playlist(row[0])
+        renumbered += 1
+
+
+def _neighbour_positions(conn, playlist_id, index, exclude):
+    # Positions of the songs now at index - 1 and index, ignoring exclude.
+    rows = conn.execute(
+        """
+        SELECT position FROM playlist_songs
+        WHERE playlist_id = ? AND song_id IS NOT ?
+        ORDER BY position, song_id
+        LIMIT 2 OFFSET ?
+        """,
+        (playlist_id, exclude, max(index - 1, 0))
+    ).fetchall()
+    positions = [row[0] for row in rows]
+
+    if index <= 0:
+        return None, (positions[0] if positions else None)
+    prev = positions[0] if positions else None
+    nxt = positions[1] if len(positions) > 1 else None
+    return prev, nxt
+
+
+def _positions_before(conn, playlist_id, index, count, exclude=None):
+    """
+    Returns count increasing positions that slot in before the song now at
+    index (or at the end), ignoring song exclude. Second value tells
+    whether the playlist had to be renumbered to make room.
+    """
+    prev, nxt = _neighbour_positions(conn, playlist_id, index, exclude)
+    if nxt is None:
+        start = prev if prev is not None else 0
+        return [start + POSITION_GAP * (k + 1) for k in range(count)], False
+    if prev is None:
+        return [nxt - POSITION_GAP * (count - k) for k in range(count)], False
+
+    step = (nxt - prev) // (count + 1)
+    renumbered = step < 1
+    if renumbered:
+        # No room left: respace now, leaving count extra gaps at index.
+        # (A moved song, excluded here but ranked there, may shift them by
+        # one place; the single gap it needs is still there.)
+        renumber_playlist(playlist_id, index, count)
+        prev, nxt = _neighbour_positions(conn, playlist_id, index, exclude)
+        step = (nxt - prev) // (count + 1)
+    elif step < RENUMBER_BELOW:
+        conn.execute("INSERT OR IGNORE INTO playlist_renumber_pending VALUES (?)", (playlist_id,))
+    return [prev + step * (k + 1) for k in range(count)], renumbered
+
+
+def add_song_to_playlist(playlist_id, song_id):
+    with transaction() as conn:
+        conn.execute(
+            """
+            INSERT OR IGNORE INTO playlist_songs (playlist_id, song_id, position)
+            VALUES (?, ?, ?)
+            """,
+            (playlist_id, song_id, _end_position(conn, playlist_id) + POSITION_GAP)
+        )
+
+
+def insert_songs_at(playlist_id, song_ids, index):
+    """
+    Inserts songs so the first lands at index in the running order (songs
+    already in the playlist are skipped). Returns the number added.
+    """
+    with transaction() as conn:
+        song_ids = list(dict.fromkeys(song_ids))
+        positions, _ = _positions_before(conn, playlist_id, index, len(song_ids))
+        return conn.executemany(
+            """
+            INSERT OR IGNORE INTO playlist_songs (playlist_id, song_id, position)
+            VALUES (?, ?, ?)
+            """,
+            ((playlist_id, song_id, pos) for song_id, pos in zip(song_ids, positions))
+        ).rowcount
+
+
+def move_song_in_playlist(playlist_id, song_id, index):
+    """
+    Moves a song to index in the running order by rewriting only its own
+    position. Returns (new position, renumbered); renumbered is True when
+    the rest of the playlist had to be respaced first.
+    """
+    with transaction() as conn:
+        (position,), renumbered = _positions_before(
+            conn, playlist_id, index, 1, exclude=song_id
+        )
+        conn.execute(
+            "UPDATE playlist_songs SET position = ? WHERE playlist_id = ? AND song_id = ?",
+            (position, playlist_id, song_id)
+        )
+        return position, renumbered
+
+
+def remove_song_from_playlist(playlist_id, song_id):
+    with transaction() as conn:
+        conn.execute(
+            "DELETE FROM playlist_songs WHERE playlist_id = ? AND song_id = ?",
+            (playlist_id, song_id)
+        )
+
+
+# Batch versions: one transaction (and where possible one statement) for
+# any number of songs. Each returns the number of links added or removed.
+
+def add_songs_to_playlist(playlist_id, song_ids):
+    with transaction() as conn:
+        end = _end_position(conn, playlist_id)
+        return conn.executemany(
+            """
+            INSERT OR IGNORE INTO playlist_songs (playlist_id, song_id, position)
+            VALUES (?, ?, ?)
+            """,
+            ((playlist_id, song_id, end + POSITION_GAP * n)
+             for n, song_id in enumerate(song_ids, start=1))
+        ).rowcount
+
+
+def remove_songs_from_playlist(playlist_id, song_ids):
+    with transaction() as conn:
+        return conn.executemany(
+            "DELETE FROM playlist_songs WHERE playlist_id = ? AND song_id = ?",
+            ((playlist_id, song_id) for song_id in song_ids)
+        ).rowcount
+
+
+def merge_playlists(target_id, source_ids):
+    """
+    Appends every song of the source playlists to the target playlist,
+    each source in its own running order. One statement per source.
+    """
+    added = 0
+    with transaction() as conn:
+        for source_id in dict.fromkeys(source_ids):
+            if source_id == target_id:
+                continue
+            cur = conn.execute(
+                """
+                INSERT OR IGNORE INTO playlist_songs (playlist_id, song_id, position)
+                SELECT ?, song_id, ? + ROW_NUMBER() OVER (ORDER BY position, song_id) * ?
+                FROM playlist_songs
+                WHERE playlist_id = ?
+                """,
+                (target_id, _end_position(conn, target_id), POSITION_GAP, source_id)
+            )
+            added += cur.rowcount
+    return added
+
+
+def copy_playlist(playlist_id, new_name):
+    """Creates new_name with the same songs as playlist_id. Returns the new id."""
+    with transaction():
+        new_id = create_playlist(new_name)
+        merge_playlists(new_id, [playlist_id])
+    return new_id
+
+
+# ---------------------------------------------------------
+# SMART PLAYLISTS
+# ---------------------------------------------------------
+
+# A smart playlist's rules are a dict like
+#     {"match": "all", "rules": [{"field": "genre", "op": "is one of",
+#                                 "value": ["Jazz", "Blues"]}, ...]}
+# ("match": "any" for OR). Its songs are materialized in playlist_songs,
+# in id (library) order, so it opens exactly like a static playlist.
+
+# Fields rules can test, and the kind of value each holds.
+SMART_FIELDS = {
+    "name": "text",
+    "artist": "text",
+    "genre": "text",
+    "path": "text",
+    "duration": "number",
+    "added": "date",
+}
+
+# Operators for each kind of field.
+SMART_OPERATORS = {
+    "text": ("is", "is not", "contains", "does not contain", "starts with", "is one of"),
+    "number": ("is", "greater than", "less than"),
+    "date": ("after", "before"),
+}
+
+
+def _like_pattern(value, prefix="%", suffix="%"):
+    escaped = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return prefix + escaped + suffix
+
+
+def _day_start(value, days=0):
+    day = datetime.date.fromisoformat(str(value)) + datetime.timedelta(days=days)
+    return int(time.mktime(day.timetuple()))
+
+
+def _compile_rule(rule):
+    field, op, value = rule.get("field"), rule.get("op"), rule.get("value")
+    kind = SMART_FIELDS.get(field)
+    if kind is None or op not in SMART_OPERATORS[kind]:
+        raise ValueError(f"Unsupported rule: {field} {op}.")
+
+    if kind == "number":
+        sign = {"is": "=", "greater than": ">", "less than": "<"}[op]
+        return f"s.{field} {sign} ?", [float(value)]
+    if kind == "date":
+        # "after" a day means from the start of the next one.
+        if op == "after":
+            return "s.added_at >= ?", [_day_start(value, days=1)]
+        return "s.added_at < ?", [_day_start(value)]
+
+    negated = op in ("is not", "does not contain")
+    if op == "is one of":
+        values = value if isinstance(value, list) else str(value).split(",")
+        values = [str(v).strip() for v in values if str(v).strip()]
+        if not values:
+            raise ValueError(f"Rule {field} is one of needs at least one value.")
+        test, params = f"{{}} COLLATE NOCASE IN ({', '.join('?' * len(values))})", values
+    elif op in ("is", "is not"):
+        test, params = "{} = ? COLLATE NOCASE", [str(value)]
+    else:
+        pattern = _like_pattern(str(value), prefix="" if op == "starts with" else "%")
+        test, params = "{} LIKE ? ESCAPE '\\'", [pattern]
+
+    if field in ("artist", "genre"):
+        sql = f"s.{field}_id IN (SELECT id FROM {field}s WHERE {test.format('name')})"
+    else:
+        sql = test.format(f"s.{field}")
+    # IS NOT 1 also keeps songs whose field is NULL.
+    return (f"({sql}) IS NOT 1" if negated else sql), params
+
+
+def _compile_rules(rules):
+    """WHERE clause over songs s (and its params) selecting the matching songs."""
+    if not isinstance(rules, dict) or not rules.get("rules"):
+        raise ValueError("A smart playlist needs at least one rule.")
+    match = rules.get("match", "all")
+    if match not in ("all", "any"):
+        raise ValueError('Rules must match "all" or "any".')
+
+    clauses, params = [], []
+    for rule in rules["rules"]:
+        try:
+            sql, rule_params = _compile_rule(rule)
+        except (AttributeError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid rule {rule!r}: {e}") from None
+        clauses.append(f"({sql})")
+        params += rule_params
+    return (" AND " if match == "all" else " OR ").join(clauses), params
+
+
+def _materialize(conn, playlist_id, rules, pending_upto=None):
+    """
+    Re-evaluates a smart playlist: against every song, or only against
+    the songs queued in smart_playlist_pending up to id pending_upto.
+    """
+    where, params = _compile_rules(rules)
+    source, bound = "songs s", []
+    if pending_upto is not None:
+        # CROSS JOIN keeps the (short) queue as the outer loop; left to
+        # itself the planner may walk the whole genre or name index.
+        source = "smart_playlist_pending p CROSS JOIN songs s ON s.id = p.song_id AND p.song_id <= ?"
+        bound = [pending_upto]
+        conn.execute(
+            f"""
+            DELETE FROM playlist_songs
+            WHERE playlist_id = ?
+              AND song_id IN (SELECT s.id FROM {source} WHERE ({where}) IS NOT 1)
+            """,
+            (playlist_id, *bound, *params)
+        )
+    else:
+        conn.execute("DELETE FROM playlist_songs WHERE playlist_id = ?", (playlist_id,))
+    conn.execute(
+        f"""
+        INSERT OR IGNORE INTO playlist_songs (playlist_id, song_id, position)
+        SELECT ?, s.id, s.id FROM {source} WHERE {where}
+        """,
+        (playlist_id, *bound, *params)
+    )
+
+
+def create_smart_playlist(name, rules):
+    """Creates a playlist kept filled with the songs matching rules. Returns its id."""
+    _compile_rules(rules)
+    with transaction(immediate=True):
+        playlist_id = create_playlist(name)
+        set_playlist_rules(playlist_id, rules)
+    return playlist_id
+
+
+def set_playlist_rules(playlist_id, rules):
+    """
+    Replaces a playlist's rules and re-fills it from the whole library.
+    rules=None turns it into a static playlist keeping its current songs.
+    """
+    with transaction(immediate=True) as conn:
+        # Similar songs only count static playlists, so their songs'
+        # neighbours change when the playlist switches kind.
+        conn.execute("INSERT OR IGNORE INTO neighbor_pending_playlists VALUES (?)", (playlist_id,))
+        conn.execute(
+            """
+            INSERT OR IGNORE INTO neighbor_pending_songs (song_id)
+            SELECT song_id FROM playlist_songs
+            WHERE playlist_id = ? AND (SELECT rules FROM playlists WHERE id = ?) IS NULL
+            """,
+            (playlist_id, playlist_id)
+        )
+        conn.execute(
+            "UPDATE playlists SET rules = ? WHERE id = ?",
+            (None if rules is None else json.dumps(rules), playlist_id)
+        )
+        if rules is not None:
+            _materialize(conn, playlist_id, rules)
+
+
+def is_smart_playlist(playlist_id):
+    """True if the playlist is filled by rules, so its songs must not be edited by hand."""
+    row = get_connection().execute(
+        "SELECT rules IS NOT NULL FROM playlists WHERE id = ?", (playlist_id,)
+    ).fetchone()
+    return bool(row and row[0])
+
+
+def get_playlist_rules(playlist_id):
+    """The rules dict of a smart playlist, or None for a static one."""
+    row = get_connection().execute(
+        "SELECT rules FROM playlists WHERE id = ?", (playlist_id,)
+    ).fetchone()
+    return json.loads(row[0]) if row is not None and row[0] is not None else None
+
+
+def refresh_smart_playlists(batch_size=IMPORT_BATCH_SIZE):
+    """
+    Applies the song writes queued since the last refresh to every smart
+    playlist, evaluating the rules against those songs only and
+    committing every batch_size songs. Cheap when nothing is queued.
+    run_maintenance() calls it after writes; reads do not, so a smart
+    playlist may lag the songs by one maintenance run.
+    Returns the number of queued songs processed.
+    """
+    conn = get_connection()
+    if conn.execute("SELECT 1 FROM smart_playlist_pending LIMIT 1").fetchone() is None:
+        return 0
+
+    processed = 0
+    while True:
+        with transaction(immediate=True) as conn:
+            last, count = conn.execute(
+                """
+                SELECT MAX(song_id), COUNT(*) FROM (
+                    SELECT song_id FROM smart_playlist_pending ORDER BY song_id LIMIT ?
+                )
+                """,
+                (batch_size,)
+            ).fetchone()
+            if last is None:
+                return processed
+            smart = conn.execute(
+                "SELECT id, rules FROM playlists WHERE rules IS NOT NULL"
+            ).fetchall()
+            for playlist_id, rules in smart:
+                _materialize(conn, playlist_id, json.loads(rules), pending_upto=last)
+            conn.execute("DELETE FROM smart_playlist_pending WHERE song_id <= ?", (last,))
+        processed += count
+
+
+# ---------------------------------------------------------
+# SIMILAR SONGS
+# ---------------------------------------------------------
+
+# Two songs are similar when they share static playlists; each shared
+# playlist adds 1 / its size, so a 10-song playlist says more about its
+# songs than a 1,000-song one. The NEIGHBOR_COUNT best scores per song
+# are kept in song_neighbors and recomputed when its playlists change.
+NEIGHBOR_COUNT = 30
+
+# Playlists above this size are left out: they say little about any two
+# of their songs, and their cost grows with the square of their size.
+NEIGHBOR_MAX_PLAYLIST_SIZE = 1_000
+
+# Songs recomputed per transaction by refresh_song_neighbors().
+NEIGHBOR_BATCH_SIZE = 5_000
+
+# Default number of songs returned by the recommendation queries.
+SIMILAR_LIMIT = 25
+
+
+def _compute_neighbors(conn, song_ids):
+    """
+    Replaces the neighbours of song_ids. Their rows of the song x song
+    co-occurrence matrix are summed from the song x playlist links, one
+    playlist at a time, and the top NEIGHBOR_COUNT of each row are kept.
+    """
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS neighbor_batch (song_id INTEGER PRIMARY KEY)")
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS neighbor_playlists (playlist_id INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM temp.neighbor_batch")
+    conn.execute("DELETE FROM temp.neighbor_playlists")
+    conn.executemany("INSERT INTO temp.neighbor_batch (song_id) VALUES (?)",
+                     ((song_id,) for song_id in song_ids))
+
+    playlists_of = {}
+    for song_id, playlist_id in conn.execute(
+        """
+        SELECT ps.song_id, ps.playlist_id
+        FROM temp.neighbor_batch b
+        JOIN playlist_songs ps ON ps.song_id = b.song_id
+        JOIN playlists p ON p.id = ps.playlist_id AND p.rules IS NULL
+        """
+    ):
+        playlists_of.setdefault(song_id, []).append(playlist_id)
+
+    conn.executemany(
+        "INSERT OR IGNORE INTO temp.neighbor_playlists (playlist_id) VALUES (?)",
+        ((playlist_id,) for playlist_ids in playlists_of.values() for playlist_id in playlist_ids)
+    )
+    # Counting stops past the limit, so big playlists cost no more than small ones.
+    conn.execute(
+        """
+        DELETE FROM temp.neighbor_playlists
+        WHERE (
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM playlist_songs
+                WHERE playlist_id = neighbor_playlists.playlist_id
+                LIMIT ?
+            )
+        ) > ?
+        """,
+        (NEIGHBOR_MAX_PLAYLIST_SIZE + 1, NEIGHBOR_MAX_PLAYLIST_SIZE)
+    )
+    songs_in = {}
+    cursor = conn.execute(
+        """
+        SELECT ps.playlist_id, ps.song_id
+        FROM temp.neighbor_playlists np
+        JOIN playlist_songs ps ON ps.playlist_id = np.playlist_id
+        ORDER BY ps.playlist_id
+        """
+    )
+    for playlist_id, rows in groupby(cursor, key=itemgetter(0)):
+        songs_in[playlist_id] = [row[1] for row in rows]
+
+    neighbors = []
+    for song_id, playlist_ids in playlists_of.items():
+        scores = {}
+        get = scores.get
+        for playlist_id in playlist_ids:
+            members = songs_in.get(playlist_id)
+            if members is None:
+                continue
+            weight = 1.0 / len(members)
+            for other in members:
+                scores[other] = get(other, 0.0) + weight
+        scores.pop(song_id, None)
+        best = heapq.nlargest(NEIGHBOR_COUNT, scores.items(), key=itemgetter(1))
+        neighbors.extend((song_id, other, score) for other, score in best)
+
+    conn.execute(
+        "DELETE FROM song_neighbors WHERE song_id IN (SELECT song_id FROM temp.neighbor_batch)"
+    )
+    conn.executemany(
+        "INSERT INTO song_neighbors (song_id, neighbor_id, score) VALUES (?, ?, ?)",
+        neighbors
+    )
+
+
+def refresh_song_neighbors(batch_size=NEIGHBOR_BATCH_SIZE):
+    """
+    Recomputes the neighbours of the songs affected by the playlist writes
+    queued since the last refresh: the songs added or removed, and the
+    other songs of those playlists. Cheap when nothing is queued.
+    run_maintenance() calls it after writes; the recommendation queries
+    read the neighbours as they stand. Returns the number of songs
+    recomputed.
+    """
+    conn = get_connection()
+    if (conn.execute("SELECT 1 FROM neighbor_pending_songs LIMIT 1").fetchone() is None
+            and conn.execute("SELECT 1 FROM neighbor_pending_playlists LIMIT 1").fetchone() is None):
+        return 0
 
-def get_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    # Expand changed playlists into their songs (the big ones are left
+    # out of every score, so their songs are not affected). The size test
+    # is materialized so it runs once per playlist, not once per song.
+    with transaction(immediate=True) as conn:
+        conn.execute(
+            """
+            WITH small AS MATERIALIZED (
+                SELECT pp.playlist_id
+                FROM neighbor_pending_playlists pp
+                JOIN playlists p ON p.id = pp.playlist_id AND p.rules IS NULL
+                WHERE (
+                    SELECT COUNT(*) FROM (
+                        SELECT 1 FROM playlist_songs WHERE playlist_id = pp.playlist_id LIMIT ?
+                    )
+                ) <= ?
+            )
+            INSERT OR IGNORE INTO neighbor_pending_songs (song_id)
+            SELECT ps.song_id
+            FROM small
+            CROSS JOIN playlist_songs ps ON ps.playlist_id = small.playlist_id
+            """,
+            (NEIGHBOR_MAX_PLAYLIST_SIZE + 1, NEIGHBOR_MAX_PLAYLIST_SIZE)
+        )
+        conn.execute("DELETE FROM neighbor_pending_playlists")
 
+    processed = 0
+    while True:
+        with transaction(immediate=True) as conn:
+            song_ids = [row[0] for row in conn.execute(
+                "SELECT song_id FROM neighbor_pending_songs ORDER BY song_id LIMIT ?",
+                (batch_size,)
+            )]
+            if not song_ids:
+                return processed
+            _compute_neighbors(conn, song_ids)
+            conn.execute("DELETE FROM neighbor_pending_songs WHERE song_id <= ?", (song_ids[-1],))
+        processed += len(song_ids)
 
-def init_db():
+
+def get_similar_songs(song_id, limit=SIMILAR_LIMIT):
+    """Songs most often found in the same playlists as song_id, best first."""
+    rows = get_connection().execute(
+        """
+        SELECT s.id, s.name, s.artist, s.genre, s.library_id, n.score
+        FROM song_neighbors n
+        JOIN song_view s ON s.id = n.neighbor_id
+        WHERE n.song_id = ?
+        ORDER BY n.score DESC, n.neighbor_id
+        LIMIT ?
+        """,
+        (song_id, limit)
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_playlist_extension(playlist_id, limit=SIMILAR_LIMIT):
     """
-    Recreates all tables every time the program runs.
-    This guarantees the 'songs' table definitely has a 'name' column.
+    Songs not in the playlist that are closest to its songs overall: the
+    neighbour scores of all its songs, summed. Best first.
     """
+    rows = get_connection().execute(
+        """
+        SELECT s.id, s.name, s.artist, s.genre, s.library_id, best.score
+        FROM (
+            SELECT n.neighbor_id, SUM(n.score) AS score
+            FROM playlist_songs ps
+            JOIN song_neighbors n ON n.song_id = ps.song_id
+            WHERE ps.playlist_id = ?
+              AND NOT EXISTS (
+                  SELECT 1 FROM playlist_songs
+                  WHERE playlist_id = ps.playlist_id AND song_id = n.neighbor_id
+              )
+            GROUP BY n.neighbor_id
+            ORDER BY score DESC, n.neighbor_id
+            LIMIT ?
+        ) AS best
+        JOIN song_view s ON s.id = best.neighbor_id
+        ORDER BY best.score DESC, best.neighbor_id
+        """,
+        (playlist_id, limit)
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+# ---------------------------------------------------------
+# SEARCH FUNCTIONS
+# ---------------------------------------------------------
+
+def search_songs_by_name(name_query):
+    q = name_query.strip()
+
     conn = get_connection()
-    cur = conn.cursor()
+    rows = conn.execute(
+        """
+        SELECT id, name, artist, genre
+        FROM song_view
+        WHERE name LIKE '%' || ? || '%'
+        ORDER BY sort_name, id
+        """,
+        (q,)
+    ).fetchall()
+    return [dict(row) for row in rows]
 
-    sql_script = """
-        DROP TABLE IF EXISTS playlist_songs;
-        DROP TABLE IF EXISTS playlists;
-        DROP TABLE IF EXISTS songs;
 
-        CREATE TABLE songs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            artist TEXT,
-            genre TEXT
-        );
+def search_songs_by_genre(genre_query):
+    q = genre_query.strip()
 
-        CREATE TABLE playlists (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL UNIQUE,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP
-        );
+    conn = get_connection()
+    rows = conn.execute(
+        """
+        SELECT id, name, artist, genre
+        FROM song_view
+        WHERE genre_id IN (SELECT id FROM genres WHERE name LIKE '%' || ? || '%')
+        ORDER BY sort_name, id
+        """,
+        (q,)
+    ).fetchall()
+    return [dict(row) for row in rows]
 
-        CREATE TABLE playlist_songs (
-            playlist_id INTEGER NOT NULL,
-            song_id INTEGER NOT NULL,
-            PRIMARY KEY (playlist_id, song_id),
-            FOREIGN KEY (playlist_id) REFERENCES playlists(id) ON DELETE CASCADE,
-            FOREIGN KEY (song_id) REFERENCES songs(id) ON DELETE CASCADE
-        );
+
+# Fields search_songs() can match against.
+SEARCH_FIELDS = ("name", "artist", "genre")
+
+# Default cap on ranked search results.
+SEARCH_LIMIT = 1000
+
+
+def _has_song_fts(conn):
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'songs_fts'"
+    ).fetchone()
+    return row is not None
+
+
+def _fts_query(terms, fields):
+    """Builds an FTS5 MATCH expression: every term, as a prefix, in any field."""
+    phrases = " AND ".join('"' + term.replace('"', '""') + '"*' for term in terms)
+    return "{" + " ".join(fields) + "} : (" + phrases + ")"
+
+
+def _search_terms(query, fields):
+    fields = tuple(fields)
+    if not fields or any(f not in SEARCH_FIELDS for f in fields):
+        raise ValueError(f"Search fields must be chosen from {SEARCH_FIELDS}.")
+    # Split like the FTS tokenizer (which also breaks on "_") so every term
+    # is one token: the index keeps no positions for phrase matching.
+    return re.findall(r"[^\W_]+", query), fields
+
+
+def _like_filter(terms, fields):
+    """WHERE clause (and params) for the LIKE fallback: every term in any field."""
+    any_field = "(" + " OR ".join(f"{f} LIKE '%' || ? || '%'" for f in fields) + ")"
+    where = " AND ".join([any_field] * len(terms))
+    params = [term for term in terms for _ in fields]
+    return where, params
+
+
+def search_songs(query, fields=SEARCH_FIELDS, limit=SEARCH_LIMIT, ranked=True):
+    """
+    Ranked full-text search. Every word in query must prefix-match a word
+    in one of the given fields ("beat help" finds "Help!" by The Beatles).
+    Results are ordered best match first; ranked=False skips scoring and
+    returns matches in id order, which lets LIMIT stop the scan early.
+    Falls back to LIKE matching when the FTS index is unavailable.
     """
+    terms, fields = _search_terms(query, fields)
+    if not terms:
+        return []
 
-    cur.executescript(sql_script)
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+    if _has_song_fts(conn):
+        rows = conn.execute(
+            f"""
+            SELECT s.id, s.name, s.artist, s.genre, s.library_id
+            FROM songs_fts
+            JOIN song_view s ON s.id = songs_fts.rowid
+            WHERE songs_fts MATCH ?
+            ORDER BY {"songs_fts.rank" if ranked else "songs_fts.rowid"}
+            LIMIT ?
+            """,
+            (_fts_query(terms, fields), -1 if limit is None else limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    # LIKE fallback: same semantics, but substring matches and a full scan.
+    where, params = _like_filter(terms, fields)
+    rows = conn.execute(
+        f"""
+        SELECT id, name, artist, genre, library_id
+        FROM song_view
+        WHERE {where}
+        ORDER BY sort_name, id
+        LIMIT ?
+        """,
+        (*params, -1 if limit is None else limit)
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def add_search_results_to_playlist(playlist_id, query, fields=SEARCH_FIELDS):
+    """Adds every song matching search_songs(query, fields), unlimited, in one statement."""
+    terms, fields = _search_terms(query, fields)
+    if not terms:
+        return 0
+
+    with transaction() as conn:
+        # Matches are appended in id order after the current last song.
+        numbered = "? + ROW_NUMBER() OVER (ORDER BY {0}) * ?"
+        if _has_song_fts(conn):
+            select = (f"SELECT ?, rowid, {numbered.format('rowid')} "
+                      "FROM songs_fts WHERE songs_fts MATCH ?")
+            params = (_fts_query(terms, fields),)
+        else:
+            where, params = _like_filter(terms, fields)
+            select = f"SELECT ?, id, {numbered.format('id')} FROM song_view WHERE {where}"
+        cur = conn.execute(
+            f"INSERT OR IGNORE INTO playlist_songs (playlist_id, song_id, position) {select}",
+            (playlist_id, _end_position(conn, playlist_id), POSITION_GAP, *params)
+        )
+        return cur.rowcount
 
 
 # ---------------------------------------------------------
-# SONG FUNCTIONS
+# FUZZY SEARCH
 # ---------------------------------------------------------
 
-def create_song(name, artist="", genre=""):
-    if name.strip() == "":
-        raise ValueError("Song name cannot be empty.")
+# Vocabulary words scored per query word, most shared trigrams first.
+FUZZY_CANDIDATES = 200
 
-    conn = get_connection()
-    cur = conn.cursor()
 
-    cur.execute(
-        "INSERT INTO songs (name, artist, genre) VALUES (?, ?, ?)",
-        (name.strip(), artist.strip(), genre.strip())
-    )
+def _words(text):
+    """Words of text folded like the FTS tokenizer folds them."""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    folded = "".join(c for c in decomposed if not unicodedata.combining(c)).lower()
+    return re.findall(r"[^\W_]+", folded)
 
-    conn.commit()
-    new_id = cur.lastrowid
-    conn.close()
-    return new_id
 
+def _trigrams(word):
+    padded = f" {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
 
-def get_all_songs():
+
+def _max_edits(word):
+    """Typos tolerated in a query word: more for longer words."""
+    return 1 if len(word) <= 5 else 2 if len(word) <= 10 else 3
+
+
+def _edit_distance(a, b, limit):
+    """Levenshtein distance of a and b, or limit + 1 once it must exceed limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char in enumerate(a, start=1):
+        current = [i]
+        for j, other in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char != other)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def update_fuzzy_index(batch_size=IMPORT_BATCH_SIZE):
+    """
+    Adds the words of songs written since the last call (queued by
+    triggers in search_terms_pending) to the fuzzy search vocabulary and
+    its trigram index, committing every batch_size songs so writers never
+    wait long for the lock. Returns the number of songs indexed.
+    run_maintenance() calls it after writes; searches do not.
+
+    Words of deleted or renamed songs stay in the vocabulary; fuzzy
+    matches are always confirmed against the songs themselves.
+    """
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name, artist, genre FROM songs ORDER BY name COLLATE NOCASE")
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    if conn.execute("SELECT 1 FROM search_terms_pending LIMIT 1").fetchone() is None:
+        return 0
 
+    indexed = 0
+    while True:
+        with transaction(immediate=True) as conn:
+            last = conn.execute(
+                """
+                SELECT MAX(song_id) FROM (
+                    SELECT song_id FROM search_terms_pending ORDER BY song_id LIMIT ?
+                )
+                """,
+                (batch_size,)
+            ).fetchone()[0]
+            if last is None:
+                return indexed
+            indexed += _index_fuzzy_terms(conn, last)
+
+
+def _index_fuzzy_terms(conn, last):
+    """Indexes the queued songs up to id last; returns how many there were."""
+    rows = conn.execute(
+        """
+        SELECT s.name, s.artist, s.genre
+        FROM search_terms_pending p
+        JOIN song_view s ON s.id = p.song_id
+        WHERE p.song_id <= ?
+        """,
+        (last,)
+    ).fetchall()
+    words = {word for row in rows for value in row for word in _words(value)}
+
+    if words:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS new_terms (term TEXT PRIMARY KEY) WITHOUT ROWID")
+        conn.execute("DELETE FROM temp.new_terms")
+        conn.executemany("INSERT OR IGNORE INTO temp.new_terms (term) VALUES (?)",
+                         [(word,) for word in words])
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM search_terms").fetchone()[0]
+        conn.execute(
+            """
+            INSERT INTO search_terms (term)
+            SELECT term FROM temp.new_terms
+            WHERE term NOT IN (SELECT term FROM search_terms)
+            """
+        )
+        added = conn.execute(
+            "SELECT id, term FROM search_terms WHERE id > ?", (last_id,)
+        ).fetchall()
+        conn.executemany(
+            "INSERT INTO search_trigrams (trigram, term_id) VALUES (?, ?)",
+            [(trigram, term_id) for term_id, term in added for trigram in _trigrams(term)]
+        )
+        conn.execute("DELETE FROM temp.new_terms")
+    conn.execute("DELETE FROM search_terms_pending WHERE song_id <= ?", (last,))
+    return len(rows)
+
+
+def _fuzzy_variants(conn, word):
+    """
+    {term: edit distance} for vocabulary words within _max_edits(word) of
+    word. Only the words sharing the most trigrams with it are checked.
+    """
+    trigrams = sorted(_trigrams(word))
+    limit = _max_edits(word)
+    # Each edit changes at most three trigrams.
+    rows = conn.execute(
+        f"""
+        SELECT t.term
+        FROM (
+            SELECT term_id, COUNT(*) AS shared
+            FROM search_trigrams
+            WHERE trigram IN ({", ".join("?" * len(trigrams))})
+            GROUP BY term_id
+            HAVING shared >= ?
+            ORDER BY shared DESC
+            LIMIT ?
+        ) m
+        JOIN search_terms t ON t.id = m.term_id
+        """,
+        (*trigrams, max(1, len(trigrams) - 3 * limit), FUZZY_CANDIDATES)
+    ).fetchall()
+
+    variants = {}
+    for (term,) in rows:
+        distance = _edit_distance(word, term, limit)
+        if distance <= limit:
+            variants[term] = distance
+    return variants
+
+
+def _fuzzy_match(variants, distance, fields):
+    """FTS5 expression: every query word as one of its variants within distance."""
+    groups = []
+    for word_variants in variants:
+        terms = ['"' + t.replace('"', '""') + '"' for t, d in word_variants.items() if d <= distance]
+        if not terms:
+            return None
+        groups.append("(" + " OR ".join(terms) + ")")
+    return "{" + " ".join(fields) + "} : (" + " AND ".join(groups) + ")"
 
-def update_song(song_id, name, artist="", genre=""):
-    if name.strip() == "":
-        raise ValueError("Song name cannot be empty.")
+
+def _fuzzy_like(variants, distance, fields):
+    """WHERE clause (and params) like _fuzzy_match() for the LIKE fallback."""
+    clauses, params = [], []
+    for word_variants in variants:
+        terms = [t for t, d in word_variants.items() if d <= distance]
+        if not terms:
+            return None, None
+        clauses.append("(" + " OR ".join(
+            f"{f} LIKE '%' || ? || '%'" for _ in terms for f in fields
+        ) + ")")
+        params.extend(term for term in terms for _ in fields)
+    return " AND ".join(clauses), params
+
+
+def _fuzzy_edits(song, variants, fields):
+    """Total edits between the query words and their closest spellings in song."""
+    song_words = set(_words(" ".join(song[f] for f in fields)))
+    return sum(min((d for t, d in word_variants.items() if t in song_words), default=0)
+               for word_variants in variants)
+
+
+def search_songs_fuzzy(query, fields=SEARCH_FIELDS, limit=SEARCH_LIMIT):
+    """
+    Typo-tolerant search: every word in query must match a word in one of
+    the given fields within a few edits ("beetles" finds The Beatles).
+    Spellings to try come from the trigram index over the vocabulary, so
+    their cost does not grow with the number of songs.
+
+    Results are ordered by total edit distance, then by name. They are
+    fetched one distance at a time, exact matches first, and the search
+    stops once limit songs have been found.
+
+    The index is used as it stands: words of songs written since the last
+    update_fuzzy_index() (see run_maintenance) are not found yet.
+    """
+    _, fields = _search_terms(query, fields)
+    words = _words(query)
+    if not words:
+        return []
 
     conn = get_connection()
-    cur = conn.cursor()
+    variants = [_fuzzy_variants(conn, word) for word in words]
+    if not all(variants):
+        return []
 
-    cur.execute(
-        "UPDATE songs SET name = ?, artist = ?, genre = ? WHERE id = ?",
-        (name.strip(), artist.strip(), genre.strip(), song_id)
-    )
+    use_fts = _has_song_fts(conn)
+    results = []
+    seen = set()
+    for distance in range(max(_max_edits(word) for word in words) + 1):
+        remaining = -1 if limit is None else limit - len(results)
+        if remaining == 0:
+            break
+        if use_fts:
+            match = _fuzzy_match(variants, distance, fields)
+            if match is None:
+                continue
+            # Songs found at a smaller distance are excluded by NOT.
+            closer = _fuzzy_match(variants, distance - 1, fields) if distance else None
+            rows = conn.execute(
+                """
+                SELECT s.id, s.name, s.artist, s.genre, s.library_id
+                FROM songs_fts
+                JOIN song_view s ON s.id = songs_fts.rowid
+                WHERE songs_fts MATCH ?
+                ORDER BY songs_fts.rowid
+                LIMIT ?
+                """,
+                (match if closer is None else f"({match}) NOT ({closer})", remaining)
+            ).fetchall()
+        else:
+            where, params = _fuzzy_like(variants, distance, fields)
+            if where is None:
+                continue
+            rows = conn.execute(
+                f"SELECT id, name, artist, genre, library_id FROM song_view WHERE {where} ORDER BY id",
+                params
+            ).fetchall()
+            rows = [row for row in rows if row["id"] not in seen][:None if limit is None else remaining]
 
-    conn.commit()
-    conn.close()
+        tier = sorted((dict(row) for row in rows),
+                      key=lambda song: (_fuzzy_edits(song, variants, fields),
+                                        sort_key(song["name"]), song["id"]))
+        seen.update(song["id"] for song in tier)
+        results.extend(tier)
+    return results
 
 
-def delete_song(song_id):
+# ---------------------------------------------------------
+# LIBRARY SCAN FUNCTIONS
+# ---------------------------------------------------------
+
+def _path_range(root):
+    """Bounds for an index range scan over every path below root."""
+    prefix = str(root).rstrip(os.sep) + os.sep
+    return prefix, prefix + "\U0010ffff"
+
+
+def get_file_index(root):
+    """Returns {path: (mtime, size)} for every scanned song below root."""
+    low, high = _path_range(root)
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM songs WHERE id = ?", (song_id,))
-    conn.commit()
-    conn.close()
+    rows = conn.execute(
+        "SELECT path, mtime, size FROM songs WHERE path >= ? AND path < ?",
+        (low, high)
+    )
+    return {row["path"]: (row["mtime"], row["size"]) for row in rows}
+
+
+def upsert_scanned_songs(rows):
+    """
+    Inserts or refreshes songs keyed by file path in one transaction.
+    rows: iterable of dicts with path, name, artist, genre, mtime, size, duration.
+    """
+    with transaction() as conn:
+        artists, genres = {}, {}
+        rows = [
+            {**row,
+             "artist_id": _facet_id(conn, "artists", row["artist"], artists),
+             "genre_id": _facet_id(conn, "genres", row["genre"], genres)}
+            for row in rows
+        ]
+        conn.executemany(
+            f"""
+            INSERT INTO songs (path, name, sort_name, artist_id, genre_id, mtime, size, duration,
+                               added_at)
+            VALUES (:path, :name, sort_key(:name), :artist_id, :genre_id, :mtime, :size, :duration,
+                    {_NOW})
+            ON CONFLICT (path) WHERE path IS NOT NULL DO UPDATE SET
+                name = excluded.name,
+                sort_name = excluded.sort_name,
+                artist_id = excluded.artist_id,
+                genre_id = excluded.genre_id,
+                mtime = excluded.mtime,
+                size = excluded.size,
+                duration = excluded.duration
+            """,
+            rows
+        )
+    _songs_changed()
+
+
+def delete_songs_by_paths(paths):
+    with transaction() as conn:
+        conn.executemany("DELETE FROM songs WHERE path = ?", ((p,) for p in paths))
+    _songs_changed()
 
 
 # ---------------------------------------------------------
-# PLAYLIST FUNCTIONS
+# EXPORT / IMPORT
 # ---------------------------------------------------------
 
-def create_playlist(name):
+# Rows fetched, or looked up, per round trip when streaming songs in or out.
+TRANSFER_BATCH_SIZE = 1000
+
+# Fields of exported songs, and of the records the import functions take.
+TRANSFER_FIELDS = ("name", "artist", "genre", "path", "duration")
+
+
+def _stream(cursor, batch_size):
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        for row in rows:
+            yield dict(row)
+
+
+def iter_playlist_songs(playlist_id, batch_size=TRANSFER_BATCH_SIZE):
+    """
+    Yields a playlist's songs in running order as dicts of TRANSFER_FIELDS.
+    Rows are fetched batch_size at a time from one cursor, so memory use
+    does not depend on the playlist's length.
+    """
+    cursor = get_connection().execute(
+        """
+        SELECT s.name, s.artist, s.genre, s.path, s.duration
+        FROM playlist_songs ps
+        JOIN song_view s ON s.id = ps.song_id
+        WHERE ps.playlist_id = ?
+        ORDER BY ps.position, ps.song_id
+        """,
+        (playlist_id,)
+    )
+    yield from _stream(cursor, batch_size)
+
+
+def iter_songs(batch_size=TRANSFER_BATCH_SIZE):
+    """Yields every song, in id order, like iter_playlist_songs()."""
+    cursor = get_connection().execute(
+        "SELECT name, artist, genre, path, duration FROM song_view ORDER BY id"
+    )
+    yield from _stream(cursor, batch_size)
+
+
+def _lookup_rows(records):
+    """Numbers records (dicts with TRANSFER_FIELDS, all optional) as song_lookup rows."""
+    for seq, record in enumerate(records, start=1):
+        try:
+            duration = float(record.get("duration") or 0) or None
+        except (TypeError, ValueError):
+            duration = None
+        yield (seq, _clean(record.get("name")), _clean(record.get("artist")),
+               _clean(record.get("genre")), _clean(record.get("path")) or None, duration)
+
+
+def _fill_song_lookup(conn, batch):
+    """
+    Loads a batch of _lookup_rows() into temp.song_lookup and resolves each
+    to an existing song: by file path first, else by name (ignoring case)
+    and artist. Unmatched rows keep song_id NULL. One join per batch
+    instead of a query per record; the name lookup seeks idx_songs_sort
+    (names equal but for case have equal sort keys), since one artist can
+    have thousands of songs.
+    """
+    conn.execute(
+        """
+        CREATE TEMP TABLE IF NOT EXISTS song_lookup (
+            seq INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            artist TEXT NOT NULL,
+            genre TEXT NOT NULL,
+            path TEXT,
+            duration REAL,
+            song_id INTEGER
+        )
+        """
+    )
+    conn.execute("DELETE FROM temp.song_lookup")
+    conn.executemany(
+        """
+        INSERT INTO temp.song_lookup (seq, name, artist, genre, path, duration)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        batch
+    )
+    conn.execute(
+        """
+        UPDATE temp.song_lookup SET song_id = COALESCE(
+            (SELECT id FROM songs WHERE path = song_lookup.path),
+            (SELECT MIN(s.id) FROM songs s
+             WHERE s.sort_name = sort_key(song_lookup.name)
+               AND s.name = song_lookup.name COLLATE NOCASE
+               AND +s.artist_id IS (SELECT id FROM artists WHERE name = song_lookup.artist))
+        )
+        """
+    )
+
+
+def import_playlist(name, records, batch_size=TRANSFER_BATCH_SIZE, on_missing=None):
+    """
+    Appends songs to the playlist called name (created if needed) in the
+    order given. records is any iterable of dicts with TRANSFER_FIELDS; it
+    is consumed lazily and resolved batch_size at a time.
+
+    Records that match no song in the library are skipped and reported as
+    on_missing(record). Returns (playlist_id, added, missing).
+    """
     if name.strip() == "":
         raise ValueError("Playlist name cannot be empty.")
 
-    conn = get_connection()
-    cur = conn.cursor()
+    added = missing = 0
+    rows = _lookup_rows(records)
+    with transaction(immediate=True) as conn:
+        row = conn.execute("SELECT id FROM playlists WHERE name = ?", (name.strip(),)).fetchone()
+        if row is not None:
+            playlist_id = row[0]
+        else:
+            playlist_id = conn.execute(
+                "INSERT INTO playlists (name, sort_name) VALUES (?1, sort_key(?1))", (name.strip(),)
+            ).lastrowid
+        base = _end_position(conn, playlist_id)
 
-    cur.execute("INSERT INTO playlists (name) VALUES (?)", (name.strip(),))
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            _fill_song_lookup(conn, batch)
+            added += conn.execute(
+                """
+                INSERT OR IGNORE INTO playlist_songs (playlist_id, song_id, position)
+                SELECT ?, song_id, ? + seq * ?
+                FROM temp.song_lookup
+                WHERE song_id IS NOT NULL
+                ORDER BY seq
+                """,
+                (playlist_id, base, POSITION_GAP)
+            ).rowcount
+            for row in conn.execute(
+                "SELECT name, artist, path FROM temp.song_lookup WHERE song_id IS NULL"
+            ).fetchall():
+                missing += 1
+                if on_missing is not None:
+                    on_missing(dict(row))
 
-    conn.commit()
-    new_id = cur.lastrowid
-    conn.close()
-    return new_id
+    return playlist_id, added, missing
 
 
-def delete_playlist(playlist_id):
+def import_library(records, batch_size=TRANSFER_BATCH_SIZE, progress=None):
+    """
+    Adds the songs in records (dicts with TRANSFER_FIELDS) that are not in
+    the library yet, matched as in import_playlist(). Records without a
+    name are skipped. progress(done) is called after every batch.
+    Returns (added, matched).
+    """
+    added = matched = done = 0
+    rows = _lookup_rows(records)
+    with transaction(immediate=True) as conn:
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            _fill_song_lookup(conn, batch)
+            matched += conn.execute(
+                "SELECT COUNT(*) FROM temp.song_lookup WHERE song_id IS NOT NULL"
+            ).fetchone()[0]
+
+            for table, column in (("artists", "artist"), ("genres", "genre")):
+                conn.execute(
+                    f"""
+                    INSERT OR IGNORE INTO {table} (name, sort_name)
+                    SELECT DISTINCT {column}, sort_key({column}) FROM temp.song_lookup
+                    WHERE song_id IS NULL AND {column} <> ''
+                    """
+                )
+            added += conn.execute(
+                f"""
+                INSERT OR IGNORE INTO songs (name, sort_name, artist_id, genre_id, path, duration,
+                                             added_at)
+                SELECT l.name, sort_key(l.name),
+                       (SELECT id FROM artists WHERE name = l.artist),
+                       (SELECT id FROM genres WHERE name = l.genre),
+                       l.path, l.duration, {_NOW}
+                FROM temp.song_lookup l
+                WHERE l.song_id IS NULL AND l.name <> ''
+                ORDER BY l.seq
+                """
+            ).rowcount
+
+            done += len(batch)
+            if progress is not None:
+                progress(done)
+
+    _songs_changed()
+    return added, matched
+
+
+# ---------------------------------------------------------
+# DUPLICATES
+# ---------------------------------------------------------
+
+def iter_song_blocks(keys_for, batch_size=TRANSFER_BATCH_SIZE):
+    """
+    Groups songs for duplicate detection. keys_for(song) returns the
+    blocking keys of a song dict (id, name, artist, genre, path,
+    duration); songs sharing a key form a block. Yields each block of two
+    or more songs as a list of song dicts in id order. Songs linked in
+    from other libraries are left out: they are duplicates of their source
+    by design, and refresh_links() would undo a merge.
+
+    The keys go into a temp table and are grouped through an index on it,
+    so the cost is one sort, and memory holds one block at a time.
+    """
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM playlists WHERE id = ?", (playlist_id,))
-    conn.commit()
-    conn.close()
+    conn.execute("DROP TABLE IF EXISTS temp.song_blocks")
+    conn.execute("CREATE TEMP TABLE song_blocks (key TEXT NOT NULL, song_id INTEGER NOT NULL)")
+    try:
+        cursor = conn.execute(
+            "SELECT id, name, artist, genre, path, duration FROM song_view WHERE library_id IS NULL"
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            conn.executemany(
+                "INSERT INTO temp.song_blocks (key, song_id) VALUES (?, ?)",
+                [(key, row["id"]) for row in rows for key in set(keys_for(dict(row)))]
+            )
+        conn.execute("CREATE INDEX temp.idx_song_blocks ON song_blocks (key, song_id)")
 
+        cursor = conn.execute(
+            """
+            SELECT b.key, s.id, s.name, s.artist, s.genre, s.path, s.duration
+            FROM temp.song_blocks b
+            JOIN song_view s ON s.id = b.song_id
+            WHERE b.key IN (SELECT key FROM temp.song_blocks GROUP BY key HAVING COUNT(*) > 1)
+            ORDER BY b.key, b.song_id
+            """
+        )
+        block, block_key = [], None
+        for row in _stream(cursor, batch_size):
+            key = row.pop("key")
+            if key != block_key and block:
+                yield block
+                block = []
+            block_key = key
+            block.append(row)
+        if block:
+            yield block
+    finally:
+        conn.execute("DROP TABLE IF EXISTS temp.song_blocks")
+
+
+def merge_songs(merges):
+    """
+    Merges duplicate songs. merges maps each duplicate's id to the id of
+    the song that replaces it, which must not be a duplicate itself.
+
+    In one transaction, every playlist entry of a duplicate is re-pointed
+    to its replacement, keeping its position (unless the playlist already
+    holds the replacement), and the duplicates are deleted. Their other
+    fields are not copied over. Returns the number of songs removed.
+    """
+    if not merges:
+        return 0
+
+    with transaction(immediate=True) as conn:
+        conn.execute(
+            """
+            CREATE TEMP TABLE IF NOT EXISTS song_merges (
+                duplicate_id INTEGER PRIMARY KEY,
+                survivor_id INTEGER NOT NULL
+            )
+            """
+        )
+        conn.execute("DELETE FROM temp.song_merges")
+        conn.executemany(
+            "INSERT INTO temp.song_merges (duplicate_id, survivor_id) VALUES (?, ?)",
+            merges.items()
+        )
+        if conn.execute(
+            """
+            SELECT 1 FROM temp.song_merges
+            WHERE survivor_id IN (SELECT duplicate_id FROM temp.song_merges)
+               OR survivor_id NOT IN (SELECT id FROM songs)
+            """
+        ).fetchone():
+            raise ValueError("Songs must be merged into existing songs that are not merged themselves.")
+
+        # One pass over playlist_songs. Rows that would repeat a song in its
+        # playlist are left alone and go with the duplicate (ON DELETE CASCADE).
+        conn.execute(
+            """
+            UPDATE OR IGNORE playlist_songs
+            SET song_id = (SELECT survivor_id FROM temp.song_merges WHERE duplicate_id = song_id)
+            WHERE song_id IN (SELECT duplicate_id FROM temp.song_merges)
+            """
+        )
+        removed = conn.execute(
+            "DELETE FROM songs WHERE id IN (SELECT duplicate_id FROM temp.song_merges)"
+        ).rowcount
+        conn.execute("DELETE FROM temp.song_merges")
+    _songs_changed()
+    return removed
+
+
+# ---------------------------------------------------------
+# LIBRARIES
+# ---------------------------------------------------------
+
+def add_library(name, path):
+    """
+    Registers another library file under name and returns its id. The
+    file must exist; it is brought up to date by Libraries.py on first
+    use.
+    """
+    if name.strip() == "":
+        raise ValueError("Library name cannot be empty.")
+    path = Path(path).resolve()
+    if not path.is_file():
+        raise ValueError(f"No library file at {path}.")
+    if path == Path(DB_PATH).resolve():
+        raise ValueError("This library is always included.")
+
+    with transaction() as conn:
+        return conn.execute(
+            "INSERT INTO libraries (name, path) VALUES (?, ?)", (name.strip(), str(path))
+        ).lastrowid
+
+
+def remove_library(library_id):
+    """Unregisters a library. Songs linked in from it stay, as ordinary songs."""
+    with transaction() as conn:
+        conn.execute("DELETE FROM libraries WHERE id = ?", (library_id,))
+
+
+def get_libraries():
+    """Returns [{'id', 'name', 'path'}] for the registered libraries, by name."""
+    rows = get_connection().execute(
+        "SELECT id, name, path FROM libraries ORDER BY name COLLATE NOCASE"
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_own_songs_page(after=None, limit=PAGE_SIZE, query=None, fields=SEARCH_FIELDS):
+    """
+    One page of the songs stored in this library, leaving out the ones
+    linked in from other libraries, as dicts with id, name, artist, genre
+    and sort_name, in (sort_name, id) order so pages of several libraries
+    can be merged. after is the (sort_name, id) of the last row shown;
+    limit None returns every song after it.
+    query restricts the page to songs matching it as in search_songs().
+    """
+    where, params = ["s.library_id IS NULL"], []
+    if after is not None:
+        where.append("s.sort_name >= ? AND (s.sort_name > ? OR s.id > ?)")
+        params += [after[0], after[0], after[1]]
 
-def add_song_to_playlist(playlist_id, song_id):
     conn = get_connection()
-    cur = conn.cursor()
+    source = "song_view s"
+    if query is not None:
+        terms, fields = _search_terms(query, fields)
+        if not terms:
+            return []
+        if _has_song_fts(conn):
+            # Matches first, then sorted: searches rarely match many songs.
+            source = "songs_fts JOIN song_view s ON s.id = songs_fts.rowid"
+            where.append("songs_fts MATCH ?")
+            params.append(_fts_query(terms, fields))
+        else:
+            like, like_params = _like_filter(terms, fields)
+            where.append(like)
+            params += like_params
 
-    cur.execute(
-        "INSERT OR IGNORE INTO playlist_songs (playlist_id, song_id) VALUES (?, ?)",
-        (playlist_id, song_id)
-    )
+    rows = conn.execute(
+        f"""
+        SELECT s.id, s.name, s.artist, s.genre, s.sort_name
+        FROM {source}
+        WHERE {" AND ".join(where)}
+        ORDER BY s.sort_name, s.id
+        LIMIT ?
+        """,
+        (*params, -1 if limit is None else limit)
+    ).fetchall()
+    return [dict(row) for row in rows]
 
-    conn.commit()
-    conn.close()
 
+def count_own_songs():
+    """Number of songs stored in this library, leaving out the ones linked in from others."""
+    conn = get_connection()
+    total = conn.execute("SELECT COUNT(*) FROM songs").fetchone()[0]
+    # Counted from the partial idx_songs_library.
+    linked = conn.execute("SELECT COUNT(*) FROM songs WHERE library_id IS NOT NULL").fetchone()[0]
+    return total - linked
 
-def remove_song_from_playlist(playlist_id, song_id):
+
+def get_songs_by_ids(song_ids, batch_size=PLAYLIST_LOOKUP_BATCH_SIZE):
+    """The existing songs among song_ids, as dicts with id and TRANSFER_FIELDS, in id order."""
     conn = get_connection()
-    cur = conn.cursor()
+    songs = []
+    song_ids = iter(song_ids)
+    while True:
+        batch = list(islice(song_ids, batch_size))
+        if not batch:
+            return sorted(songs, key=itemgetter("id"))
+        rows = conn.execute(
+            f"""
+            SELECT id, name, artist, genre, path, duration FROM song_view
+            WHERE id IN ({", ".join("?" * len(batch))})
+            """,
+            batch
+        )
+        songs += (dict(row) for row in rows)
+
 
-    cur.execute(
-        "DELETE FROM playlist_songs WHERE playlist_id = ? AND song_id = ?",
-        (playlist_id, song_id)
+def get_linked_song_ids(library_id):
+    """{id in that library: local id} for every song linked in from library_id."""
+    rows = get_connection().execute(
+        "SELECT library_song_id, id FROM songs WHERE library_id = ?", (library_id,)
     )
+    return dict(rows.fetchall())
+
+
+def link_library_songs(library_id, songs):
+    """
+    Makes songs of another library (dicts with id and TRANSFER_FIELDS, as
+    get_songs_by_ids() returns them there) usable in this one, and returns
+    their local ids in the same order. A song already linked gets its
+    fields updated; one whose file is already in this library is used as
+    is; any other is added as a linked song.
+    """
+    ids = []
+    known = {"artists": {}, "genres": {}}
+    with transaction(immediate=True) as conn:
+        for song in songs:
+            row = conn.execute(
+                "SELECT id FROM songs WHERE library_id = ? AND library_song_id = ?",
+                (library_id, song["id"])
+            ).fetchone()
+            if row is None and song["path"]:
+                row = conn.execute("SELECT id FROM songs WHERE path = ?", (song["path"],)).fetchone()
+                if row is not None:
+                    ids.append(row[0])
+                    continue
 
-    conn.commit()
-    conn.close()
+            values = {
+                "name": song["name"],
+                "artist_id": _facet_id(conn, "artists", song["artist"], known["artists"]),
+                "genre_id": _facet_id(conn, "genres", song["genre"], known["genres"]),
+                "path": song["path"],
+                "duration": song["duration"],
+            }
+            if row is not None:
+                conn.execute(
+                    """
+                    UPDATE OR IGNORE songs SET name = :name, sort_name = sort_key(:name),
+                        artist_id = :artist_id, genre_id = :genre_id,
+                        path = :path, duration = :duration
+                    WHERE id = :id
+                    """,
+                    {**values, "id": row[0]}
+                )
+                ids.append(row[0])
+                continue
+            ids.append(conn.execute(
+                f"""
+                INSERT INTO songs (name, sort_name, artist_id, genre_id, path, duration, added_at,
+                                   library_id, library_song_id)
+                VALUES (:name, sort_key(:name), :artist_id, :genre_id, :path, :duration, {_NOW},
+                        :library_id, :library_song_id)
+                """,
+                {**values, "library_id": library_id, "library_song_id": song["id"]}
+            ).lastrowid)
+
+    _songs_changed()
+    return ids
 
 
 # ---------------------------------------------------------
-# SEARCH FUNCTIONS
+# CHANGE FEED
 # ---------------------------------------------------------
 
-def search_songs_by_name(name_query):
-    q = name_query.strip()
+# Change-log entries get_changes() replays at most; a reader further
+# behind is told to reload.
+CHANGE_FEED_LIMIT = 5_000
+
+# compact_change_log() keeps the newest CHANGE_LOG_KEEP entries, and only
+# runs once there are CHANGE_LOG_SLACK more, so most calls delete nothing.
+CHANGE_LOG_KEEP = 10_000
+CHANGE_LOG_SLACK = 1_000
+
+
+# Schema version that added change_log_mark.
+_CHANGE_LOG_MARK_VERSION = 18
+
+
+# Change-log entries committed by threads that called record_own_changes(),
+# as one (first seq, last seq) range per transaction.
+_own_changes = []
+_own_changes_lock = threading.Lock()
+
+
+def _seal_change_log(conn):
+    """
+    Moves change_log_mark past the entries the open transaction wrote,
+    just before it commits (see transaction()). The playlist_songs
+    triggers then start the next transaction's entries afresh. Returns
+    the (first, last) seqs written, or None.
+    """
+    if conn.execute("PRAGMA user_version").fetchone()[0] < _CHANGE_LOG_MARK_VERSION:
+        return None
+    mark, last = conn.execute(
+        "SELECT (SELECT seq FROM change_log_mark), (SELECT COALESCE(MAX(seq), 0) FROM change_log)"
+    ).fetchone()
+    if last <= mark:
+        return None
+    conn.execute("UPDATE change_log_mark SET seq = ?", (last,))
+    return mark + 1, last
+
+
+def record_own_changes():
+    """
+    Has the transactions the calling thread commits note the change-log
+    entries they wrote, which get_changes(skip_own=True) then leaves out.
+    Meant for the app's DbWorker threads: the app redraws what its own
+    writes touched as each finishes (see Worker.py).
+    """
+    _local.own_changes = True
+
+
+def _own_changes_after(after_seq):
+    """The _own_changes ranges past after_seq. Earlier ones are dropped: the reader is past them."""
+    with _own_changes_lock:
+        _own_changes[:] = [seqs for seqs in _own_changes if seqs[1] > after_seq]
+        return list(_own_changes)
 
-    conn = get_connection()
-    cur = conn.cursor()
 
-    cur.execute(
+def _log_renumber(conn, playlist_id, last_seq):
+    """
+    Logs a renumbering as 'playlist_order' rather than a change of songs:
+    drops the playlist_songs entry the renumber itself wrote after
+    last_seq (an earlier entry of the same transaction stays), then adds
+    one 'playlist_order' entry, so readers only re-read cached positions.
+    """
+    conn.execute(
+        "DELETE FROM change_log WHERE kind = 'playlist_songs' AND row_id = ? AND seq > ?",
+        (playlist_id, last_seq)
+    )
+    conn.execute(
         """
-        SELECT id, name, artist, genre
-        FROM songs
-        WHERE name LIKE '%' || ? || '%'
-        ORDER BY name COLLATE NOCASE
+        INSERT INTO change_log (kind, row_id) SELECT 'playlist_order', ?
+        WHERE NOT EXISTS (
+            SELECT 1 FROM change_log
+            WHERE kind = 'playlist_order' AND row_id = ?
+              AND seq > (SELECT seq FROM change_log_mark)
+        )
         """,
-        (q,)
+        (playlist_id, playlist_id)
     )
 
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
 
+def get_change_seq():
+    """Sequence number of the newest change-log entry, 0 if there is none."""
+    return get_connection().execute("SELECT MAX(seq) FROM change_log").fetchone()[0] or 0
 
-def search_songs_by_genre(genre_query):
-    q = genre_query.strip()
 
+def compact_change_log(keep=CHANGE_LOG_KEEP, slack=CHANGE_LOG_SLACK):
+    """
+    Trims the change log to its newest keep entries once it holds more
+    than keep + slack. Readers further behind are told to reload by
+    get_changes(). Done here rather than by a trigger, which would cost
+    every logged write. Returns the number of entries deleted.
+    """
     conn = get_connection()
-    cur = conn.cursor()
+    first, last = conn.execute(
+        "SELECT (SELECT MIN(seq) FROM change_log), (SELECT MAX(seq) FROM change_log)"
+    ).fetchone()
+    if first is None or last - first < keep + slack:
+        return 0
+    with transaction(immediate=True) as conn:
+        return conn.execute(
+            "DELETE FROM change_log WHERE seq <= (SELECT MAX(seq) FROM change_log) - ?", (keep,)
+        ).rowcount
 
-    cur.execute(
-        """
-        SELECT id, name, artist, genre
-        FROM songs
-        WHERE genre LIKE '%' || ? || '%'
-        ORDER BY name COLLATE NOCASE
-        """,
-        (q,)
-    )
 
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
\ No newline at end of file
+def get_changes(after_seq, limit=CHANGE_FEED_LIMIT, batch_size=PLAYLIST_LOOKUP_BATCH_SIZE,
+                skip_own=False):
+    """
+    What was written after change-log entry after_seq, by any connection
+    or process. Returns (seq, changes): seq is the newest entry read, to
+    pass next time, and changes a dict with
+        songs: {song id: the song as get_song() returns it, None if deleted}
+        playlists: ids of the playlists added, changed or deleted
+        playlist_songs: ids of the playlists whose songs changed
+        playlist_order: ids of the playlists renumbered; their songs and
+            order are the same, only the position values changed
+    changes is None when the log was trimmed past after_seq or holds more
+    than limit entries after it; reloading is then the cheaper way to
+    catch up. Work is proportional to the entries read.
+
+    skip_own leaves out the entries written by this process's threads
+    that called record_own_changes().
+    """
+    own = _own_changes_after(after_seq) if skip_own else []
+    changes = {"songs": {}, "playlists": set(), "playlist_songs": set(), "playlist_order": set()}
+    with transaction() as conn:
+        first = conn.execute("SELECT MIN(seq) FROM change_log").fetchone()[0]
+        rows = conn.execute(
+            "SELECT seq, kind, row_id FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?",
+            (after_seq, limit + 1)
+        ).fetchall()
+        if not rows:
+            return after_seq, changes
+        if len(rows) > limit or first > after_seq + 1:
+            return get_change_seq(), None
+
+        for seq, kind, row_id in rows:
+            if any(first <= seq <= last for first, last in own):
+                continue
+            if kind == "song":
+                changes["songs"][row_id] = None
+            elif kind == "playlist":
+                changes["playlists"].add(row_id)
+            else:
+                changes[kind].add(row_id)
+
+        song_ids = iter(list(changes["songs"]))
+        while True:
+            batch = list(islice(song_ids, batch_size))
+            if not batch:
+                break
+            for row in conn.execute(
+                f"""
+                SELECT id, name, artist, genre, library_id FROM song_view
+                WHERE id IN ({", ".join("?" * len(batch))})
+                """,
+                batch
+            ):
+                changes["songs"][row["id"]] = dict(row)
+    return rows[-1][0], changes
+
+
+# ---------------------------------------------------------
+# MAINTENANCE
+# ---------------------------------------------------------
+
+def run_maintenance():
+    """
+    Does the work writes leave queued for later: bringing smart playlists
+    up to date, indexing new words for fuzzy search, recomputing the
+    neighbours of songs whose playlists changed, renumbering crowded
+    playlists and trimming the change log. Every step commits in short batches and is cheap when
+    nothing is queued, so this suits a background thread polling after
+    commits (see Maintenance.py); reads never do it themselves.
+    Returns the number of queued items processed.
+    """
+    return (refresh_smart_playlists() + update_fuzzy_index() + refresh_song_neighbors()
+            + renumber_pending_playlists() + compact_change_log())
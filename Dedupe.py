@@ -0,0 +1,197 @@
+"""
+Duplicate song detection and merging.
+
+Usage:
+    python Dedupe.py                    # list likely duplicates
+    python Dedupe.py --threshold 0.95   # stricter matching
+    python Dedupe.py --merge            # merge every group found
+
+Names and artists are normalized before comparing: case, accents,
+punctuation, "feat." credits and a leading "The" are ignored. Each song
+gets a few blocking keys built from its normalized artist and name, and
+only songs sharing a key are scored against each other, so the work
+grows with the library size rather than with its square.
+
+Within a group, the song with the most information (a file, a duration,
+a genre) is kept, and the others are merged into it with
+Database.merge_songs. Songs linked in from other libraries (see
+Libraries.py) are never grouped.
+"""
+
+import argparse
+import re
+import sys
+import unicodedata
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+from Database import init_db, iter_song_blocks, merge_songs
+
+# Default minimum similarity (0-1) for two songs to count as duplicates.
+SIMILARITY_THRESHOLD = 0.93
+
+# Characters of the normalized name used in the prefix and suffix keys.
+KEY_LENGTH = 6
+
+# Blocks larger than this are not scored pair by pair: their songs are
+# sorted by normalized name and each is compared with the next
+# WINDOW_SIZE only, which keeps the work per song bounded.
+MAX_BLOCK_SIZE = 50
+WINDOW_SIZE = 10
+
+# A featured-artist credit and everything after it.
+_FEAT = re.compile(r"(?<=\S)\s*[(\[]?\s*\b(?:feat|ft|featuring)\b\.?\s.*$", re.IGNORECASE)
+_NON_WORD = re.compile(r"[\W_]+")
+_NUMBER = re.compile(r"\d+")
+
+
+@lru_cache(maxsize=100_000)
+def normalize(text):
+    """Comparable form of a name or artist, e.g. "Beyoncé (feat. X)" -> "beyonce"."""
+    original = text or ""
+    text = _FEAT.sub("", original)
+    if not text.isascii():
+        text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+    text = _NON_WORD.sub(" ", text.casefold().replace("&", " and ")).strip()
+    if text.startswith("the "):
+        text = text[4:]
+    # Names made only of punctuation are compared as written.
+    return text or original.casefold().strip()
+
+
+def blocking_keys(name, artist):
+    """
+    Keys of a song with this normalized name and artist. The prefix and
+    suffix keys catch differences at either end of the name; the last one
+    catches differently written artists.
+    """
+    squashed = name.replace(" ", "")
+    return (
+        f"<{artist}\0{squashed[:KEY_LENGTH]}",
+        f">{artist}\0{squashed[-KEY_LENGTH:]}",
+        f"={name}\0{artist[:3]}",
+    )
+
+
+def _song_keys(song):
+    return blocking_keys(normalize(song["name"]), normalize(song["artist"]))
+
+
+def similarity(a, b, at_least=0.0):
+    """
+    Score from 0 to 1 for two (normalized name, normalized artist) pairs.
+    Returns 0 early once the score is known to be below at_least.
+    """
+    if a == b:
+        return 1.0
+    # "Part 1" and "Part 2" are different songs, however similar.
+    if _NUMBER.findall(a[0]) != _NUMBER.findall(b[0]):
+        return 0.0
+    artist = 1.0 if a[1] == b[1] else SequenceMatcher(None, a[1], b[1]).ratio()
+
+    # The name is weighted twice; check the cheap upper bounds first.
+    needed = (3 * at_least - artist) / 2
+    shorter, longer = sorted((len(a[0]), len(b[0])))
+    if 2 * shorter / (shorter + longer or 1) < needed:
+        return 0.0
+    matcher = SequenceMatcher(None, a[0], b[0])
+    if matcher.quick_ratio() < needed:
+        return 0.0
+    return (2 * matcher.ratio() + artist) / 3
+
+
+def _score_block(block, threshold):
+    """Yields the (id, id) pairs in a block that look like duplicates."""
+    keys = [(normalize(song["name"]), normalize(song["artist"])) for song in block]
+    order = range(len(block))
+    window = len(block)
+    if len(block) > MAX_BLOCK_SIZE:
+        order = sorted(order, key=keys.__getitem__)
+        window = WINDOW_SIZE
+
+    for n, i in enumerate(order):
+        for j in order[n + 1:n + 1 + window]:
+            if similarity(keys[i], keys[j], threshold) >= threshold:
+                yield block[i]["id"], block[j]["id"]
+
+
+def _survivor_rank(song):
+    return (song["path"] is not None, bool(song["duration"]), song["genre"] != "",
+            song["artist"] != "", -song["id"])
+
+
+def find_duplicates(threshold=SIMILARITY_THRESHOLD):
+    """
+    Returns groups of likely duplicate songs, each a list of song dicts
+    with the one to keep first. Pairs found in different blocks are
+    joined, so a group can span several blocks.
+    """
+    parent = {}
+    songs = {}
+
+    def root(song_id):
+        while parent[song_id] != song_id:
+            parent[song_id] = parent[parent[song_id]]
+            song_id = parent[song_id]
+        return song_id
+
+    for block in iter_song_blocks(_song_keys):
+        by_id = {song["id"]: song for song in block}
+        for a, b in _score_block(block, threshold):
+            for song_id in (a, b):
+                if song_id not in parent:
+                    parent[song_id] = song_id
+                    songs[song_id] = by_id[song_id]
+            parent[root(b)] = root(a)
+
+    groups = {}
+    for song_id in parent:
+        groups.setdefault(root(song_id), []).append(songs[song_id])
+    return [
+        sorted(group, key=_survivor_rank, reverse=True)
+        for group in sorted(groups.values(), key=lambda g: min(s["id"] for s in g))
+    ]
+
+
+def merge_duplicates(groups):
+    """Merges each group into its first song. Returns the number of songs removed."""
+    return merge_songs({
+        song["id"]: group[0]["id"]
+        for group in groups
+        for song in group[1:]
+    })
+
+
+# ---------------------------------------------------------
+# CLI
+# ---------------------------------------------------------
+
+def _describe(song):
+    artist = f"{song['artist']} - " if song["artist"] else ""
+    return f"{song['id']}: {artist}{song['name']}" + (f"  [{song['path']}]" if song["path"] else "")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find and merge duplicate songs.")
+    parser.add_argument("--threshold", type=float, default=SIMILARITY_THRESHOLD,
+                        help="minimum similarity from 0 to 1 (default %(default)s)")
+    parser.add_argument("--merge", action="store_true",
+                        help="merge each group into its first song")
+    args = parser.parse_args(argv)
+
+    init_db()
+    groups = find_duplicates(args.threshold)
+    for group in groups:
+        print(f"keep  {_describe(group[0])}")
+        for song in group[1:]:
+            print(f"  dup {_describe(song)}")
+
+    duplicates = sum(len(group) - 1 for group in groups)
+    print(f"{len(groups):,} groups, {duplicates:,} duplicate songs.", file=sys.stderr)
+    if args.merge and groups:
+        print(f"Merged away {merge_duplicates(groups):,} songs.", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+Streaming bulk import of songs from CSV, JSON or NDJSON files.
+
+Usage:
+    python Importer.py songs.csv
+    python Importer.py songs.json --batch-size 10000
+    python Importer.py dump.txt --format ndjson
+
+CSV files need a header row with a 'name' column ('artist' and 'genre' are
+optional). JSON files hold a top-level array of objects; NDJSON files hold
+one object per line. Files are read incrementally, never all at once.
+"""
+
+import argparse
+import csv
+import json
+import sys
+from pathlib import Path
+
+from Database import init_db, import_songs, IMPORT_BATCH_SIZE
+
+FORMATS = {
+    ".csv": "csv",
+    ".json": "json",
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+}
+
+# Bytes read per chunk when streaming a JSON array.
+JSON_CHUNK_SIZE = 1 << 16
+
+
+# ---------------------------------------------------------
+# READERS (generators, one record at a time)
+# ---------------------------------------------------------
+
+def read_csv(f):
+    yield from csv.DictReader(f)
+
+
+def read_ndjson(f):
+    for line_no, line in enumerate(f, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            # Hand the error to import_songs, which rejects the line.
+            error = ValueError(f"Invalid JSON on line {line_no}, column {e.colno}: {e.msg}")
+            error.__cause__ = e
+            yield error
+
+
+def read_json(f, chunk_size=JSON_CHUNK_SIZE):
+    """Yields the elements of a top-level JSON array without loading it whole."""
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    started = False
+    eof = False
+
+    while True:
+        # Skip whitespace and separators between elements.
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+
+        if pos == len(buf):
+            if eof:
+                raise ValueError("Unexpected end of JSON array.")
+            buf = f.read(chunk_size)
+            pos = 0
+            eof = buf == ""
+            continue
+
+        if not started:
+            if buf[pos] != "[":
+                raise ValueError("JSON input must be an array of song objects.")
+            started = True
+            pos += 1
+            continue
+
+        if buf[pos] == "]":
+            return
+
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # Element straddles the chunk boundary; read more and retry.
+            more = f.read(chunk_size)
+            eof = more == ""
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+
+        yield obj
+        pos = end
+        if pos > chunk_size:
+            buf = buf[pos:]
+            pos = 0
+
+
+READERS = {
+    "csv": read_csv,
+    "json": read_json,
+    "ndjson": read_ndjson,
+}
+
+
+def detect_format(path):
+    fmt = FORMATS.get(Path(path).suffix.lower())
+    if fmt is None:
+        raise ValueError(f"Cannot tell the format of {path}; pass --format.")
+    return fmt
+
+
+def import_file(path, fmt=None, batch_size=IMPORT_BATCH_SIZE, progress=None, on_reject=None):
+    """Streams one file into the songs table. Returns (imported, rejected)."""
+    fmt = fmt or detect_format(path)
+    reader = READERS[fmt]
+    with open(path, newline="", encoding="utf-8") as f:
+        return import_songs(
+            reader(f),
+            batch_size=batch_size,
+            progress=progress,
+            on_reject=on_reject,
+        )
+
+
+# ---------------------------------------------------------
+# CLI
+# ---------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import songs into the music library.")
+    parser.add_argument("file", help="CSV, JSON or NDJSON file to import")
+    parser.add_argument("--format", choices=sorted(READERS), help="override format detection")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE,
+                        help=f"rows per insert batch (default {IMPORT_BATCH_SIZE})")
+    args = parser.parse_args(argv)
+
+    def progress(count):
+        print(f"\rImported {count:,} songs...", end="", file=sys.stderr, flush=True)
+
+    def on_reject(index, row, reason):
+        if isinstance(row, Exception):
+            print(f"\nRejected record {index + 1}: {reason}", file=sys.stderr)
+        else:
+            print(f"\nRejected record {index + 1}: {reason} {row!r}", file=sys.stderr)
+
+    init_db()
+    try:
+        imported, rejected = import_file(
+            args.file,
+            fmt=args.format,
+            batch_size=args.batch_size,
+            progress=progress,
+            on_reject=on_reject,
+        )
+    except (OSError, ValueError) as e:
+        print(f"\nImport failed: {e}", file=sys.stderr)
+        return 1
+
+    print(f"\nDone: {imported:,} imported, {rejected:,} rejected.", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
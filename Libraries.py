@@ -0,0 +1,278 @@
+"""
+Several library files browsed and searched as one.
+
+Usage:
+    python Libraries.py add Archive /mnt/archive/music_organizer.db
+    python Libraries.py list
+    python Libraries.py search "beatles help"
+    python Libraries.py link "Road Trip" Archive 12 40 41
+    python Libraries.py refresh Archive
+    python Libraries.py remove Archive
+
+The library in Database.DB_PATH is always included; others are
+registered with Database.add_library. Every library file has a worker
+thread of its own, bound to it with Database.bind_thread, so a listing
+or search runs on all of them at once and takes as long as the slowest
+one rather than all of them together (ATTACH would run them one after
+another on a single connection). Each library returns its rows in
+(sort_name, id) order and heapq.merge interleaves them.
+
+Playlists belong to the library in DB_PATH. Songs of other libraries are
+added to them through linked songs (see Database.link_library_songs),
+which refresh_links() updates from their source.
+"""
+
+import argparse
+import heapq
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import Database
+
+# Name shown for the library in DB_PATH.
+LOCAL_NAME = "Local"
+
+# Larger than any song id: an after= id that skips every song with a name.
+_AFTER_ALL = 2 ** 63 - 1
+
+_workers = {}  # library path (None for DB_PATH) -> single-thread executor
+_workers_lock = threading.Lock()
+_opened = set()  # library paths whose schema this process brought up to date
+
+
+def _worker(path):
+    with _workers_lock:
+        worker = _workers.get(path)
+        if worker is None:
+            worker = ThreadPoolExecutor(1, thread_name_prefix="library",
+                                        initializer=Database.bind_thread, initargs=(path,))
+            _workers[path] = worker
+        return worker
+
+
+def close_workers():
+    """Stops the library worker threads, closing their connections."""
+    with _workers_lock:
+        workers = list(_workers.values())
+        _workers.clear()
+        _opened.clear()
+    for worker in workers:
+        worker.submit(Database.close_connection)
+        worker.shutdown()
+
+
+def _run(path, fn, *args):
+    # Migrates a library the first time this process uses it, not on every
+    # call. Only the library's own worker thread touches its entry.
+    if path not in _opened:
+        Database.init_db()
+        _opened.add(path)
+    return fn(*args)
+
+
+def _call(path, fn, *args):
+    """Starts fn(*args) on the worker of the library at path; returns its future."""
+    return _worker(path).submit(_run, path, fn, *args)
+
+
+def get_libraries():
+    """Every library as {'id', 'name', 'path'}, this one first with id and path None."""
+    return [{"id": None, "name": LOCAL_NAME, "path": None}] + Database.get_libraries()
+
+
+def add_library(name, path):
+    """
+    Registers the library file at path under name, bringing its schema up
+    to date. Returns its song count. Files that cannot be opened as a
+    library are not registered.
+    """
+    library_id = Database.add_library(name, path)
+    try:
+        return _call(_library(library_id)["path"], Database.count_songs).result()
+    except sqlite3.Error:
+        Database.remove_library(library_id)
+        raise
+
+
+def _library(library_id):
+    for library in get_libraries():
+        if library["id"] == library_id:
+            return library
+    raise ValueError(f"No library {library_id}.")
+
+
+def _library_named(name):
+    for library in get_libraries():
+        if library["name"].casefold() == name.casefold():
+            return library
+    raise ValueError(f"No library called {name!r}.")
+
+
+def get_songs_page(after=None, limit=Database.PAGE_SIZE, query=None,
+                   fields=Database.SEARCH_FIELDS):
+    """
+    One page of the songs of every library in (sort_name, library, id)
+    order, as dicts like Database.get_own_songs_page() returns plus
+    library (its id, None for this one). after is the last row of the
+    previous page. query restricts the page to matching songs; limit
+    None returns all of them.
+    """
+    libraries = get_libraries()
+    ranks = {library["id"]: rank for rank, library in enumerate(libraries)}
+    futures = []
+    for rank, library in enumerate(libraries):
+        start = None
+        if after is not None:
+            # Equal sort names are ordered by library, then by id.
+            cursor = ranks.get(after["library"], -1)
+            start = (after["sort_name"],
+                     after["id"] if rank == cursor else _AFTER_ALL if rank < cursor else 0)
+        futures.append(_call(library["path"], Database.get_own_songs_page,
+                             start, limit, query, fields))
+
+    pages = [
+        [(row["sort_name"] or "", rank, row["id"], {**row, "library": library["id"]})
+         for row in future.result()]
+        for rank, (library, future) in enumerate(zip(libraries, futures))
+    ]
+    return [entry[-1] for entry in islice(heapq.merge(*pages), limit)]
+
+
+def count_songs():
+    """Number of songs get_songs_page() lists: every library's own songs together."""
+    futures = [_call(library["path"], Database.count_own_songs) for library in get_libraries()]
+    return sum(future.result() for future in futures)
+
+
+def search_songs(query, fields=Database.SEARCH_FIELDS, limit=Database.SEARCH_LIMIT):
+    """Songs of every library matching query (see Database.search_songs), by name."""
+    return get_songs_page(limit=limit, query=query, fields=fields)
+
+
+def _link(library_id, song_ids):
+    """{id there: local id} for the songs song_ids of library_id that still exist."""
+    if library_id is None:
+        return {song_id: song_id for song_id in song_ids}
+    songs = _call(_library(library_id)["path"], Database.get_songs_by_ids, song_ids).result()
+    local_ids = Database.link_library_songs(library_id, songs)
+    return dict(zip([song["id"] for song in songs], local_ids))
+
+
+def link_songs(library_id, song_ids):
+    """
+    Local ids for the songs song_ids of library_id, linking them in as
+    needed (see Database.link_library_songs). Songs that no longer exist
+    there are left out.
+    """
+    linked = _link(library_id, song_ids)
+    return [linked[song_id] for song_id in song_ids if song_id in linked]
+
+
+def add_to_playlist(playlist_id, songs):
+    """
+    Appends songs, rows from get_songs_page() or anything with library
+    and id, to a playlist of this library, in the order given. Each
+    library's songs are linked in one go, however they interleave.
+    Returns the number added.
+    """
+    songs = list(songs)
+    by_library = {}
+    for song in songs:
+        by_library.setdefault(song["library"], []).append(song["id"])
+    linked = {library_id: _link(library_id, ids) for library_id, ids in by_library.items()}
+    return Database.add_songs_to_playlist(playlist_id, [
+        linked[song["library"]][song["id"]] for song in songs
+        if song["id"] in linked[song["library"]]
+    ])
+
+
+def refresh_links(library_id):
+    """
+    Updates the songs linked in from library_id with their current name,
+    artist, genre, file and duration there. Returns the number updated.
+    """
+    linked = Database.get_linked_song_ids(library_id)
+    return len(link_songs(library_id, sorted(linked)))
+
+
+# ---------------------------------------------------------
+# CLI
+# ---------------------------------------------------------
+
+def _describe(song, names):
+    artist = f"{song['artist']} - " if song["artist"] else ""
+    return f"{names[song['library']]:>12}  {song['id']}: {artist}{song['name']}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Register, search and link library files.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser("add", help="register a library file")
+    cmd.add_argument("name")
+    cmd.add_argument("path")
+
+    cmd = commands.add_parser("remove", help="unregister a library (its linked songs stay)")
+    cmd.add_argument("name")
+
+    commands.add_parser("list", help="list the libraries")
+
+    cmd = commands.add_parser("search", help="search every library")
+    cmd.add_argument("query")
+    cmd.add_argument("--fields", default=",".join(Database.SEARCH_FIELDS),
+                     help="comma-separated fields to match (default %(default)s)")
+    cmd.add_argument("--limit", type=int, default=Database.SEARCH_LIMIT)
+
+    cmd = commands.add_parser("link", help="add songs of a library to a playlist")
+    cmd.add_argument("playlist", help="playlist name")
+    cmd.add_argument("library", help="library name")
+    cmd.add_argument("song_ids", nargs="+", type=int, help="song ids in that library")
+
+    cmd = commands.add_parser("refresh", help="update songs linked in from a library")
+    cmd.add_argument("name")
+
+    args = parser.parse_args(argv)
+    Database.init_db()
+    try:
+        if args.command == "add":
+            count = add_library(args.name, args.path)
+            print(f"Added {args.name} ({count:,} songs).", file=sys.stderr)
+
+        elif args.command == "remove":
+            Database.remove_library(_library_named(args.name)["id"])
+
+        elif args.command == "list":
+            libraries = get_libraries()
+            counts = [_call(library["path"], Database.count_songs) for library in libraries]
+            for library, count in zip(libraries, counts):
+                print(f"{library['name']:>12}  {count.result():>9,} songs  "
+                      f"{library['path'] or Database.DB_PATH}")
+
+        elif args.command == "search":
+            names = {library["id"]: library["name"] for library in get_libraries()}
+            for song in search_songs(args.query, tuple(args.fields.split(",")), args.limit):
+                print(_describe(song, names))
+
+        elif args.command == "link":
+            playlist_id = Database.get_playlist_id(args.playlist)
+            if playlist_id is None:
+                print(f"No playlist called {args.playlist!r}.", file=sys.stderr)
+                return 1
+            library_id = _library_named(args.library)["id"]
+            songs = [{"library": library_id, "id": song_id} for song_id in args.song_ids]
+            print(f"Added {add_to_playlist(playlist_id, songs):,} songs.", file=sys.stderr)
+
+        else:
+            count = refresh_links(_library_named(args.name)["id"])
+            print(f"Updated {count:,} linked songs.", file=sys.stderr)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(f"{args.command} failed: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
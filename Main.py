@@ -1,48 +1,567 @@
+import sys
 import tkinter as tk
-from tkinter import ttk, messagebox
+from collections import OrderedDict
+from difflib import SequenceMatcher
+from tkinter import ttk, messagebox, font as tkfont
 
 from Database import (
     init_db,
-    get_connection,
-    create_song,
-    get_all_songs,
-    update_song,
-    delete_song,
+    close_connection,
+    count_songs,
+    get_songs_page,
+    get_all_playlists,
+    count_playlist_songs,
+    get_playlist_songs_page,
+    get_artists,
+    get_genres,
+    PAGE_SIZE,
     create_playlist,
     delete_playlist,
-    add_song_to_playlist,
-    remove_song_from_playlist,
-    search_songs_by_name,
-    search_songs_by_genre,
+    add_songs_to_playlist,
+    remove_songs_from_playlist,
+    add_search_results_to_playlist,
+    merge_playlists,
+    copy_playlist,
+    move_song_in_playlist,
+    create_smart_playlist,
+    set_playlist_rules,
+    get_playlist_rules,
+    SMART_FIELDS,
+    SMART_OPERATORS,
+    get_similar_songs,
+    get_playlist_extension,
+    get_playlists_for_song,
+    search_songs,
+    search_songs_fuzzy,
+    SEARCH_FIELDS,
+    SEARCH_LIMIT,
 )
+from QueryStats import (
+    BUCKETS_MS,
+    get_query_stats,
+    get_slow_queries,
+    get_slow_query_threshold,
+    reset_query_stats,
+    set_slow_query_threshold,
+)
+from ChangeFeed import ChangeFeed
+import Libraries
+from Maintenance import Maintenance
+from SearchCache import SearchCache
+from SongCache import SongCache, sort_key
+from Worker import DbWorker
+
+# Pause after the last keystroke before the search box runs a search.
+SEARCH_DEBOUNCE_MS = 150
+
+# Playlists named under Song Details before "and N more".
+APPEARS_IN_SHOWN = 8
+
+# How often the Diagnostics tab refreshes while it is showing.
+DIAGNOSTICS_REFRESH_MS = 1000
+
+def format_song(song):
+    text = f"{song['name']} — {song['artist']} [{song['genre']}]"
+    # Linked in from another library (see Libraries.py).
+    return f"{text}  (linked)" if song.get("library_id") is not None else text
+
+
+def library_song(song):
+    """
+    A row of Libraries.get_songs_page() with an id unique across libraries,
+    (library, id), as VirtualList selects rows by id.
+    """
+    return {**song, "id": (song["library"], song["id"])}
+
+
+def library_names():
+    return {library["id"]: library["name"] for library in Libraries.get_libraries()}
+
+
+def format_playlist(playlist):
+    return f"{playlist['name']}  (smart)" if playlist["smart"] else playlist["name"]
+
+
+def format_facet(facet):
+    return f"{facet['name']} ({facet['songs']:,})"
+
 
-def fetch_all_playlists():
-    """Return list of dicts: [{'id': ..., 'name': ...}, ...]."""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name FROM playlists ORDER BY name COLLATE NOCASE")
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
-
-
-def fetch_songs_for_playlist(playlist_id):
-    """Return list of dicts for the songs in a playlist."""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
+def show_error(message):
+    """Returns an on_error callback for DbWorker that reports the failure."""
+    return lambda e: messagebox.showerror("Error", f"{message}:\n{e}")
+
+
+# --------------------------- LIST VIEWS --------------------------- #
+
+class ListView:
+    """
+    View-model for a tk.Listbox. update(rows) works out the inserts,
+    deletes and changed rows between what is shown and the new rows
+    (matched by 'id') and applies only those to the widget, keeping the
+    selection and scroll position.
+
+    With key=, both lists are assumed sorted by key (as the SQL listings
+    are) and diffed in one merge pass; otherwise difflib is used.
+    """
+
+    def __init__(self, listbox, format_row, key=None, keep_scroll=True):
+        self.listbox = listbox
+        self.format_row = format_row
+        self.key = key
+        self.keep_scroll = keep_scroll
+        self.rows = []
+        self.texts = []
+
+    def _sorted(self, keys):
+        return all(a < b for a, b in zip(keys, keys[1:]))
+
+    def _diff(self, rows):
+        """SequenceMatcher-style opcodes turning self.rows into rows."""
+        if self.key is not None:
+            old_keys = [self.key(row) for row in self.rows]
+            new_keys = [self.key(row) for row in rows]
+            if self._sorted(old_keys) and self._sorted(new_keys):
+                return self._merge_diff(old_keys, new_keys)
+
+        matcher = SequenceMatcher(None, [r["id"] for r in self.rows], [r["id"] for r in rows],
+                                  autojunk=False)
+        return matcher.get_opcodes()
+
+    @staticmethod
+    def _merge_diff(old_keys, new_keys):
+        ops = []
+
+        def add(tag, i, j, di, dj):
+            last = ops[-1] if ops else None
+            if last and last[0] == tag and last[2] == i and last[4] == j:
+                ops[-1] = (tag, last[1], i + di, last[3], j + dj)
+            else:
+                ops.append((tag, i, i + di, j, j + dj))
+
+        i = j = 0
+        while i < len(old_keys) or j < len(new_keys):
+            if j == len(new_keys) or (i < len(old_keys) and old_keys[i] < new_keys[j]):
+                add("delete", i, j, 1, 0)
+                i += 1
+            elif i == len(old_keys) or new_keys[j] < old_keys[i]:
+                add("insert", i, j, 0, 1)
+                j += 1
+            else:
+                add("equal", i, j, 1, 1)
+                i += 1
+                j += 1
+        return ops
+
+    def update(self, rows):
+        lb = self.listbox
+        texts = [self.format_row(row) for row in rows]
+        selected = {self.rows[i]["id"] for i in lb.curselection() if i < len(self.rows)}
+        top_id = self.rows[lb.nearest(0)]["id"] if self.rows and self.keep_scroll else None
+
+        # Apply back to front so earlier old-list indexes stay valid.
+        for tag, i1, i2, j1, j2 in reversed(self._diff(rows)):
+            if tag == "equal":
+                for k in range(i2 - i1):
+                    if self.texts[i1 + k] != texts[j1 + k]:
+                        lb.delete(i1 + k)
+                        lb.insert(i1 + k, texts[j1 + k])
+                continue
+            if i2 > i1:
+                lb.delete(i1, i2 - 1)
+            if j2 > j1:
+                lb.insert(i1, *texts[j1:j2])
+
+        self.rows = rows
+        self.texts = texts
+
+        if selected or top_id is not None:
+            lb.selection_clear(0, tk.END)
+            for index, row in enumerate(rows):
+                if row["id"] in selected:
+                    lb.selection_set(index)
+                if row["id"] == top_id:
+                    lb.yview(index)
+
+    def clear(self):
+        self.update([])
+
+
+# ------------------------- VIRTUAL SONG LIST ------------------------ #
+
+# Pages of songs kept in memory by PagedSongSource.
+PAGE_CACHE_PAGES = 8
+
+# Shown in VirtualList rows whose page is still being fetched.
+LOADING_TEXT = "Loading…"
+
+
+class ListSource:
+    """Row source over an in-memory list (e.g. search results)."""
+
+    def __init__(self, rows):
+        self.items = rows
+
+    def __len__(self):
+        return len(self.items)
+
+    def rows(self, start, count):
+        return self.items[start:start + count]
+
+
+class PagedSongSource:
+    """
+    Row source over the songs table in name order, optionally only one
+    artist's and/or genre's songs. Pages are fetched on demand with keyset
+    pagination from a neighbouring cached page and kept in a small LRU
+    cache, so memory and per-scroll cost stay flat.
+
+    Until attach() is called (e.g. while it is built on a worker), pages
+    are fetched inline. After, missing pages are fetched through the
+    DbWorker one at a time and rows() returns placeholders (id None) for
+    them meanwhile; on_loaded() is called on the Tk thread as each
+    arrives. A newer page request supersedes an older one, so dragging
+    the scrollbar only ever waits for where it stops.
+
+    filtered is True when the rows are not simply every song of this
+    library, i.e. when SongCache cannot stand in for the source.
+    """
+
+    def __init__(self, page_size=PAGE_SIZE, cache_pages=PAGE_CACHE_PAGES,
+                 artist_id=None, genre_id=None):
+        self.page_size = page_size
+        self.cache_pages = cache_pages
+        self.pages = OrderedDict()
+        self.filters = {"artist_id": artist_id, "genre_id": genre_id}
+        self.filtered = artist_id is not None or genre_id is not None
+        self.total = self._count()
+        self.db = None
+        self.on_loaded = None
+        self.loading = None  # page number being fetched on the worker
+
+    def __len__(self):
+        return self.total
+
+    def _count(self):
+        return count_songs(**self.filters)
+
+    @staticmethod
+    def _fetch(**query):
+        return get_songs_page(**query)
+
+    def attach(self, db, on_loaded):
+        """Fetches missing pages through db from now on (Tk thread only)."""
+        self.db = db
+        self.on_loaded = on_loaded
+
+    def detach(self):
+        """Drops any page still being fetched, e.g. once no longer shown."""
+        if self.db is not None:
+            self.db.cancel(self._channel())
+        self.loading = None
+
+    def _channel(self):
+        return ("pages", id(self))
+
+    @staticmethod
+    def _cursor(row):
+        """The keyset of a row, for after= and before=."""
+        return row["name"], row["id"]
+
+    def _page_query(self, n):
+        """_fetch() arguments for page n, seeking from a cached neighbour."""
+        prev_page = self.pages.get(n - 1)
+        next_page = self.pages.get(n + 1)
+        if prev_page:
+            return dict(after=self._cursor(prev_page[-1]), limit=self.page_size, **self.filters)
+        if next_page:
+            return dict(before=self._cursor(next_page[0]), limit=self.page_size, **self.filters)
+        # Jump (e.g. scrollbar drag): no neighbour to seek from.
+        return dict(offset=n * self.page_size, limit=self.page_size, **self.filters)
+
+    def _store(self, n, page):
+        self.pages[n] = page
+        if len(self.pages) > self.cache_pages:
+            self.pages.popitem(last=False)
+
+    def _page(self, n):
+        """Page n, or None if it is not cached and is being fetched instead."""
+        page = self.pages.get(n)
+        if page is not None:
+            self.pages.move_to_end(n)
+            return page
+        if self.db is None:
+            while n not in self.pages:
+                self._store(n, self._fetch(**self._page_query(n)))
+            return self.pages[n]
+        if self.loading != n:
+            self.loading = n
+            self.db.submit(
+                self._fetch,
+                channel=self._channel(),
+                on_done=lambda page: self._on_page(n, page),
+                on_error=self._on_page_error,
+                **self._page_query(n),
+            )
+        return None
+
+    def _on_page(self, n, result):
+        self.loading = None
+        self._store(n, result)
+        # Renders the rows that were waiting, which asks for the next missing page.
+        self.on_loaded()
+
+    def _on_page_error(self, error):
+        self.loading = None
+        show_error("Failed to load songs")(error)
+
+    def patch(self, songs):
         """
-        SELECT s.id, s.name, s.artist, s.genre
-        FROM songs s
-        JOIN playlist_songs ps ON s.id = ps.song_id
-        WHERE ps.playlist_id = ?
-        ORDER BY s.name COLLATE NOCASE
-        """,
-        (playlist_id,),
-    )
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+        Updates the cached rows of songs edited elsewhere, {id: the song
+        as Database.get_changes() gives it}. Deleted songs (None) are left
+        alone: the rows around them shift, which takes a reload.
+        """
+        for page in self.pages.values():
+            for i, row in enumerate(page):
+                fresh = songs.get(row["id"])
+                if fresh is not None:
+                    page[i] = {**row, **fresh}
+
+    def rows(self, start, count):
+        end = min(start + count, self.total)
+        result = []
+        while start < end:
+            n, offset = divmod(start, self.page_size)
+            page = self._page(n)
+            if page is None:
+                # Placeholders for the rest of the window: later pages
+                # are only fetched once this one is in.
+                result.extend({"id": None} for _ in range(end - start))
+                break
+            chunk = page[offset:offset + end - start]
+            if not chunk:
+                break
+            result.extend(chunk)
+            start += len(chunk)
+        return result
+
+
+class PlaylistSongSource(PagedSongSource):
+    """Row source over one playlist's songs in running order, paged on (position, id)."""
+
+    def __init__(self, playlist_id, page_size=PAGE_SIZE, cache_pages=PAGE_CACHE_PAGES):
+        self.playlist_id = playlist_id
+        super().__init__(page_size, cache_pages)
+        self.filters = {"playlist_id": playlist_id}
+        self.filtered = True
+
+    def _count(self):
+        return count_playlist_songs(self.playlist_id)
+
+    @staticmethod
+    def _fetch(**query):
+        return get_playlist_songs_page(**query)
+
+    @staticmethod
+    def _cursor(row):
+        return row["position"], row["id"]
+
+
+# Pages listed per call when LibrariesSource jumps past the pages it knows.
+LIBRARY_SKIP_PAGES = 50
+
+
+class LibrariesSource(PagedSongSource):
+    """
+    Row source over the songs of every library (see Libraries.py) in name
+    order, with rows as library_song() gives them. Libraries are only
+    paged forwards, so the last row of each page listed is kept as where
+    the next page starts, and a jump lists forwards from the nearest such
+    row, at most LIBRARY_SKIP_PAGES pages per call.
+    """
+
+    def __init__(self, page_size=PAGE_SIZE, cache_pages=PAGE_CACHE_PAGES):
+        self.starts = {0: None}  # page number -> last row of the page before
+        super().__init__(page_size, cache_pages)
+        # SongCache holds this library only.
+        self.filtered = True
+
+    def _count(self):
+        return Libraries.count_songs()
+
+    @staticmethod
+    def _fetch(after, first, pages, page_size):
+        rows = Libraries.get_songs_page(after=after, limit=pages * page_size)
+        return first, [rows[i:i + page_size] for i in range(0, pages * page_size, page_size)]
+
+    def _page_query(self, n):
+        first = max(m for m in self.starts if m <= n)
+        return dict(after=self.starts[first], first=first,
+                    pages=min(n - first + 1, LIBRARY_SKIP_PAGES), page_size=self.page_size)
+
+    def _store(self, n, result):
+        first, chunks = result
+        for m, chunk in enumerate(chunks, start=first):
+            if chunk:
+                self.starts[m + 1] = chunk[-1]
+        if first <= n < first + len(chunks):
+            super()._store(n, [library_song(song) for song in chunks[n - first]])
+
+
+class VirtualList(tk.Frame):
+    """
+    Scrollable list that only ever holds the rows currently on screen.
+    Rows come from a source with len() and rows(start, count); the
+    scrollbar is driven by hand to represent the full length.
+
+    Selection is tracked by row id, so Ctrl/Shift-click can build up a
+    multi-row selection across scrolled windows. Rows with id None are
+    placeholders for rows still loading; they show LOADING_TEXT and cannot
+    be selected.
+    """
+
+    def __init__(self, master, format_row, on_select=None, **listbox_options):
+        super().__init__(master)
+
+        self.format_row = format_row
+        self.on_select = on_select
+        self.source = ListSource([])
+        self.top = 0          # absolute index of the first visible row
+        self.visible = listbox_options.get("height", 10)
+        self.window = []      # rows currently in the listbox
+        self.selected_ids = {}  # ordered set of selected row ids
+        self.active = None    # absolute index of the last clicked/moved-to row
+        self._extend = False  # last click had Shift/Ctrl held
+
+        self.scrollbar = tk.Scrollbar(self, command=self._on_scrollbar)
+        self.scrollbar.pack(side="right", fill="y")
+
+        listbox_options.setdefault("activestyle", "none")
+        self.listbox = tk.Listbox(self, exportselection=False, selectmode=tk.EXTENDED,
+                                  **listbox_options)
+        self.listbox.pack(side="left", fill="both", expand=True)
+        # Scrolling by a row only touches the rows entering/leaving the window.
+        self.view = ListView(self.listbox, self._format_row, keep_scroll=False)
+
+        self.line_height = tkfont.Font(font=self.listbox.cget("font")).metrics("linespace") + 1
+
+        self.listbox.bind("<ButtonPress-1>", self._on_click)
+        self.listbox.bind("<<ListboxSelect>>", self._on_listbox_select)
+        self.listbox.bind("<Configure>", self._on_resize)
+        self.listbox.bind("<MouseWheel>", lambda e: self.scroll(-3 if e.delta > 0 else 3))
+        self.listbox.bind("<Button-4>", lambda e: self.scroll(-3))
+        self.listbox.bind("<Button-5>", lambda e: self.scroll(3))
+        self.listbox.bind("<Up>", lambda e: self._move_selection(-1))
+        self.listbox.bind("<Down>", lambda e: self._move_selection(1))
+        self.listbox.bind("<Prior>", lambda e: self._move_selection(-self.visible))
+        self.listbox.bind("<Next>", lambda e: self._move_selection(self.visible))
+
+    # public API
+
+    def set_source(self, source, keep_position=False, keep_selection=False):
+        if source is not self.source and hasattr(self.source, "detach"):
+            self.source.detach()
+        self.source = source
+        if not keep_position:
+            self.top = 0
+        if not keep_selection:
+            self.selected_ids = {}
+            self.active = None
+        self.render()
+
+    def get_selected_ids(self):
+        return list(self.selected_ids)
+
+    def set_selected_ids(self, ids):
+        self.selected_ids = dict.fromkeys(ids)
+        self.render()
+
+    def scroll(self, rows):
+        self.top += rows
+        self.render()
+        return "break"
+
+    def render(self):
+        total = len(self.source)
+        self.top = max(0, min(self.top, total - self.visible))
+        self.window = self.source.rows(self.top, self.visible)
+
+        self.view.update(self.window)
+        self.listbox.selection_clear(0, tk.END)
+        for index, row in enumerate(self.window):
+            if row["id"] in self.selected_ids:
+                self.listbox.selection_set(index)
+
+        if total:
+            self.scrollbar.set(self.top / total, (self.top + len(self.window)) / total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    def _format_row(self, row):
+        return LOADING_TEXT if row["id"] is None else self.format_row(row)
+
+    # events
+
+    def _on_scrollbar(self, action, amount, unit=None):
+        if action == "moveto":
+            self.top = int(float(amount) * len(self.source))
+        elif unit == "pages":
+            self.top += int(amount) * self.visible
+        else:
+            self.top += int(amount)
+        self.render()
+
+    def _on_resize(self, event):
+        visible = max(1, event.height // self.line_height)
+        if visible != self.visible:
+            self.visible = visible
+            self.render()
+
+    def _on_click(self, event):
+        # Runs before the class binding updates the selection.
+        self._extend = bool(event.state & (0x0001 | 0x0004))  # Shift or Control
+
+    def _on_listbox_select(self, event):
+        picked = [self.window[i]["id"] for i in self.listbox.curselection()
+                  if self.window[i]["id"] is not None]
+        if self._extend:
+            # Keep selected rows that are scrolled out of view.
+            shown = {row["id"] for row in self.window}
+            kept = {i: None for i in self.selected_ids if i not in shown}
+            self.selected_ids = {**kept, **dict.fromkeys(picked)}
+        else:
+            self.selected_ids = dict.fromkeys(picked)
+        self._extend = False
+
+        clicked = self.listbox.index(tk.ACTIVE)
+        if clicked < len(self.window) and self.window[clicked]["id"] in self.selected_ids:
+            self.active = self.top + clicked
+            if self.on_select is not None:
+                self.on_select(self.window[clicked])
+
+    def _move_selection(self, delta):
+        total = len(self.source)
+        if not total:
+            return "break"
+        current = self.top if self.active is None else self.active
+        self.active = max(0, min(current + delta, total - 1))
+
+        # Scroll just enough to keep the active row on screen.
+        if self.active < self.top:
+            self.top = self.active
+        elif self.active >= self.top + self.visible:
+            self.top = self.active - self.visible + 1
+        self.render()
+
+        row = self.window[self.active - self.top]
+        self.listbox.selection_clear(0, tk.END)
+        if row["id"] is None:
+            self.selected_ids = {}
+            return "break"
+        self.selected_ids = {row["id"]: None}
+        self.listbox.selection_set(self.active - self.top)
+        if self.on_select is not None:
+            self.on_select(row)
+        return "break"
 
 
 # --------------------------- LIBRARY TAB --------------------------- #
@@ -50,17 +569,36 @@ def fetch_songs_for_playlist(playlist_id):
 class LibraryTab(tk.Frame):
     """Library tab: shows all songs, search, and add/edit/delete form."""
 
-    def __init__(self, master, *args, **kwargs):
+    def __init__(self, master, db: DbWorker, *args, on_write=None, **kwargs):
         super().__init__(master, *args, **kwargs)
 
-        # list of dicts: {'id', 'name', 'artist', 'genre'}
-        self.songs = []
+        self.db = db
+        # Called after this tab changes songs, for the other tabs showing them.
+        self.on_write = on_write
         self.selected_song_id = None
+        # {'library', 'id'} of the selected song when it is another library's.
+        self.selected_other_song = None
+        # Playlists the selected song is in, as shown under Song Details.
+        self.appears_in = []
+
+        self.search_cache = SearchCache()
+        # (keyword, field) of the search the list shows, None for all songs.
+        self.current_search = None
+        # Canonical song records; edits patch it instead of reloading.
+        self.song_cache = SongCache()
+        self._search_after_id = None
+        # Facets picked in the Browse sidebar; None means all.
+        self.genre_id = None
+        self.artist_id = None
+        # List and search every library (see Libraries.py), not just this one.
+        self.all_libraries = tk.BooleanVar(value=False)
+        self.library_names = {}
 
         self._build_search_area()
         self._build_song_list()
         self._build_form()
 
+        self.refresh_facets()
         self.refresh_songs()
 
     # UI sections
@@ -72,32 +610,53 @@ class LibraryTab(tk.Frame):
         tk.Label(frame, text="Keyword:").grid(row=0, column=0, padx=5, pady=5, sticky="e")
         self.search_entry = tk.Entry(frame, width=30)
         self.search_entry.grid(row=0, column=1, padx=5, pady=5)
+        # Search as you type.
+        self.search_entry.bind("<KeyRelease>", self._schedule_search)
+        self.search_entry.bind("<Return>", lambda e: self.search_songs())
 
         self.search_field = tk.StringVar(value="name")
-        rb_name = tk.Radiobutton(frame, text="By Name", variable=self.search_field, value="name")
-        rb_genre = tk.Radiobutton(frame, text="By Genre", variable=self.search_field, value="genre")
+        rb_name = tk.Radiobutton(frame, text="By Name", variable=self.search_field, value="name",
+                                 command=self._schedule_search)
+        rb_genre = tk.Radiobutton(frame, text="By Genre", variable=self.search_field, value="genre",
+                                  command=self._schedule_search)
+        # Typo-tolerant, over names, artists and genres.
+        rb_fuzzy = tk.Radiobutton(frame, text="Fuzzy", variable=self.search_field, value="fuzzy",
+                                  command=self._schedule_search)
         rb_name.grid(row=0, column=2, padx=5, pady=5)
         rb_genre.grid(row=0, column=3, padx=5, pady=5)
+        rb_fuzzy.grid(row=0, column=4, padx=5, pady=5)
 
         btn_search = tk.Button(frame, text="Search", command=self.search_songs)
-        btn_search.grid(row=0, column=4, padx=5, pady=5)
-
-        btn_show_all = tk.Button(frame, text="Show All", command=self.refresh_songs)
-        btn_show_all.grid(row=0, column=5, padx=5, pady=5)
+        btn_search.grid(row=0, column=5, padx=5, pady=5)
 
-    def _build_song_list(self):
-        frame = tk.LabelFrame(self, text="Songs")
-        frame.pack(fill="both", expand=True, padx=10, pady=5)
-
-        scrollbar = tk.Scrollbar(frame)
-        scrollbar.pack(side="right", fill="y")
+        btn_show_all = tk.Button(frame, text="Show All", command=self.show_all_songs)
+        btn_show_all.grid(row=0, column=6, padx=5, pady=5)
 
-        self.song_listbox = tk.Listbox(frame, height=12, activestyle="none")
-        self.song_listbox.pack(side="left", fill="both", expand=True)
-        self.song_listbox.config(yscrollcommand=scrollbar.set)
-        scrollbar.config(command=self.song_listbox.yview)
+        cb_libraries = tk.Checkbutton(frame, text="All Libraries", variable=self.all_libraries,
+                                      command=self._on_scope_change)
+        cb_libraries.grid(row=0, column=7, padx=5, pady=5)
 
-        self.song_listbox.bind("<<ListboxSelect>>", self.on_song_select)
+    def _build_song_list(self):
+        body = tk.Frame(self)
+        body.pack(fill="both", expand=True, padx=10, pady=5)
+
+        sidebar = tk.LabelFrame(body, text="Browse")
+        sidebar.pack(side="left", fill="y", padx=(0, 5))
+        # Artist lists can be long too, so these are virtual as well.
+        self.genre_list = VirtualList(sidebar, format_facet, on_select=self.on_genre_select,
+                                      height=8, width=28)
+        self.genre_list.pack(fill="both", expand=True, pady=(0, 5))
+        self.artist_list = VirtualList(sidebar, format_facet, on_select=self.on_artist_select,
+                                       height=12, width=28)
+        self.artist_list.pack(fill="both", expand=True)
+
+        frame = tk.LabelFrame(body, text="Songs")
+        frame.pack(side="left", fill="both", expand=True)
+
+        # Only the visible rows are ever loaded into the widget.
+        self.song_list = VirtualList(frame, self._format_song, on_select=self.on_song_select,
+                                     height=12)
+        self.song_list.pack(fill="both", expand=True)
 
     def _build_form(self):
         frame = tk.LabelFrame(self, text="Song Details")
@@ -106,6 +665,7 @@ class LibraryTab(tk.Frame):
         tk.Label(frame, text="Title:").grid(row=0, column=0, sticky="e", padx=5, pady=2)
         tk.Label(frame, text="Artist:").grid(row=1, column=0, sticky="e", padx=5, pady=2)
         tk.Label(frame, text="Genre:").grid(row=2, column=0, sticky="e", padx=5, pady=2)
+        tk.Label(frame, text="Appears in:").grid(row=3, column=0, sticky="ne", padx=5, pady=2)
 
         self.entry_title = tk.Entry(frame, width=35)
         self.entry_artist = tk.Entry(frame, width=35)
@@ -115,6 +675,9 @@ class LibraryTab(tk.Frame):
         self.entry_artist.grid(row=1, column=1, padx=5, pady=2)
         self.entry_genre.grid(row=2, column=1, padx=5, pady=2)
 
+        self.appears_in_label = tk.Label(frame, anchor="w", justify="left", wraplength=300)
+        self.appears_in_label.grid(row=3, column=1, sticky="w", padx=5, pady=2)
+
         btn_frame = tk.Frame(frame)
         btn_frame.grid(row=0, column=2, rowspan=3, padx=10, pady=2, sticky="ns")
 
@@ -130,47 +693,278 @@ class LibraryTab(tk.Frame):
 
     # Helpers
 
+    def _format_song(self, song):
+        if song.get("library") is None:
+            return format_song(song)
+        return f"{format_song(song)}  ({self.library_names.get(song['library'], '?')})"
+
     def clear_form(self):
         self.selected_song_id = None
+        self.selected_other_song = None
         self.entry_title.delete(0, tk.END)
         self.entry_artist.delete(0, tk.END)
         self.entry_genre.delete(0, tk.END)
+        self.db.cancel("appears_in")
+        self._show_appears_in([])
+
+    def _show_appears_in(self, playlists):
+        self.appears_in = playlists
+        names = [format_playlist(pl) for pl in playlists]
+        if len(names) > APPEARS_IN_SHOWN:
+            names[APPEARS_IN_SHOWN:] = [f"and {len(names) - APPEARS_IN_SHOWN:,} more"]
+        self.appears_in_label.config(text=", ".join(names) if names else "No playlists")
 
     def populate_listbox(self, songs):
-        self.songs = songs
-        self.song_listbox.delete(0, tk.END)
-        for song in songs:
-            display = f"{song['name']} — {song['artist']} [{song['genre']}]"
-            self.song_listbox.insert(tk.END, display)
+        self.song_list.set_source(ListSource(self.song_cache.canonical(songs)))
+
+    @staticmethod
+    def _load_library(top, artist_id=None, genre_id=None):
+        # Runs on a worker: count plus the page about to be shown. Later
+        # pages are fetched through the DbWorker once _show_all attaches it.
+        source = PagedSongSource(artist_id=artist_id, genre_id=genre_id)
+        source.rows(top, PAGE_SIZE)
+        return source
+
+    def _show_all(self, source):
+        # Prefer the in-memory cache once it is loaded and current.
+        if not source.filtered and not self.song_cache.stale:
+            source = self.song_cache
+        else:
+            source.attach(self.db, self.song_list.render)
+        self.song_list.set_source(source, keep_position=True)
+
+    def show_all_songs(self):
+        self._set_facets(None, None)
+        self.refresh_songs()
+
+    @staticmethod
+    def _load_all_libraries(top):
+        # Runs on a worker, like _load_library.
+        source = LibrariesSource()
+        source.rows(top, PAGE_SIZE)
+        return library_names(), source
+
+    def _show_all_libraries(self, result):
+        self.library_names, source = result
+        source.attach(self.db, self.song_list.render)
+        self.song_list.set_source(source, keep_position=True)
 
     def refresh_songs(self):
-        try:
-            songs = get_all_songs()  # list of dicts from Database.py
-            self.populate_listbox(songs)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to load songs:\n{e}")
+        self.current_search = None
+        if self.all_libraries.get():
+            self.db.submit(
+                self._load_all_libraries,
+                self.song_list.top,
+                channel="library",
+                on_done=self._show_all_libraries,
+                on_error=show_error("Failed to load songs"),
+            )
+            return
 
-    def search_songs(self):
+        browsing = self.artist_id is not None or self.genre_id is not None
+        if not browsing and not self.song_cache.stale:
+            # Every write since the load went through the cache: no query needed.
+            self.db.cancel("library")
+            self.song_list.set_source(self.song_cache, keep_position=True)
+            return
+
+        # Paged first paint, while the cache (re)loads in the background.
+        self.db.submit(
+            self._load_library,
+            self.song_list.top,
+            self.artist_id,
+            self.genre_id,
+            channel="library",
+            on_done=self._show_all,
+            on_error=show_error("Failed to load songs"),
+        )
+        if self.song_cache.stale:
+            self.db.submit(
+                self.song_cache.load,
+                channel="song_cache",
+                on_done=self._on_song_cache_loaded,
+                on_error=show_error("Failed to load songs"),
+            )
+
+    def _on_song_cache_loaded(self, loaded):
+        source = self.song_list.source
+        if loaded and isinstance(source, PagedSongSource) and not source.filtered:
+            self.song_list.set_source(self.song_cache, keep_position=True)
+
+    # Browse sidebar
+
+    @staticmethod
+    def _load_genres():
+        return [{"id": None, "name": "All Genres", "songs": count_songs()}] + get_genres()
+
+    @staticmethod
+    def _load_artists(genre_id):
+        everyone = {"id": None, "name": "All Artists", "songs": count_songs(genre_id=genre_id)}
+        return [everyone] + get_artists(genre_id)
+
+    def refresh_facets(self):
+        """Reloads both facet lists (counts change with every write)."""
+        self.db.submit(
+            self._load_genres,
+            channel="genres",
+            on_done=lambda rows: self._show_facets(self.genre_list, rows, self.genre_id),
+            on_error=show_error("Failed to load genres"),
+        )
+        self._refresh_artists(keep_position=True)
+
+    def _refresh_artists(self, keep_position=False):
+        self.db.submit(
+            self._load_artists,
+            self.genre_id,
+            channel="artists",
+            on_done=lambda rows: self._show_facets(
+                self.artist_list, rows, self.artist_id, keep_position
+            ),
+            on_error=show_error("Failed to load artists"),
+        )
+
+    @staticmethod
+    def _show_facets(facet_list, rows, selected_id, keep_position=True):
+        facet_list.set_source(ListSource(rows), keep_position=keep_position)
+        facet_list.set_selected_ids([selected_id])
+
+    def _set_facets(self, genre_id, artist_id):
+        genre_changed = genre_id != self.genre_id
+        self.genre_id = genre_id
+        self.artist_id = artist_id
+        self.genre_list.set_selected_ids([genre_id])
+        self.artist_list.set_selected_ids([artist_id])
+        if genre_changed:
+            # Only artists with songs in the genre, with counts for it.
+            self._refresh_artists()
+
+    def on_genre_select(self, facet):
+        if facet["id"] == self.genre_id and self.artist_id is None:
+            return
+        self._browse(facet["id"], None)
+
+    def on_artist_select(self, facet):
+        if facet["id"] == self.artist_id:
+            return
+        self._browse(self.genre_id, facet["id"])
+
+    def _browse(self, genre_id, artist_id):
+        # Facets are this library's.
+        self.all_libraries.set(False)
+        self._set_facets(genre_id, artist_id)
+        self.search_entry.delete(0, tk.END)
+        self.song_list.top = 0
+        self.refresh_songs()
+
+    def _on_scope_change(self):
+        self.song_list.top = 0
+        if self.all_libraries.get():
+            self._set_facets(None, None)
+        self._live_search()
+
+    @staticmethod
+    def _search_all_libraries(keyword, fields):
+        songs = Libraries.search_songs(keyword, fields, SEARCH_LIMIT)
+        return library_names(), [library_song(song) for song in songs]
+
+    def _show_library_results(self, result):
+        self.library_names, songs = result
+        self.song_list.set_source(ListSource(songs))
+
+    def _schedule_search(self, event=None):
+        # Debounce: only the last keystroke in a burst triggers a search.
+        if self._search_after_id is not None:
+            self.after_cancel(self._search_after_id)
+        self._search_after_id = self.after(SEARCH_DEBOUNCE_MS, self._live_search)
+
+    def _live_search(self):
+        self._search_after_id = None
         keyword = self.search_entry.get().strip()
         if not keyword:
             self.refresh_songs()
             return
-        try:
-            if self.search_field.get() == "name":
-                songs = search_songs_by_name(keyword)
-            else:
-                songs = search_songs_by_genre(keyword)
+
+        field = self.search_field.get()
+        if field == "fuzzy" or self.all_libraries.get():
+            # Fuzzy results can't be refined from a cached shorter query,
+            # and the cache holds this library's results only.
+            self.search_songs()
+            return
+        self.current_search = (keyword, field, False)
+        # Searches cover the whole library, not the browsed facet.
+        self._set_facets(None, None)
+        songs = self.search_cache.lookup(field, keyword)
+        if songs is not None:
+            self.db.cancel("library")
             self.populate_listbox(songs)
-        except Exception as e:
-            messagebox.showerror("Error", f"Search failed:\n{e}")
+            return
 
-    def on_song_select(self, event):
-        try:
-            index = self.song_listbox.curselection()[0]
-        except IndexError:
+        # Same channel as refresh_songs: the newest listing request wins.
+        self.db.submit(
+            self.search_cache.fetch,
+            field,
+            keyword,
+            channel="library",
+            on_done=lambda result: self.populate_listbox(
+                self.search_cache.store(field, keyword, result)
+            ),
+            on_error=show_error("Search failed"),
+        )
+
+    def search_songs(self):
+        """Search button: full ranked search, bypassing the live-search cache."""
+        if self._search_after_id is not None:
+            self.after_cancel(self._search_after_id)
+            self._search_after_id = None
+
+        keyword = self.search_entry.get().strip()
+        if not keyword:
+            self.refresh_songs()
+            return
+        field = self.search_field.get()
+        # Fuzzy search covers this library only: other libraries' fuzzy
+        # indexes are kept up by their own Maintenance, if any.
+        everywhere = self.all_libraries.get() and field != "fuzzy"
+        self.current_search = (keyword, field, everywhere)
+        self._set_facets(None, None)
+        if everywhere:
+            self.db.submit(
+                self._search_all_libraries,
+                keyword,
+                (field,),
+                channel="library",
+                on_done=self._show_library_results,
+                on_error=show_error("Search failed"),
+            )
             return
-        song = self.songs[index]  # dict
-        self.selected_song_id = song["id"]
+        if field == "fuzzy":
+            search, fields = search_songs_fuzzy, SEARCH_FIELDS
+        else:
+            search, fields = search_songs, (field,)
+        self.db.submit(
+            search,
+            keyword,
+            fields=fields,
+            channel="library",
+            on_done=self.populate_listbox,
+            on_error=show_error("Search failed"),
+        )
+
+    def _after_write(self, _result=None):
+        self.refresh_songs()
+        self.refresh_facets()
+        self.clear_form()
+        if self.on_write is not None:
+            self.on_write()
+
+    def on_song_select(self, song):
+        library = song.get("library")
+        # Rows of other libraries' listings have (library, id) ids.
+        song_id = song["id"][1] if "library" in song else song["id"]
+        if library is None:
+            self.selected_song_id, self.selected_other_song = song_id, None
+        else:
+            self.selected_song_id, self.selected_other_song = None, {"library": library, "id": song_id}
 
         self.entry_title.delete(0, tk.END)
         self.entry_title.insert(0, song["name"])
@@ -181,6 +975,23 @@ class LibraryTab(tk.Frame):
         self.entry_genre.delete(0, tk.END)
         self.entry_genre.insert(0, song["genre"])
 
+        if library is not None:
+            self.db.cancel("appears_in")
+            self.appears_in = []
+            name = self.library_names.get(library, "?")
+            self.appears_in_label.config(text=f"Song of the {name} library")
+            return
+        self.appears_in_label.config(text="")
+        self._load_appears_in(song_id)
+
+    def _load_appears_in(self, song_id):
+        self.db.submit(
+            get_playlists_for_song, song_id,
+            channel="appears_in",
+            on_done=self._show_appears_in,
+            on_error=show_error("Failed to load the song's playlists"),
+        )
+
     # CRUD actions
 
     def add_song(self):
@@ -192,14 +1003,23 @@ class LibraryTab(tk.Frame):
             messagebox.showwarning("Validation", "Title is required.")
             return
 
-        try:
-            create_song(title, artist, genre)
-            self.refresh_songs()
-            self.clear_form()
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to add song:\n{e}")
+        self.db.submit(
+            self.song_cache.create_song, title, artist, genre,
+            on_done=self._after_write,
+            on_error=show_error("Failed to add song"),
+        )
+
+    def _check_own_song(self):
+        """False (after saying why) when the selected song is another library's."""
+        if self.selected_other_song is not None:
+            messagebox.showinfo("Other Library",
+                                "Songs of other libraries can only be changed in their library.")
+            return False
+        return True
 
     def update_song(self):
+        if not self._check_own_song():
+            return
         if self.selected_song_id is None:
             messagebox.showinfo("Select Song", "Please select a song to update.")
             return
@@ -212,50 +1032,244 @@ class LibraryTab(tk.Frame):
             messagebox.showwarning("Validation", "Title is required.")
             return
 
-        try:
-            update_song(self.selected_song_id, title, artist, genre)
-            self.refresh_songs()
-            self.clear_form()
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to update song:\n{e}")
+        self.db.submit(
+            self.song_cache.update_song, self.selected_song_id, title, artist, genre,
+            on_done=self._after_write,
+            on_error=show_error("Failed to update song"),
+        )
 
     def delete_song(self):
+        if not self._check_own_song():
+            return
         if self.selected_song_id is None:
             messagebox.showinfo("Select Song", "Please select a song to delete.")
             return
 
-        if not messagebox.askyesno("Confirm", "Delete this song?"):
+        message = "Delete this song?"
+        if self.appears_in:
+            message = f"This song is in {len(self.appears_in):,} playlist(s). Delete it from all of them?"
+        if not messagebox.askyesno("Confirm", message):
             return
 
-        try:
-            delete_song(self.selected_song_id)
-            self.refresh_songs()
-            self.clear_form()
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to delete song:\n{e}")
+        self.db.submit(
+            self.song_cache.delete_song, self.selected_song_id,
+            on_done=self._after_write,
+            on_error=show_error("Failed to delete song"),
+        )
+
+    # Writes by other processes or Maintenance (see ChangeFeed.py)
+
+    def apply_changes(self, changes):
+        songs = changes["songs"]
+        if songs:
+            self.song_cache.apply(songs)
+            self.search_cache.clear()
+            self.refresh_facets()
+            if self.selected_song_id in songs and songs[self.selected_song_id] is None:
+                self.clear_form()
+            # Re-renders from the cache, or reloads just the page or search shown.
+            self._live_search()
+        if changes["playlists"] or changes["playlist_songs"]:
+            self.playlists_changed()
+
+    def reload(self):
+        """Reloads everything, for when the changes are too many to apply."""
+        self.song_cache.invalidate()
+        self.search_cache.clear()
+        self.refresh_facets()
+        self._live_search()
+        if self.selected_song_id is not None:
+            self._load_appears_in(self.selected_song_id)
 
     # For playlists tab
 
+    def playlists_changed(self):
+        """Reloads the selected song's playlists under Song Details."""
+        if self.selected_song_id is not None:
+            self._load_appears_in(self.selected_song_id)
+
     def get_selected_song_id(self):
+        """The selected song of this library, or None."""
         return self.selected_song_id
 
+    def get_selected_songs(self):
+        """The selected songs as {'library', 'id'} (see Libraries.add_to_playlist)."""
+        songs = [
+            {"library": key[0], "id": key[1]} if isinstance(key, tuple)
+            else {"library": None, "id": key}
+            for key in self.song_list.get_selected_ids()
+        ]
+        if not songs and self.selected_other_song is not None:
+            songs = [self.selected_other_song]
+        elif not songs and self.selected_song_id is not None:
+            songs = [{"library": None, "id": self.selected_song_id}]
+        return songs
+
+
+# ---------------------- SMART PLAYLIST DIALOG ---------------------- #
+
+class SmartPlaylistDialog(tk.Toplevel):
+    """
+    Edits the rules of a smart playlist, or creates one when playlist_id
+    is None. Rules are saved on the worker; the dialog closes once they
+    are, or shows why they were rejected.
+    """
+
+    def __init__(self, master, db: DbWorker, on_saved, playlist_id=None, rules=None):
+        super().__init__(master)
+        self.title("New Smart Playlist" if playlist_id is None else "Edit Rules")
+        self.transient(master.winfo_toplevel())
+
+        self.db = db
+        self.on_saved = on_saved
+        self.playlist_id = playlist_id
+        self.rule_rows = []
+
+        top = tk.Frame(self)
+        top.pack(fill="x", padx=10, pady=5)
+        if playlist_id is None:
+            tk.Label(top, text="Name:").pack(side="left")
+            self.entry_name = tk.Entry(top, width=25)
+            self.entry_name.pack(side="left", padx=(2, 10))
+        tk.Label(top, text="Match").pack(side="left")
+        self.match = ttk.Combobox(top, values=("all", "any"), width=5, state="readonly")
+        self.match.set((rules or {}).get("match", "all"))
+        self.match.pack(side="left", padx=2)
+        tk.Label(top, text="of these rules:").pack(side="left")
+
+        self.rules_frame = tk.Frame(self)
+        self.rules_frame.pack(fill="x", padx=10)
+        for rule in (rules or {}).get("rules", [{"field": "genre", "op": "is", "value": ""}]):
+            self.add_rule(rule)
+
+        buttons = tk.Frame(self)
+        buttons.pack(fill="x", padx=10, pady=5)
+        tk.Button(buttons, text="Add Rule", command=self.add_rule).pack(side="left")
+        tk.Button(buttons, text="Cancel", command=self.destroy).pack(side="right")
+        tk.Button(buttons, text="OK", command=self.save).pack(side="right", padx=5)
+
+    def add_rule(self, rule=None):
+        rule = rule or {"field": "name", "op": "contains", "value": ""}
+        row = tk.Frame(self.rules_frame)
+        row.pack(fill="x", pady=2)
+
+        field = ttk.Combobox(row, values=list(SMART_FIELDS), width=9, state="readonly")
+        op = ttk.Combobox(row, width=16, state="readonly")
+        value = tk.Entry(row, width=30)
+
+        def on_field(event=None):
+            ops = SMART_OPERATORS[SMART_FIELDS[field.get()]]
+            op["values"] = ops
+            if op.get() not in ops:
+                op.set(ops[0])
+
+        field.set(rule["field"])
+        op.set(rule["op"])
+        on_field()
+        field.bind("<<ComboboxSelected>>", on_field)
+        shown = rule["value"]
+        value.insert(0, ", ".join(shown) if isinstance(shown, list) else str(shown))
+
+        entry = (row, field, op, value)
+        remove = tk.Button(row, text="\u2212", width=2, command=lambda: self.remove_rule(entry))
+        for widget in (field, op, value, remove):
+            widget.pack(side="left", padx=2)
+        self.rule_rows.append(entry)
+
+    def remove_rule(self, entry):
+        self.rule_rows.remove(entry)
+        entry[0].destroy()
+
+    def get_rules(self):
+        rules = []
+        for _, field, op, value in self.rule_rows:
+            text = value.get().strip()
+            if not text and SMART_FIELDS[field.get()] != "text":
+                # Dates are written like 2024-01-31.
+                raise ValueError(f"Rule {field.get()} {op.get()} needs a value.")
+            if op.get() == "is one of":
+                text = [v.strip() for v in text.split(",") if v.strip()]
+            rules.append({"field": field.get(), "op": op.get(), "value": text})
+        return {"match": self.match.get(), "rules": rules}
+
+    def save(self):
+        try:
+            rules = self.get_rules()
+        except ValueError as e:
+            messagebox.showwarning("Validation", str(e), parent=self)
+            return
+
+        def done(_result):
+            self.destroy()
+            self.on_saved()
+
+        if self.playlist_id is None:
+            name = self.entry_name.get().strip()
+            if not name:
+                messagebox.showwarning("Validation", "Playlist name cannot be empty.", parent=self)
+                return
+            task = lambda: create_smart_playlist(name, rules)
+        else:
+            playlist_id = self.playlist_id
+            task = lambda: set_playlist_rules(playlist_id, rules)
+        self.db.submit(task, on_done=done, on_error=show_error("Failed to save rules"))
+
+
+# ---------------------- RECOMMENDATIONS DIALOG ---------------------- #
+
+class RecommendationsDialog(tk.Toplevel):
+    """Lists recommended songs; with on_add, the selected ones can be added to a playlist."""
+
+    def __init__(self, master, title, songs, on_add=None):
+        super().__init__(master)
+        self.title(title)
+        self.transient(master.winfo_toplevel())
+        self.songs = songs
+        self.on_add = on_add
+
+        frame = tk.Frame(self)
+        frame.pack(fill="both", expand=True, padx=10, pady=5)
+        scrollbar = tk.Scrollbar(frame)
+        scrollbar.pack(side="right", fill="y")
+        self.listbox = tk.Listbox(frame, width=60, height=15, selectmode=tk.EXTENDED,
+                                  yscrollcommand=scrollbar.set)
+        self.listbox.pack(side="left", fill="both", expand=True)
+        scrollbar.config(command=self.listbox.yview)
+        self.listbox.insert(tk.END, *(format_song(song) for song in songs))
+
+        buttons = tk.Frame(self)
+        buttons.pack(fill="x", padx=10, pady=5)
+        tk.Button(buttons, text="Close", command=self.destroy).pack(side="right")
+        if on_add is not None:
+            tk.Button(buttons, text="Add Selected to Playlist",
+                      command=self.add_selected).pack(side="right", padx=5)
+
+    def add_selected(self):
+        song_ids = [self.songs[i]["id"] for i in self.listbox.curselection()]
+        if not song_ids:
+            messagebox.showinfo("Select Song", "Select the songs to add.", parent=self)
+            return
+        self.on_add(song_ids)
+        self.destroy()
+
 
 # -------------------------- PLAYLISTS TAB -------------------------- #
 
 class PlaylistsTab(tk.Frame):
     """Playlists tab: manage playlists and their songs."""
 
-    def __init__(self, master, library_tab: LibraryTab, *args, **kwargs):
+    def __init__(self, master, db: DbWorker, library_tab: LibraryTab, *args, **kwargs):
         super().__init__(master, *args, **kwargs)
 
+        self.db = db
         self.library_tab = library_tab
 
-        # list of dicts: {'id', 'name'}
+        # list of dicts: {'id', 'name', 'smart'}
         self.playlists = []
         self.selected_playlist_id = None
 
-        # list of dicts: {'id', 'name', 'artist', 'genre'}
-        self.playlist_songs = []
+        # The song last clicked in the open playlist.
+        self.selected_song = None
 
         self._build_layout()
         self.refresh_playlists()
@@ -268,12 +1282,14 @@ class PlaylistsTab(tk.Frame):
         scrollbar_pl = tk.Scrollbar(left_frame)
         scrollbar_pl.pack(side="right", fill="y")
 
-        self.playlist_listbox = tk.Listbox(left_frame, height=12)
+        self.playlist_listbox = tk.Listbox(left_frame, height=12, selectmode=tk.EXTENDED,
+                                           exportselection=False)
         self.playlist_listbox.pack(side="left", fill="y")
         self.playlist_listbox.config(yscrollcommand=scrollbar_pl.set)
         scrollbar_pl.config(command=self.playlist_listbox.yview)
 
         self.playlist_listbox.bind("<<ListboxSelect>>", self.on_playlist_select)
+        self.playlist_view = ListView(self.playlist_listbox, format_playlist, key=sort_key)
 
         ctrl_frame = tk.Frame(left_frame)
         ctrl_frame.pack(fill="x", pady=5)
@@ -283,21 +1299,36 @@ class PlaylistsTab(tk.Frame):
         self.entry_playlist_name.pack(anchor="w", padx=5, pady=2)
 
         btn_add_pl = tk.Button(ctrl_frame, text="Create Playlist", command=self.create_playlist)
+        btn_copy_pl = tk.Button(ctrl_frame, text="Copy Playlist", command=self.copy_playlist)
+        btn_merge_pl = tk.Button(ctrl_frame, text="Merge Selected Playlists",
+                                 command=self.merge_selected_playlists)
         btn_del_pl = tk.Button(ctrl_frame, text="Delete Playlist", command=self.delete_playlist)
+        btn_smart_pl = tk.Button(ctrl_frame, text="New Smart Playlist...",
+                                 command=self.create_smart_playlist)
+        btn_rules_pl = tk.Button(ctrl_frame, text="Edit Rules...", command=self.edit_rules)
         btn_add_pl.pack(anchor="w", padx=5, pady=2)
+        btn_copy_pl.pack(anchor="w", padx=5, pady=2)
+        btn_merge_pl.pack(anchor="w", padx=5, pady=2)
         btn_del_pl.pack(anchor="w", padx=5, pady=2)
+        btn_smart_pl.pack(anchor="w", padx=5, pady=2)
+        btn_rules_pl.pack(anchor="w", padx=5, pady=2)
 
         # right side: songs in playlist
         right_frame = tk.LabelFrame(self, text="Songs in Selected Playlist")
         right_frame.pack(side="left", fill="both", expand=True, padx=10, pady=5)
 
-        scrollbar_ps = tk.Scrollbar(right_frame)
-        scrollbar_ps.pack(side="right", fill="y")
+        # Paged like the library: only the visible rows are loaded.
+        self.song_list = VirtualList(right_frame, format_song, on_select=self.on_song_select,
+                                     height=12, activestyle="underline")
+        self.song_list.pack(fill="both", expand=True)
 
-        self.playlist_song_listbox = tk.Listbox(right_frame, height=12)
-        self.playlist_song_listbox.pack(side="left", fill="both", expand=True)
-        self.playlist_song_listbox.config(yscrollcommand=scrollbar_ps.set)
-        scrollbar_ps.config(command=self.playlist_song_listbox.yview)
+        # Drag a song to reorder the playlist.
+        self._drag_index = None
+        self._drag_song = None
+        listbox = self.song_list.listbox
+        listbox.bind("<ButtonPress-1>", self._on_drag_start, add="+")
+        listbox.bind("<B1-Motion>", self._on_drag_motion)
+        listbox.bind("<ButtonRelease-1>", self._on_drag_drop, add="+")
 
         # buttons under playlist songs
         btn_frame = tk.Frame(self)
@@ -305,66 +1336,264 @@ class PlaylistsTab(tk.Frame):
 
         btn_add_song_to_pl = tk.Button(
             btn_frame,
-            text="Add Selected Library Song to Playlist",
+            text="Add Selected Library Songs to Playlist",
             command=self.add_selected_library_song_to_playlist,
         )
+        btn_add_results_to_pl = tk.Button(
+            btn_frame,
+            text="Add All Search Results",
+            command=self.add_search_results_to_playlist,
+        )
         btn_remove_song_from_pl = tk.Button(
             btn_frame,
-            text="Remove Selected Song from Playlist",
+            text="Remove Selected Songs from Playlist",
             command=self.remove_selected_song_from_playlist,
         )
+        btn_similar = tk.Button(btn_frame, text="Similar Songs...", command=self.show_similar_songs)
+        btn_extend = tk.Button(btn_frame, text="Extend Playlist...", command=self.extend_playlist)
 
         btn_add_song_to_pl.pack(side="left", padx=5)
+        btn_add_results_to_pl.pack(side="left", padx=5)
         btn_remove_song_from_pl.pack(side="left", padx=5)
+        btn_similar.pack(side="left", padx=5)
+        btn_extend.pack(side="left", padx=5)
 
     # playlist helpers
 
     def refresh_playlists(self):
-        try:
-            self.playlists = fetch_all_playlists()
-            self.playlist_listbox.delete(0, tk.END)
-            for pl in self.playlists:
-                self.playlist_listbox.insert(tk.END, pl["name"])
+        self.db.submit(
+            get_all_playlists,
+            channel="playlists",
+            on_done=self._show_playlists,
+            on_error=show_error("Failed to load playlists"),
+        )
+
+    def _show_playlists(self, playlists):
+        self.playlists = playlists
+        self.playlist_view.update(playlists)
+
+        # Keep the open playlist if it still exists.
+        if all(pl["id"] != self.selected_playlist_id for pl in playlists):
             self.selected_playlist_id = None
-            self.playlist_song_listbox.delete(0, tk.END)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to load playlists:\n{e}")
+            self.refresh_playlist_songs()
+
+    def _is_smart(self, playlist_id):
+        return any(pl["id"] == playlist_id and pl["smart"] for pl in self.playlists)
+
+    def _check_editable(self):
+        """False (after saying why) when the open playlist is a smart one."""
+        if self._is_smart(self.selected_playlist_id):
+            messagebox.showinfo(
+                "Smart Playlist",
+                "Smart playlists are filled by their rules. Use Edit Rules..., "
+                "or copy the playlist to edit its songs by hand.",
+            )
+            return False
+        return True
+
+    def get_selected_playlist_ids(self):
+        return [self.playlists[i]["id"] for i in self.playlist_listbox.curselection()]
 
     def on_playlist_select(self, event):
-        try:
-            index = self.playlist_listbox.curselection()[0]
-        except IndexError:
+        selection = self.playlist_listbox.curselection()
+        if not selection:
             return
+        # Open the row just clicked; Ctrl/Shift-click only adds to the selection.
+        index = self.playlist_listbox.index(tk.ACTIVE)
+        if index not in selection:
+            index = selection[0]
         pl = self.playlists[index]
-        self.selected_playlist_id = pl["id"]
-        self.refresh_playlist_songs()
-
-    def refresh_playlist_songs(self):
+        if pl["id"] != self.selected_playlist_id:
+            self.selected_playlist_id = pl["id"]
+            self.refresh_playlist_songs(keep_position=False)
+
+    @staticmethod
+    def _load_playlist(playlist_id, top):
+        # Runs on a worker: count plus the page about to be shown, like
+        # LibraryTab._load_library.
+        source = PlaylistSongSource(playlist_id)
+        source.rows(top, PAGE_SIZE)
+        return source
+
+    def refresh_playlist_songs(self, keep_position=True):
+        """
+        Reloads the open playlist's count and visible page. With
+        keep_position (the same playlist, after a write), the scroll
+        position and selection stay, and ListView rewrites only the rows
+        that changed.
+        """
         if self.selected_playlist_id is None:
-            self.playlist_song_listbox.delete(0, tk.END)
+            self.db.cancel("playlist_songs")
+            self.selected_song = None
+            self.song_list.set_source(ListSource([]))
+            return
+        # Switching playlists quickly discards the older, still-running load.
+        self.db.submit(
+            self._load_playlist,
+            self.selected_playlist_id,
+            self.song_list.top if keep_position else 0,
+            channel="playlist_songs",
+            on_done=lambda source: self._show_playlist_songs(source, keep_position),
+            on_error=show_error("Failed to load playlist songs"),
+        )
+
+    def _show_playlist_songs(self, source, keep_position):
+        if not keep_position:
+            self.selected_song = None
+        source.attach(self.db, self.song_list.render)
+        self.song_list.set_source(source, keep_position=keep_position, keep_selection=keep_position)
+
+    def on_song_select(self, song):
+        self.selected_song = song
+
+    def apply_changes(self, changes):
+        """
+        Redraws what writes by other processes or Maintenance touched (see
+        ChangeFeed.py), row by row through the VirtualList's ListView.
+        """
+        if changes["playlists"]:
+            self.refresh_playlists()
+        playlist_id = self.selected_playlist_id
+        if playlist_id is None:
+            return
+        # Songs added, removed or moved, smart playlists' included: reload
+        # the visible page. A renumbering keeps the rows but moves the
+        # (position, id) cursors cached pages seek from, so it does too.
+        if playlist_id in changes["playlist_songs"] or playlist_id in changes["playlist_order"]:
+            self.refresh_playlist_songs()
+        elif changes["songs"] and isinstance(self.song_list.source, PagedSongSource):
+            # Only edits of songs it holds: patch the cached rows in place.
+            self.song_list.source.patch(changes["songs"])
+            self.song_list.render()
+
+    # drag to reorder
+
+    def _on_drag_start(self, event):
+        self._drag_index = None
+        if event.state & (0x0001 | 0x0004):
+            return  # Shift/Ctrl-click: leave extended selection alone
+        index = self.song_list.listbox.nearest(event.y)
+        if 0 <= index < len(self.song_list.window) and self.song_list.window[index]["id"] is not None:
+            # Absolute row numbers, as move_song_in_playlist takes.
+            self._drag_index = self.song_list.top + index
+            self._drag_song = self.song_list.window[index]
+
+    def _on_drag_motion(self, event):
+        if self._drag_index is None:
+            return None
+        # Underline the drop target instead of extending the selection.
+        self.song_list.listbox.activate(self.song_list.listbox.nearest(event.y))
+        return "break"
+
+    def _on_drag_drop(self, event):
+        start, self._drag_index = self._drag_index, None
+        if start is None or self.selected_playlist_id is None:
+            return
+        if self._is_smart(self.selected_playlist_id):
+            return  # kept in library order
+        target = self.song_list.top + self.song_list.listbox.nearest(event.y)
+        if target == start or not 0 <= target < len(self.song_list.source):
             return
-        try:
-            self.playlist_songs = fetch_songs_for_playlist(self.selected_playlist_id)
-            self.playlist_song_listbox.delete(0, tk.END)
-            for song in self.playlist_songs:
-                display = f"{song['name']} — {song['artist']} [{song['genre']}]"
-                self.playlist_song_listbox.insert(tk.END, display)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to load playlist songs:\n{e}")
+
+        playlist_id = self.selected_playlist_id
+
+        def done(_result):
+            if playlist_id == self.selected_playlist_id:
+                # One page, not the playlist; only the rows that moved are redrawn.
+                self.refresh_playlist_songs()
+
+        # Dropping on row N puts the song where row N is now.
+        self.db.submit(
+            move_song_in_playlist, playlist_id, self._drag_song["id"], target,
+            on_done=done,
+            on_error=show_error("Failed to move song"),
+        )
 
     # playlist actions
 
+    def _after_write(self, refresh):
+        """
+        on_done for this tab's writes: refresh(), and the Library tab's
+        Song Details, as ChangeFeed skips the app's own writes.
+        """
+        def done(_result=None):
+            refresh()
+            self.library_tab.playlists_changed()
+        return done
+
     def create_playlist(self):
         name = self.entry_playlist_name.get().strip()
         if not name:
             messagebox.showwarning("Validation", "Playlist name cannot be empty.")
             return
-        try:
-            create_playlist(name)
+
+        def done(_playlist_id):
+            self.entry_playlist_name.delete(0, tk.END)
+            self.refresh_playlists()
+
+        self.db.submit(
+            create_playlist, name,
+            on_done=done,
+            on_error=show_error("Failed to create playlist"),
+        )
+
+    def create_smart_playlist(self):
+        SmartPlaylistDialog(self, self.db, on_saved=self._after_write(self.refresh_playlists))
+
+    def edit_rules(self):
+        playlist_id = self.selected_playlist_id
+        if not self._is_smart(playlist_id):
+            messagebox.showinfo("Select Playlist", "Select a smart playlist to edit its rules.")
+            return
+
+        def refresh():
+            self.refresh_playlists()
+            if playlist_id == self.selected_playlist_id:
+                self.refresh_playlist_songs()
+
+        saved = self._after_write(refresh)
+        self.db.submit(
+            get_playlist_rules, playlist_id,
+            on_done=lambda rules: SmartPlaylistDialog(self, self.db, saved, playlist_id, rules),
+            on_error=show_error("Failed to load rules"),
+        )
+
+    def copy_playlist(self):
+        if self.selected_playlist_id is None:
+            messagebox.showinfo("Select Playlist", "Select a playlist to copy.")
+            return
+
+        name = self.entry_playlist_name.get().strip()
+        if not name:
+            current = next(pl["name"] for pl in self.playlists if pl["id"] == self.selected_playlist_id)
+            name = f"{current} (copy)"
+
+        def refresh():
             self.entry_playlist_name.delete(0, tk.END)
             self.refresh_playlists()
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to create playlist:\n{e}")
+
+        self.db.submit(
+            copy_playlist, self.selected_playlist_id, name,
+            on_done=self._after_write(refresh),
+            on_error=show_error("Failed to copy playlist"),
+        )
+
+    def merge_selected_playlists(self):
+        sources = [i for i in self.get_selected_playlist_ids() if i != self.selected_playlist_id]
+        if self.selected_playlist_id is None or not sources:
+            messagebox.showinfo(
+                "Select Playlists",
+                "Open the target playlist, then Ctrl-click the playlists to merge into it.",
+            )
+            return
+        if not self._check_editable():
+            return
+
+        self.db.submit(
+            merge_playlists, self.selected_playlist_id, sources,
+            on_done=self._after_write(self.refresh_playlist_songs),
+            on_error=show_error("Failed to merge playlists"),
+        )
 
     def delete_playlist(self):
         if self.selected_playlist_id is None:
@@ -374,51 +1603,261 @@ class PlaylistsTab(tk.Frame):
         if not messagebox.askyesno("Confirm", "Delete this playlist and its song links?"):
             return
 
-        try:
-            delete_playlist(self.selected_playlist_id)
-            self.refresh_playlists()
-            self.playlist_song_listbox.delete(0, tk.END)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to delete playlist:\n{e}")
+        self.db.submit(
+            delete_playlist, self.selected_playlist_id,
+            on_done=self._after_write(self.refresh_playlists),
+            on_error=show_error("Failed to delete playlist"),
+        )
 
     def add_selected_library_song_to_playlist(self):
         if self.selected_playlist_id is None:
             messagebox.showinfo("Select Playlist", "Select a playlist first.")
             return
+        if not self._check_editable():
+            return
 
-        song_id = self.library_tab.get_selected_song_id()
-        if song_id is None:
-            messagebox.showinfo("Select Song", "Select a song from the Library tab.")
+        songs = self.library_tab.get_selected_songs()
+        if not songs:
+            messagebox.showinfo("Select Song", "Select songs from the Library tab.")
             return
 
-        try:
-            add_song_to_playlist(self.selected_playlist_id, song_id)
-            self.refresh_playlist_songs()
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to add song to playlist:\n{e}")
+        # Songs of other libraries are linked in as they are added.
+        self.db.submit(
+            Libraries.add_to_playlist, self.selected_playlist_id, songs,
+            on_done=self._after_write(self.refresh_playlist_songs),
+            on_error=show_error("Failed to add songs to playlist"),
+        )
+
+    def add_search_results_to_playlist(self):
+        if self.selected_playlist_id is None:
+            messagebox.showinfo("Select Playlist", "Select a playlist first.")
+            return
+        if not self._check_editable():
+            return
+
+        search = self.library_tab.current_search
+        if search is None:
+            messagebox.showinfo("Search", "Run a search in the Library tab first.")
+            return
+        keyword, field, everywhere = search
+
+        playlist_id = self.selected_playlist_id
+        if everywhere:
+            task = lambda: Libraries.add_to_playlist(
+                playlist_id, Libraries.search_songs(keyword, (field,), limit=None)
+            )
+        elif field == "fuzzy":
+            task = lambda: add_songs_to_playlist(
+                playlist_id, [song["id"] for song in search_songs_fuzzy(keyword, limit=None)]
+            )
+        else:
+            task = lambda: add_search_results_to_playlist(playlist_id, keyword, (field,))
+        self.db.submit(
+            task,
+            on_done=self._after_write(self.refresh_playlist_songs),
+            on_error=show_error("Failed to add search results to playlist"),
+        )
 
     def remove_selected_song_from_playlist(self):
         if self.selected_playlist_id is None:
             messagebox.showinfo("Select Playlist", "Select a playlist first.")
             return
+        if not self._check_editable():
+            return
 
-        try:
-            index = self.playlist_song_listbox.curselection()[0]
-        except IndexError:
-            messagebox.showinfo("Select Song", "Select a song from the playlist list.")
+        song_ids = self.song_list.get_selected_ids()
+        if not song_ids:
+            messagebox.showinfo("Select Song", "Select songs from the playlist list.")
+            return
+
+        if not messagebox.askyesno("Confirm", f"Remove {len(song_ids)} song(s) from the playlist?"):
+            return
+
+        self.db.submit(
+            remove_songs_from_playlist, self.selected_playlist_id, song_ids,
+            on_done=self._after_write(self.refresh_playlist_songs),
+            on_error=show_error("Failed to remove songs from playlist"),
+        )
+
+    # recommendations
+
+    def _show_recommendations(self, title, songs):
+        if not songs:
+            messagebox.showinfo(title, "No songs share playlists with these yet.")
             return
 
-        song = self.playlist_songs[index]
-        song_id = song["id"]
+        on_add = None
+        playlist_id = self.selected_playlist_id
+        if playlist_id is not None and not self._is_smart(playlist_id):
+            on_add = lambda song_ids: self._add_recommended(playlist_id, song_ids)
+        RecommendationsDialog(self, title, songs, on_add)
+
+    def _add_recommended(self, playlist_id, song_ids):
+        self.db.submit(
+            add_songs_to_playlist, playlist_id, song_ids,
+            on_done=self._after_write(self.refresh_playlist_songs),
+            on_error=show_error("Failed to add songs to playlist"),
+        )
 
-        if not messagebox.askyesno("Confirm", "Remove this song from the playlist?"):
+    def show_similar_songs(self):
+        # A song picked in the open playlist, else the Library tab's selection.
+        song = self.selected_song
+        if song is not None and song["id"] in self.song_list.selected_ids:
+            song_id, title = song["id"], f"Similar to {song['name']}"
+        else:
+            song_id, title = self.library_tab.get_selected_song_id(), "Similar Songs"
+        if song_id is None:
+            messagebox.showinfo("Select Song", "Select a song in the playlist or the Library tab.")
             return
 
+        self.db.submit(
+            get_similar_songs, song_id,
+            channel="recommendations",
+            on_done=lambda songs: self._show_recommendations(title, songs),
+            on_error=show_error("Failed to find similar songs"),
+        )
+
+    def extend_playlist(self):
+        if self.selected_playlist_id is None:
+            messagebox.showinfo("Select Playlist", "Select a playlist first.")
+            return
+
+        self.db.submit(
+            get_playlist_extension, self.selected_playlist_id,
+            channel="recommendations",
+            on_done=lambda songs: self._show_recommendations("Extend Playlist", songs),
+            on_error=show_error("Failed to find songs for the playlist"),
+        )
+
+
+# ---------------------------- DIAGNOSTICS TAB ---------------------------- #
+
+class DiagnosticsTab(tk.Frame):
+    """Per-statement query timings from QueryStats (hidden; Ctrl+Shift+D)."""
+
+    COLUMNS = (
+        ("calls", "Calls", 60),
+        ("total_ms", "Total ms", 80),
+        ("mean_ms", "Mean ms", 70),
+        ("p95_ms", "p95 ms", 60),
+        ("max_ms", "Max ms", 70),
+        ("rows", "Rows", 80),
+        ("full_scans", "Full scans", 75),
+    )
+
+    def __init__(self, master, *args, **kwargs):
+        super().__init__(master, *args, **kwargs)
+        self.order_by = "total_ms"
+        self._build_controls()
+        self._build_stats()
+        self._build_slow_log()
+        self._refresh_loop()
+
+    def _build_controls(self):
+        frame = tk.Frame(self)
+        frame.pack(fill="x", padx=10, pady=5)
+
+        tk.Label(frame, text="Slow query threshold (ms):").pack(side="left")
+        self.threshold = tk.StringVar(value=f"{get_slow_query_threshold():g}")
+        entry = tk.Entry(frame, textvariable=self.threshold, width=8)
+        entry.pack(side="left", padx=5)
+        entry.bind("<Return>", lambda e: self.apply_threshold())
+        tk.Button(frame, text="Apply", command=self.apply_threshold).pack(side="left", padx=5)
+
+        tk.Button(frame, text="Reset Stats", command=self.reset).pack(side="right", padx=5)
+        tk.Button(frame, text="Refresh", command=self.refresh).pack(side="right", padx=5)
+
+    def _build_stats(self):
+        frame = tk.LabelFrame(self, text="Statements")
+        frame.pack(fill="both", expand=True, padx=10, pady=5)
+
+        columns = [name for name, _, _ in self.COLUMNS] + ["sql"]
+        self.tree = ttk.Treeview(frame, columns=columns, show="headings", height=12)
+        for name, heading, width in self.COLUMNS:
+            self.tree.heading(name, text=heading, command=lambda n=name: self.sort_by(n))
+            self.tree.column(name, width=width, anchor="e", stretch=False)
+        self.tree.heading("sql", text="Statement")
+        self.tree.column("sql", width=400)
+        self.tree.bind("<<TreeviewSelect>>", lambda e: self._show_details())
+
+        scrollbar = tk.Scrollbar(frame, orient="vertical", command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree.pack(side="left", fill="both", expand=True)
+        scrollbar.pack(side="right", fill="y")
+
+        self.details = tk.Text(self, height=6, wrap="word", state="disabled")
+        self.details.pack(fill="x", padx=10, pady=5)
+
+    def _build_slow_log(self):
+        frame = tk.LabelFrame(self, text="Slow Queries")
+        frame.pack(fill="both", padx=10, pady=5)
+
+        self.slow_listbox = tk.Listbox(frame, height=6)
+        self.slow_listbox.pack(fill="both", expand=True)
+
+    # Actions
+
+    def apply_threshold(self):
         try:
-            remove_song_from_playlist(self.selected_playlist_id, song_id)
-            self.refresh_playlist_songs()
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to remove song from playlist:\n{e}")
+            set_slow_query_threshold(float(self.threshold.get()))
+        except ValueError:
+            messagebox.showwarning("Invalid Threshold", "Enter the threshold in milliseconds.")
+
+    def reset(self):
+        reset_query_stats()
+        self.refresh()
+
+    def sort_by(self, column):
+        self.order_by = column
+        self.refresh()
+
+    # Display
+
+    def _refresh_loop(self):
+        if self.winfo_ismapped():
+            self.refresh()
+        self.after(DIAGNOSTICS_REFRESH_MS, self._refresh_loop)
+
+    def refresh(self):
+        self.stats = {row["sql"]: row for row in get_query_stats(self.order_by)}
+
+        # Update rows in place so the selection and scroll position survive.
+        for iid in set(self.tree.get_children()) - set(self.stats):
+            self.tree.delete(iid)
+        for index, (sql, row) in enumerate(self.stats.items()):
+            values = [
+                f"{row[name]:.2f}" if isinstance(row[name], float) else row[name]
+                for name, _, _ in self.COLUMNS
+            ] + [sql]
+            if self.tree.exists(sql):
+                self.tree.item(sql, values=values)
+                self.tree.move(sql, "", index)
+            else:
+                self.tree.insert("", index, iid=sql, values=values)
+
+        self.slow_listbox.delete(0, tk.END)
+        for entry in get_slow_queries():
+            self.slow_listbox.insert(
+                tk.END,
+                f"{entry['ms']:8.1f} ms  {entry['rows']:>7} rows  "
+                f"{'SCAN  ' if entry['full_scan'] else ''}{entry['sql']}  {entry['params']}",
+            )
+        self._show_details()
+
+    def _show_details(self):
+        selection = self.tree.selection()
+        row = self.stats.get(selection[0]) if selection else None
+
+        self.details.configure(state="normal")
+        self.details.delete("1.0", tk.END)
+        if row is not None:
+            labels = [f"<={bound}" for bound in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}"]
+            histogram = ", ".join(
+                f"{label}: {count}" for label, count in zip(labels, row["histogram"]) if count
+            )
+            plan = "\n".join(row["plan"] or ()) or "(no plan)"
+            self.details.insert(tk.END, f"{row['sql']}\n\nPlan:\n{plan}\n\nLatency ms: {histogram}")
+        self.details.configure(state="disabled")
 
 
 # ---------------------------- MAIN APP ---------------------------- #
@@ -428,22 +1867,68 @@ class MusicOrganizerApp:
         self.root = root
         self.root.title("Music Organizer")
 
+        # All SQL runs on this worker pool, never on the Tk thread.
+        self.db = DbWorker(root)
+        # Follows writes from other processes and Maintenance; started before the tabs load.
+        self.changes = ChangeFeed(root, self.db, self.apply_changes, self.reload)
+        # Indexes and refreshes what writes queue, away from the reads.
+        self.maintenance = Maintenance().start()
+
         notebook = ttk.Notebook(root)
         notebook.pack(fill="both", expand=True)
 
-        self.library_tab = LibraryTab(notebook)
-        self.playlists_tab = PlaylistsTab(notebook, self.library_tab)
+        # Song edits can change the open playlist's rows.
+        self.library_tab = LibraryTab(notebook, self.db,
+                                      on_write=lambda: self.playlists_tab.refresh_playlist_songs())
+        self.playlists_tab = PlaylistsTab(notebook, self.db, self.library_tab)
 
         notebook.add(self.library_tab, text="Library")
         notebook.add(self.playlists_tab, text="Playlists")
 
+        # Query timings for tracking down slow screens; Ctrl+Shift+D shows it.
+        self.notebook = notebook
+        self.diagnostics_tab = DiagnosticsTab(notebook)
+        notebook.add(self.diagnostics_tab, text="Diagnostics")
+        notebook.hide(self.diagnostics_tab)
+        root.bind("<Control-Shift-D>", self.toggle_diagnostics)
+
+    def apply_changes(self, changes):
+        self.library_tab.apply_changes(changes)
+        self.playlists_tab.apply_changes(changes)
+
+    def reload(self):
+        self.library_tab.reload()
+        self.playlists_tab.refresh_playlists()
+        self.playlists_tab.refresh_playlist_songs()
+
+    def toggle_diagnostics(self, event=None):
+        if self.notebook.tab(self.diagnostics_tab, "state") == "hidden":
+            self.notebook.add(self.diagnostics_tab)
+            self.notebook.select(self.diagnostics_tab)
+            self.diagnostics_tab.refresh()
+        else:
+            self.notebook.hide(self.diagnostics_tab)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if "--serve" in argv:
+        # Headless: the HTTP/JSON API instead of the window (see Server.py).
+        import Server
+        return Server.main([arg for arg in argv if arg != "--serve"])
 
-def main():
     init_db()
     root = tk.Tk()
     app = MusicOrganizerApp(root)
-    root.mainloop()
+    try:
+        root.mainloop()
+    finally:
+        app.changes.stop()
+        app.maintenance.stop()
+        app.db.shutdown()
+        Libraries.close_workers()
+        close_connection()
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
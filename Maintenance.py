@@ -0,0 +1,67 @@
+"""
+Runs the work writes leave queued, off the paths that read.
+
+Triggers queue the follow-up work of a write (new words for the fuzzy
+search index, and so on) instead of doing it inline. Maintenance runs it
+with Database.run_maintenance on a thread of its own, soon after any
+connection, in this process or another, commits. Searches and listings
+use the derived data as it stands and never wait for it; each step
+commits in short batches, so writers do not wait long either.
+
+The app and the server each start one. Several running on one database
+do no harm: the queues are drained under the write lock.
+"""
+
+import logging
+import sqlite3
+import threading
+
+import Database
+
+log = logging.getLogger("Maintenance")
+
+# How often, in seconds, the thread checks PRAGMA data_version.
+MAINTENANCE_POLL_S = 0.5
+
+# How long stop() waits for a run in progress. Anything left over stays
+# queued for the next run, as the batches commit one by one.
+MAINTENANCE_STOP_S = 2.0
+
+
+class Maintenance:
+    def __init__(self, poll_s=MAINTENANCE_POLL_S):
+        self.poll_s = poll_s
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="maintenance", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=MAINTENANCE_STOP_S):
+        """Ends the thread, waiting up to timeout seconds for a run in progress."""
+        self._stopping.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            data_version = Database.data_version_watcher()
+            version = None  # so the first check runs whatever is queued
+            while not self._stopping.is_set():
+                current = data_version()
+                if current != version:
+                    version = current
+                    try:
+                        Database.run_maintenance()
+                    except sqlite3.OperationalError as e:
+                        # Usually a busy database; try again on the next poll.
+                        log.warning("Maintenance deferred: %s", e)
+                        version = None
+                    except Exception:
+                        # E.g. a stored rule that no longer compiles. Keep
+                        # polling: the next commit tries again.
+                        log.exception("Maintenance failed")
+                self._stopping.wait(self.poll_s)
+        finally:
+            Database.close_connection()
@@ -0,0 +1,312 @@
+"""
+Per-statement query instrumentation.
+
+Database.py opens its connections with InstrumentedConnection, whose
+cursors time every statement from execute() until its rows have been
+fetched and record, per distinct SQL text:
+
+- call count, total/max latency and a latency histogram,
+- rows returned (or changed, for writes),
+- how many calls ran a plan that scans a whole table or index. EXPLAIN
+  QUERY PLAN is run only the first time a statement is seen, so this
+  costs one extra query per distinct statement, not per call.
+
+Calls slower than SLOW_QUERY_MS are logged through the "QueryStats"
+logger and kept in a short list for the Diagnostics tab. executemany()
+calls are judged by their time per parameter set, so a bulk write is not
+reported just for being large.
+
+The overhead is a few microseconds per statement, so it stays on.
+"""
+
+import logging
+import re
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+log = logging.getLogger("QueryStats")
+
+# Calls slower than this (milliseconds) go to the slow-query log.
+SLOW_QUERY_MS = 100.0
+
+# Slow calls kept for get_slow_queries().
+SLOW_LOG_SIZE = 200
+
+# Upper bounds (milliseconds) of the latency histogram buckets; the last
+# bucket counts everything slower.
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# Distinct statements tracked; further ones are counted under OTHER.
+MAX_STATEMENTS = 1000
+OTHER = "(other statements)"
+
+# Statements worth asking the planner about.
+_EXPLAINABLE = re.compile(r"\s*(SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE)\b", re.IGNORECASE)
+
+# A plan step that reads every row of a table or index (rather than
+# searching it); virtual tables, subqueries and constant rows don't count.
+_FULL_SCAN = re.compile(r"^SCAN (?!CONSTANT ROW)(?!\()(?!\S+ VIRTUAL TABLE)")
+
+# Placeholder lists like "IN (?, ?, ?)" vary in length; track them as one.
+_PLACEHOLDER_RUN = re.compile(r"\?(?:\s*,\s*\?)+")
+
+
+def normalize(sql):
+    return _PLACEHOLDER_RUN.sub("?, ...", " ".join(sql.split()))
+
+
+class StatementStats:
+    __slots__ = ("sql", "calls", "total_ms", "max_ms", "rows", "full_scans",
+                 "histogram", "plan", "scans_table")
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.calls = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.full_scans = 0
+        self.histogram = [0] * (len(BUCKETS_MS) + 1)
+        self.plan = None          # EXPLAIN QUERY PLAN lines, once known
+        self.scans_table = False  # plan reads a whole table or index
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of calls."""
+        target = self.calls * fraction
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.histogram):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return self.max_ms
+
+    def as_dict(self):
+        return {
+            "sql": self.sql,
+            "calls": self.calls,
+            "total_ms": self.total_ms,
+            "mean_ms": self.total_ms / self.calls if self.calls else 0.0,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "max_ms": self.max_ms,
+            "rows": self.rows,
+            "full_scans": self.full_scans,
+            "plan": self.plan,
+            "histogram": list(self.histogram),
+        }
+
+
+_lock = threading.Lock()
+_statements = {}  # normalized sql -> StatementStats
+_by_sql = {}      # raw sql -> StatementStats, so normalize() runs once per text
+_slow = deque(maxlen=SLOW_LOG_SIZE)
+
+
+def _stats_for(sql):
+    stats = _by_sql.get(sql)
+    if stats is not None:
+        return stats
+
+    key = normalize(sql)
+    stats = _statements.get(key)
+    if stats is None:
+        with _lock:
+            stats = _statements.get(key)
+            if stats is None:
+                if len(_statements) >= MAX_STATEMENTS:
+                    key = OTHER
+                    stats = _statements.get(key)
+                if stats is None:
+                    stats = _statements[key] = StatementStats(key)
+            if len(_by_sql) < 4 * MAX_STATEMENTS:
+                _by_sql[sql] = stats
+    return stats
+
+
+def _explain(conn, stats, sql, params):
+    # Mark the plan as known first so concurrent callers don't repeat this.
+    stats.plan = ()
+    if stats.sql == OTHER or not _EXPLAINABLE.match(sql):
+        return
+    try:
+        cursor = sqlite3.Cursor(conn)
+        rows = cursor.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    except sqlite3.Error:
+        return
+    stats.plan = tuple(row[3] for row in rows)
+    stats.scans_table = any(_FULL_SCAN.match(line) for line in stats.plan)
+
+
+def _record(stats, elapsed_ms, rows, params, executions=1):
+    with _lock:
+        stats.calls += 1
+        stats.total_ms += elapsed_ms
+        stats.rows += rows
+        if elapsed_ms > stats.max_ms:
+            stats.max_ms = elapsed_ms
+        stats.histogram[bisect_left(BUCKETS_MS, elapsed_ms)] += 1
+        if stats.scans_table:
+            stats.full_scans += 1
+
+    if elapsed_ms >= SLOW_QUERY_MS * max(executions, 1):
+        entry = {
+            "time": time.time(),
+            "ms": elapsed_ms,
+            "rows": rows,
+            "sql": stats.sql,
+            "params": repr(params)[:200],
+            "full_scan": stats.scans_table,
+        }
+        _slow.append(entry)
+        log.warning("slow query (%.1f ms, %d rows): %s", elapsed_ms, rows, stats.sql)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    A call stays open while its rows are being fetched; it is recorded
+    when the rows run out, the cursor is reused or closed, or the cursor
+    is garbage collected.
+    """
+
+    _call = None  # [stats, elapsed ms, rows, params] of the open call
+
+    def execute(self, sql, params=()):
+        self._finish()
+        stats = _stats_for(sql)
+        if stats.plan is None:
+            _explain(self.connection, stats, sql, params)
+        start = time.perf_counter()
+        super().execute(sql, params)
+        elapsed = (time.perf_counter() - start) * 1000
+        if self.description is None:
+            # Not a query: nothing to fetch, rowcount is what it changed.
+            _record(stats, elapsed, max(self.rowcount, 0), params)
+        else:
+            self._call = [stats, elapsed, 0, params]
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._finish()
+        stats = _stats_for(sql)
+        executions = 0
+
+        def counted():
+            nonlocal executions
+            for params in seq_of_params:
+                executions += 1
+                yield params
+
+        start = time.perf_counter()
+        super().executemany(sql, counted())
+        _record(stats, (time.perf_counter() - start) * 1000, max(self.rowcount, 0), "(many)",
+                executions)
+        return self
+
+    def executescript(self, script):
+        self._finish()
+        stats = _stats_for(script)
+        start = time.perf_counter()
+        super().executescript(script)
+        _record(stats, (time.perf_counter() - start) * 1000, 0, ())
+        return self
+
+    def _fetched(self, start, rows, done):
+        call = self._call
+        if call is not None:
+            call[1] += (time.perf_counter() - start) * 1000
+            call[2] += rows
+            if done:
+                self._finish()
+
+    def _finish(self):
+        call = self._call
+        if call is not None:
+            self._call = None
+            _record(*call)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(start, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(start, len(rows), len(rows) < (self.arraysize if size is None else size))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(start, len(rows), True)
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(start, 0, True)
+            raise
+        self._fetched(start, 1, False)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        self._finish()
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection factory for sqlite3.connect(); see the module docstring."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # The C implementations bypass cursor().execute, so route them here.
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
+
+
+# ----- API ----- #
+
+def get_query_stats(order_by="total_ms"):
+    """Returns one dict per statement, most expensive first."""
+    with _lock:
+        rows = [stats.as_dict() for stats in _statements.values()]
+    rows.sort(key=lambda row: row[order_by], reverse=True)
+    return rows
+
+
+def get_slow_queries():
+    """Recent calls slower than SLOW_QUERY_MS, newest first."""
+    return list(reversed(_slow))
+
+
+def get_slow_query_threshold():
+    return SLOW_QUERY_MS
+
+
+def set_slow_query_threshold(ms):
+    global SLOW_QUERY_MS
+    SLOW_QUERY_MS = float(ms)
+
+
+def reset_query_stats():
+    with _lock:
+        _statements.clear()
+        _by_sql.clear()
+        _slow.clear()
@@ -0,0 +1,530 @@
+"""
+Builds the song library from the audio files under a music folder.
+
+Usage:
+    python Scanner.py ~/Music
+    python Scanner.py ~/Music --workers 8 --prune
+
+Tags (title, artist, genre) and duration are read from MP3 (ID3v1/v2),
+FLAC and Ogg Vorbis/Opus headers by a process pool. Scans are incremental:
+the path, mtime and size stored on each song act as the file index, so a
+re-scan only parses files that are new or changed since the last run.
+"""
+
+import argparse
+import os
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+
+from Database import (
+    init_db,
+    get_file_index,
+    upsert_scanned_songs,
+    delete_songs_by_paths,
+)
+
+AUDIO_EXTENSIONS = {".mp3", ".flac", ".ogg", ".oga", ".opus"}
+
+# Songs written per transaction.
+SCAN_BATCH_SIZE = 500
+
+# Below this many changed files the pool start-up costs more than it saves.
+MIN_PARALLEL_FILES = 64
+
+# Bytes read from the start/end of a file when looking for headers.
+HEAD_BYTES = 1 << 16
+TAIL_BYTES = 1 << 16
+
+ID3V1_GENRES = (
+    "Blues", "Classic Rock", "Country", "Dance", "Disco", "Funk", "Grunge",
+    "Hip-Hop", "Jazz", "Metal", "New Age", "Oldies", "Other", "Pop", "R&B",
+    "Rap", "Reggae", "Rock", "Techno", "Industrial", "Alternative", "Ska",
+    "Death Metal", "Pranks", "Soundtrack", "Euro-Techno", "Ambient",
+    "Trip-Hop", "Vocal", "Jazz+Funk", "Fusion", "Trance", "Classical",
+    "Instrumental", "Acid", "House", "Game", "Sound Clip", "Gospel", "Noise",
+    "AlternRock", "Bass", "Soul", "Punk", "Space", "Meditative",
+    "Instrumental Pop", "Instrumental Rock", "Ethnic", "Gothic", "Darkwave",
+    "Techno-Industrial", "Electronic", "Pop-Folk", "Eurodance", "Dream",
+    "Southern Rock", "Comedy", "Cult", "Gangsta", "Top 40", "Christian Rap",
+    "Pop/Funk", "Jungle", "Native American", "Cabaret", "New Wave",
+    "Psychadelic", "Rave", "Showtunes", "Trailer", "Lo-Fi", "Tribal",
+    "Acid Punk", "Acid Jazz", "Polka", "Retro", "Musical", "Rock & Roll",
+    "Hard Rock",
+)
+
+
+# ---------------------------------------------------------
+# TAG READERS
+# ---------------------------------------------------------
+
+def _id3_genre(value):
+    """Resolves ID3 numeric genre references like '(17)' or '17'."""
+    ref = value.strip("()")
+    if ref.isdigit() and int(ref) < len(ID3V1_GENRES):
+        return ID3V1_GENRES[int(ref)]
+    return value
+
+
+def _id3_text(data):
+    if not data:
+        return ""
+    encoding = {0: "latin-1", 1: "utf-16", 2: "utf-16-be", 3: "utf-8"}.get(data[0], "latin-1")
+    text = data[1:].decode(encoding, errors="replace")
+    # Multiple values are NUL-separated; keep the first.
+    return text.split("\x00")[0].strip()
+
+
+def _read_id3v2(f):
+    """Returns (tags, tag_size) for an ID3v2 tag at the start of the file."""
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b"ID3":
+        return {}, 0
+
+    major, flags = header[3], header[5]
+    size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+    data = f.read(size)
+    pos = 0
+
+    if flags & 0x40 and major >= 3:
+        # Skip the extended header.
+        ext = struct.unpack(">I", data[:4])[0]
+        if major == 4:
+            ext = (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+            pos = ext
+        else:
+            pos = ext + 4
+
+    if major == 2:
+        id_len, header_len = 3, 6
+        wanted = {b"TT2": "name", b"TP1": "artist", b"TCO": "genre"}
+    else:
+        id_len, header_len = 4, 10
+        wanted = {b"TIT2": "name", b"TPE1": "artist", b"TCON": "genre"}
+
+    tags = {}
+    while pos + header_len <= len(data) and len(tags) < len(wanted):
+        frame_id = data[pos:pos + id_len]
+        if not frame_id.strip(b"\x00"):
+            break  # padding
+        if major == 2:
+            frame_size = int.from_bytes(data[pos + 3:pos + 6], "big")
+        elif major == 4:
+            b = data[pos + 4:pos + 8]
+            frame_size = (b[0] << 21) | (b[1] << 14) | (b[2] << 7) | b[3]
+        else:
+            frame_size = struct.unpack(">I", data[pos + 4:pos + 8])[0]
+        body = data[pos + header_len:pos + header_len + frame_size]
+        if frame_id in wanted:
+            tags[wanted[frame_id]] = _id3_text(body)
+        pos += header_len + frame_size
+
+    if "genre" in tags:
+        tags["genre"] = _id3_genre(tags["genre"])
+    return tags, 10 + size
+
+
+def _read_id3v1(f, file_size):
+    if file_size < 128:
+        return {}
+    f.seek(file_size - 128)
+    data = f.read(128)
+    if data[:3] != b"TAG":
+        return {}
+
+    def text(raw):
+        return raw.split(b"\x00")[0].decode("latin-1").strip()
+
+    tags = {"name": text(data[3:33]), "artist": text(data[33:63])}
+    if data[127] < len(ID3V1_GENRES):
+        tags["genre"] = ID3V1_GENRES[data[127]]
+    return tags
+
+
+_MP3_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLE_RATES = {
+    1: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    2.5: (11025, 12000, 8000),
+}
+
+
+def _mp3_duration(f, audio_start, audio_end):
+    """Duration of an MPEG Layer III stream from its Xing/VBRI header or bitrate."""
+    f.seek(audio_start)
+    data = f.read(HEAD_BYTES)
+
+    for i in range(len(data) - 4):
+        if data[i] != 0xFF or data[i + 1] & 0xE0 != 0xE0:
+            continue
+        version_bits = (data[i + 1] >> 3) & 0x03
+        layer_bits = (data[i + 1] >> 1) & 0x03
+        bitrate_idx = data[i + 2] >> 4
+        rate_idx = (data[i + 2] >> 2) & 0x03
+        if version_bits == 1 or layer_bits != 1 or bitrate_idx in (0, 15) or rate_idx == 3:
+            continue  # not a valid Layer III header
+
+        version = {0: 2.5, 2: 2, 3: 1}[version_bits]
+        sample_rate = _MP3_SAMPLE_RATES[version][rate_idx]
+        bitrate = _MP3_BITRATES[1 if version == 1 else 2][bitrate_idx] * 1000
+        samples_per_frame = 1152 if version == 1 else 576
+        mono = (data[i + 3] >> 6) == 3
+
+        if version == 1:
+            side_info = 17 if mono else 32
+        else:
+            side_info = 9 if mono else 17
+
+        xing = i + 4 + side_info
+        if data[xing:xing + 4] in (b"Xing", b"Info"):
+            xing_flags = struct.unpack(">I", data[xing + 4:xing + 8])[0]
+            if xing_flags & 0x01:
+                frames = struct.unpack(">I", data[xing + 8:xing + 12])[0]
+                return frames * samples_per_frame / sample_rate
+
+        vbri = i + 4 + 32
+        if data[vbri:vbri + 4] == b"VBRI":
+            frames = struct.unpack(">I", data[vbri + 14:vbri + 18])[0]
+            return frames * samples_per_frame / sample_rate
+
+        # Assume constant bitrate.
+        return (audio_end - audio_start - i) * 8 / bitrate
+
+    return None
+
+
+def read_mp3(path):
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        tags, id3_size = _read_id3v2(f)
+        v1 = _read_id3v1(f, file_size)
+        for key, value in v1.items():
+            if not tags.get(key):
+                tags[key] = value
+        audio_end = file_size - (128 if v1 else 0)
+        tags["duration"] = _mp3_duration(f, id3_size, audio_end)
+    return tags
+
+
+_VORBIS_KEYS = {"TITLE": "name", "ARTIST": "artist", "GENRE": "genre"}
+
+
+def _parse_vorbis_comment(data):
+    """Parses a (possibly truncated) Vorbis comment block."""
+    tags = {}
+    try:
+        vendor_len = struct.unpack_from("<I", data, 0)[0]
+        pos = 4 + vendor_len
+        count = struct.unpack_from("<I", data, pos)[0]
+        pos += 4
+        for _ in range(count):
+            length = struct.unpack_from("<I", data, pos)[0]
+            pos += 4
+            entry = data[pos:pos + length].decode("utf-8", errors="replace")
+            pos += length
+            key, _, value = entry.partition("=")
+            field = _VORBIS_KEYS.get(key.upper())
+            if field and field not in tags:
+                tags[field] = value.strip()
+    except struct.error:
+        pass
+    return tags
+
+
+def read_flac(path):
+    tags = {}
+    with open(path, "rb") as f:
+        if f.read(4) != b"fLaC":
+            return tags
+        last = False
+        while not last:
+            header = f.read(4)
+            if len(header) < 4:
+                break
+            last = bool(header[0] & 0x80)
+            block_type = header[0] & 0x7F
+            length = int.from_bytes(header[1:4], "big")
+            if block_type == 0:  # STREAMINFO
+                info = f.read(length)
+                packed = int.from_bytes(info[10:18], "big")
+                sample_rate = packed >> 44
+                total_samples = packed & 0xFFFFFFFFF
+                if sample_rate:
+                    tags["duration"] = total_samples / sample_rate
+            elif block_type == 4:  # VORBIS_COMMENT
+                tags.update(_parse_vorbis_comment(f.read(length)))
+            else:
+                f.seek(length, os.SEEK_CUR)
+    return tags
+
+
+def _ogg_packets(data):
+    """Yields the complete packets found in a run of Ogg pages."""
+    pos = 0
+    packet = b""
+    while data[pos:pos + 4] == b"OggS":
+        segments = data[pos + 26]
+        table = data[pos + 27:pos + 27 + segments]
+        pos += 27 + segments
+        for lacing in table:
+            packet += data[pos:pos + lacing]
+            pos += lacing
+            if lacing < 255:
+                yield packet
+                packet = b""
+    if packet:
+        yield packet  # truncated; parsers cope with partial data
+
+
+def read_ogg(path):
+    tags = {}
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        head = f.read(HEAD_BYTES)
+        f.seek(max(0, file_size - TAIL_BYTES))
+        tail = f.read(TAIL_BYTES)
+
+    rate = None
+    pre_skip = 0
+    for packet in islice(_ogg_packets(head), 2):
+        if packet.startswith(b"\x01vorbis"):
+            rate = struct.unpack_from("<I", packet, 12)[0]
+        elif packet.startswith(b"OpusHead"):
+            pre_skip = struct.unpack_from("<H", packet, 10)[0]
+            rate = 48000  # Opus granules always count 48 kHz samples
+        elif packet.startswith(b"\x03vorbis"):
+            tags.update(_parse_vorbis_comment(packet[7:]))
+        elif packet.startswith(b"OpusTags"):
+            tags.update(_parse_vorbis_comment(packet[8:]))
+
+    last_page = tail.rfind(b"OggS")
+    if rate and last_page != -1 and last_page + 14 <= len(tail):
+        granule = struct.unpack_from("<q", tail, last_page + 6)[0]
+        if granule > 0:
+            tags["duration"] = (granule - pre_skip) / rate
+    return tags
+
+
+TAG_READERS = {
+    ".mp3": read_mp3,
+    ".flac": read_flac,
+    ".ogg": read_ogg,
+    ".oga": read_ogg,
+    ".opus": read_ogg,
+}
+
+
+def read_song(entry):
+    """
+    Worker: turns (path, mtime, size) into a song row for upsert_scanned_songs.
+    Unreadable tags fall back to the file name so the file is still listed.
+    Returns (row, error).
+    """
+    path, mtime, size = entry
+    error = None
+    try:
+        tags = TAG_READERS[Path(path).suffix.lower()](path)
+    except Exception as e:
+        # Any failure is this file's alone; raising would end the whole
+        # scan through pool.map.
+        tags = {}
+        error = f"{path}: {e}"
+
+    row = {
+        "path": path,
+        "name": tags.get("name") or Path(path).stem,
+        "artist": tags.get("artist", ""),
+        "genre": tags.get("genre", ""),
+        "mtime": mtime,
+        "size": size,
+        "duration": tags.get("duration"),
+    }
+    return row, error
+
+
+# ---------------------------------------------------------
+# SCANNING
+# ---------------------------------------------------------
+
+def _storable(path):
+    """False for paths that are not valid UTF-8 and so cannot be stored as text."""
+    try:
+        path.encode("utf-8")
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def _printable(path):
+    return path if _storable(path) else repr(os.fsencode(path))
+
+
+def walk_audio_files(root, on_error=None):
+    """
+    Yields (path, mtime, size) for every audio file under root.
+    on_error(path, error) is called for every folder that could not be
+    listed and every entry that could not be examined; the walk goes on
+    without them.
+    """
+    stack = [str(root)]
+    while stack:
+        folder = stack.pop()
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif os.path.splitext(entry.name)[1].lower() in AUDIO_EXTENSIONS:
+                            st = entry.stat()
+                            yield entry.path, st.st_mtime, st.st_size
+                    except OSError as e:
+                        if on_error is not None:
+                            on_error(entry.path, e)
+        except OSError as e:
+            if on_error is not None:
+                on_error(folder, e)
+
+
+def scan_library(root, workers=None, batch_size=SCAN_BATCH_SIZE, prune=False,
+                 progress=None, on_error=None):
+    """
+    Scans root and upserts new or changed audio files into songs.
+
+    Files whose path, mtime and size match the stored index are skipped
+    without being opened. prune=True also deletes songs whose file is gone.
+    progress(done, total) is called after each batch; on_error(message) for
+    files whose tags could not be read, for files skipped because their
+    path is not valid UTF-8, and for folders and files that could not be
+    examined at all. Songs under those are never pruned: an unreadable or
+    unmounted folder is not a deleted one.
+    Returns a dict of counts: seen, unchanged, updated, errors, removed.
+    """
+    root = Path(root).expanduser().resolve()
+    if not root.is_dir():
+        raise ValueError(f"Not a directory: {root}")
+    if not _storable(str(root)):
+        raise ValueError(f"Not a UTF-8 path: {os.fsencode(root)!r}")
+
+    known = get_file_index(root)
+    changed = []
+    seen = 0
+    skipped = 0
+    unreadable = []
+
+    def walk_error(path, error):
+        unreadable.append(path)
+        if on_error is not None:
+            on_error(f"{_printable(path)}: {error}")
+
+    for path, mtime, size in walk_audio_files(root, walk_error):
+        seen += 1
+        if not _storable(path):
+            skipped += 1
+            if on_error is not None:
+                on_error(f"{os.fsencode(path)!r}: file name is not valid UTF-8; skipped")
+            continue
+        if known.pop(path, None) != (mtime, size):
+            changed.append((path, mtime, size))
+
+    stats = {
+        "seen": seen,
+        "unchanged": seen - skipped - len(changed),
+        "updated": 0,
+        "errors": skipped + len(unreadable),
+        "removed": 0,
+    }
+
+    def store(results):
+        batch = []
+        for row, error in results:
+            if error:
+                stats["errors"] += 1
+                if on_error is not None:
+                    on_error(error)
+            batch.append(row)
+            if len(batch) >= batch_size:
+                upsert_scanned_songs(batch)
+                stats["updated"] += len(batch)
+                batch = []
+                if progress is not None:
+                    progress(stats["updated"], len(changed))
+        if batch:
+            upsert_scanned_songs(batch)
+            stats["updated"] += len(batch)
+            if progress is not None:
+                progress(stats["updated"], len(changed))
+
+    if len(changed) < MIN_PARALLEL_FILES or workers == 1:
+        store(map(read_song, changed))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunk = max(1, min(256, len(changed) // ((workers or os.cpu_count() or 1) * 4)))
+            store(pool.map(read_song, changed, chunksize=chunk))
+
+    if prune and unreadable:
+        # Keep what the walk could not see; its files may well be there.
+        failed = set(unreadable)
+        under = tuple(path + os.sep for path in failed)
+        known = {path: v for path, v in known.items()
+                 if path not in failed and not path.startswith(under)}
+
+    if prune and known:
+        # Whatever is left in the index was not found on disk.
+        delete_songs_by_paths(known)
+        stats["removed"] = len(known)
+
+    return stats
+
+
+# ---------------------------------------------------------
+# CLI
+# ---------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scan a music folder into the library.")
+    parser.add_argument("folder", help="root of the music folder to scan")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="tag reader processes (default: one per CPU)")
+    parser.add_argument("--batch-size", type=int, default=SCAN_BATCH_SIZE,
+                        help=f"songs per write transaction (default {SCAN_BATCH_SIZE})")
+    parser.add_argument("--prune", action="store_true",
+                        help="remove songs whose files no longer exist")
+    args = parser.parse_args(argv)
+
+    def progress(done, total):
+        print(f"\rRead {done:,}/{total:,} changed files...", end="", file=sys.stderr, flush=True)
+
+    def on_error(message):
+        print(f"\nCould not read: {message}", file=sys.stderr)
+
+    init_db()
+    try:
+        stats = scan_library(
+            args.folder,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            prune=args.prune,
+            progress=progress,
+            on_error=on_error,
+        )
+    except ValueError as e:
+        print(f"Scan failed: {e}", file=sys.stderr)
+        return 1
+
+    print(
+        f"\nDone: {stats['seen']:,} files, {stats['unchanged']:,} unchanged, "
+        f"{stats['updated']:,} added/updated, {stats['removed']:,} removed, "
+        f"{stats['errors']:,} unreadable.",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
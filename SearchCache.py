@@ -0,0 +1,118 @@
+"""
+Result cache for search-as-you-type.
+
+Entries are keyed by (field, query) and kept in LRU order. When a new query
+only extends a cached one ("beat" -> "beatl"), its results are a subset of
+the cached results, so they are filtered in memory instead of asking
+SQLite again. Any write to songs (see Database.get_song_write_count)
+empties the cache.
+"""
+
+import re
+import unicodedata
+from collections import OrderedDict
+
+from Database import search_songs, get_song_write_count, sort_key
+
+# Cached queries kept per cache.
+CACHE_ENTRIES = 64
+
+# Results fetched per query. Larger result sets are not cached as
+# complete, so queries refining them go back to the database.
+RESULT_LIMIT = 5000
+
+
+def fold(text):
+    """Case- and accent-insensitive form, matching the FTS5 tokenizer."""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def words(text):
+    # Same word boundaries as Database._search_terms.
+    return re.findall(r"[^\W_]+", fold(text))
+
+
+class _Entry:
+    __slots__ = ("rows", "words", "complete")
+
+    def __init__(self, rows, field, complete, row_words=None):
+        self.rows = rows
+        # Pre-split field values so refining is only prefix checks.
+        self.words = row_words if row_words is not None else [words(row[field]) for row in rows]
+        self.complete = complete
+
+
+class SearchCache:
+    def __init__(self, max_entries=CACHE_ENTRIES, result_limit=RESULT_LIMIT):
+        self.max_entries = max_entries
+        self.result_limit = result_limit
+        self.entries = OrderedDict()  # (field, folded query) -> _Entry
+        self.generation = get_song_write_count()
+
+    def _check_generation(self):
+        generation = get_song_write_count()
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+
+    def clear(self):
+        """Drops every entry, e.g. after another process wrote songs."""
+        self.entries.clear()
+
+    def lookup(self, field, query):
+        """
+        Returns the results for query from the cache, refining a cached
+        shorter query if possible, or None when the database must be asked.
+        """
+        self._check_generation()
+        key = (field, fold(query).strip())
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry.rows
+
+        # Longest complete cached query that the new one extends.
+        base = None
+        for (cached_field, cached_query), cached in self.entries.items():
+            if (cached_field == field and cached.complete
+                    and key[1].startswith(cached_query)
+                    and (base is None or len(cached_query) > len(base[0]))):
+                base = (cached_query, cached)
+        if base is None:
+            return None
+
+        terms = words(query)
+        matches = [
+            (row, row_words) for row, row_words in zip(base[1].rows, base[1].words)
+            if all(any(w.startswith(t) for w in row_words) for t in terms)
+        ]
+        rows = [row for row, _ in matches]
+        self._put(key, _Entry(rows, field, True, [w for _, w in matches]))
+        return rows
+
+    def fetch(self, field, query):
+        """
+        Runs the search against the database. Meant for a worker thread;
+        pass the result to store() on the Tk thread.
+        """
+        generation = get_song_write_count()
+        rows = search_songs(query, fields=(field,), limit=self.result_limit + 1, ranked=False)
+        complete = len(rows) <= self.result_limit
+        rows = sorted(rows[:self.result_limit], key=lambda row: (sort_key(row["name"]), row["id"]))
+        return _Entry(rows, field, complete), generation
+
+    def store(self, field, query, result):
+        """Caches a fetch() result unless songs were written meanwhile; returns its rows."""
+        entry, generation = result
+        self._check_generation()
+        if generation == self.generation:
+            self._put((field, fold(query).strip()), entry)
+        return entry.rows
+
+    def _put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
@@ -0,0 +1,484 @@
+"""
+Headless HTTP/JSON API over Database.py, for scripts, web front-ends and
+several users sharing one library.
+
+Usage:
+    python Main.py --serve [--host HOST] [--port PORT] [--workers N]
+    python Server.py [--host HOST] [--port PORT] [--workers N]
+
+Endpoints:
+    GET    /songs?limit=&after=&after_id=&artist_id=&genre_id=
+    GET    /songs/stream?artist_id=&genre_id=
+    GET    /songs/<id>
+    GET    /songs/<id>/similar?limit=
+    GET    /songs/<id>/playlists
+    GET    /artists?genre_id=
+    GET    /genres?artist_id=
+    GET    /playlists
+    GET    /playlists/<id>/songs?limit=&after_position=&after_id=
+    GET    /playlists/<id>/songs/stream
+    GET    /playlists/<id>/extend?limit=
+    GET    /search?q=&fields=name,artist&fuzzy=1&limit=
+    POST   /playlists                 {"name": ...}
+    DELETE /playlists/<id>
+    POST   /playlists/<id>/songs      {"song_ids": [...]}
+    DELETE /playlists/<id>/songs      {"song_ids": [...]}
+
+Adding or removing songs of a smart playlist answers 409 Conflict: its
+rules decide its songs.
+
+Listings are paged with keysets: each page carries "next", the URL of the
+following page, or null. The /stream variants send the whole listing as
+one JSON array with chunked encoding, fetching it a page at a time, so
+neither side holds it in memory.
+
+Database calls run on a bounded thread pool, one SQLite connection per
+thread. Work queued by writes (see Maintenance.py) runs on a thread of
+its own, never in a request. GET responses carry an ETag derived from PRAGMA data_version.
+Until something commits, repeat requests are answered from an in-memory
+cache, or with 304 Not Modified for a matching If-None-Match, without
+running a query.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import Database
+from Maintenance import Maintenance
+
+log = logging.getLogger("Server")
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+
+# Threads running Database calls. Requests beyond POOL_QUEUE per thread
+# wait in the event loop instead of piling up in the pool's queue.
+POOL_SIZE = 8
+POOL_QUEUE = 4
+
+# GET responses kept per URL, and the largest body worth keeping.
+RESPONSE_CACHE_SIZE = 2048
+MAX_CACHED_BYTES = 1 << 20
+
+# Rows per page: the default, the most a client may ask for, and the
+# page size used when streaming.
+DEFAULT_LIMIT = Database.PAGE_SIZE
+MAX_LIMIT = 1000
+STREAM_BATCH_SIZE = Database.TRANSFER_BATCH_SIZE
+
+# Largest request head and body accepted.
+MAX_HEAD_BYTES = 16 * 1024
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class HttpError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or HTTPStatus(status).phrase)
+        self.status = status
+
+
+# ---------------------------------------------------------
+# ROUTES
+# ---------------------------------------------------------
+
+ROUTES = []  # (method, compiled path pattern, handler, streamed)
+
+
+def route(method, pattern, stream=False):
+    """
+    Registers a handler. Handlers run on the thread pool and get the
+    parsed query (GET) or JSON body (other methods), then the path
+    groups as ints. Stream handlers also get the cursor of the page to
+    fetch (None first) and return (rows, next cursor or None).
+    """
+    def register(fn):
+        ROUTES.append((method, re.compile(pattern + r"\Z"), fn, stream))
+        return fn
+    return register
+
+
+def _int(params, name, default=None):
+    value = params.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise HttpError(400, f"{name} must be an integer") from None
+
+
+def _limit(params, default=DEFAULT_LIMIT):
+    limit = _int(params, "limit", default)
+    if not 1 <= limit <= MAX_LIMIT:
+        raise HttpError(400, f"limit must be between 1 and {MAX_LIMIT}")
+    return limit
+
+
+def _song_ids(body):
+    song_ids = body.get("song_ids")
+    if not isinstance(song_ids, list) or not all(isinstance(i, int) for i in song_ids):
+        raise HttpError(400, "song_ids must be a list of integers")
+    return song_ids
+
+
+def _static_playlist(playlist_id):
+    # The next refresh_smart_playlists() would overwrite any hand edit.
+    if Database.is_smart_playlist(playlist_id):
+        raise HttpError(409, "Smart playlists are filled by their rules")
+    return playlist_id
+
+
+def _next_url(path, params, **cursor):
+    params = {k: v for k, v in params.items() if v is not None and k not in cursor}
+    return f"{path}?{urlencode({**params, **cursor})}"
+
+
+def _songs_page(params, after, limit):
+    return Database.get_songs_page(
+        after=after, limit=limit,
+        artist_id=_int(params, "artist_id"), genre_id=_int(params, "genre_id"),
+    )
+
+
+@route("GET", r"/songs")
+def list_songs(params):
+    limit = _limit(params)
+    after = (params["after"], _int(params, "after_id", 0)) if "after" in params else None
+    songs = _songs_page(params, after, limit)
+    next_url = None
+    if len(songs) == limit:
+        next_url = _next_url("/songs", params, after=songs[-1]["name"], after_id=songs[-1]["id"])
+    total = Database.count_songs(_int(params, "artist_id"), _int(params, "genre_id"))
+    return {"songs": songs, "total": total, "next": next_url}
+
+
+@route("GET", r"/songs/stream", stream=True)
+def stream_songs(params, cursor):
+    songs = _songs_page(params, cursor, STREAM_BATCH_SIZE)
+    last = songs[-1] if len(songs) == STREAM_BATCH_SIZE else None
+    return songs, last and (last["name"], last["id"])
+
+
+@route("GET", r"/songs/(\d+)")
+def get_song(params, song_id):
+    song = Database.get_song(song_id)
+    if song is None:
+        raise HttpError(404, f"No song {song_id}")
+    return song
+
+
+@route("GET", r"/songs/(\d+)/playlists")
+def song_playlists(params, song_id):
+    return Database.get_playlists_for_song(song_id)
+
+
+@route("GET", r"/songs/(\d+)/similar")
+def similar_songs(params, song_id):
+    return Database.get_similar_songs(song_id, _limit(params, Database.SIMILAR_LIMIT))
+
+
+@route("GET", r"/artists")
+def list_artists(params):
+    return Database.get_artists(_int(params, "genre_id"))
+
+
+@route("GET", r"/genres")
+def list_genres(params):
+    return Database.get_genres(_int(params, "artist_id"))
+
+
+@route("GET", r"/playlists")
+def list_playlists(params):
+    return Database.get_all_playlists()
+
+
+@route("GET", r"/playlists/(\d+)/songs")
+def list_playlist_songs(params, playlist_id):
+    limit = _limit(params)
+    after = None
+    if "after_position" in params:
+        after = (_int(params, "after_position"), _int(params, "after_id", 0))
+    songs = Database.get_playlist_songs_page(playlist_id, after, limit)
+    next_url = None
+    if len(songs) == limit:
+        next_url = _next_url(f"/playlists/{playlist_id}/songs", params,
+                             after_position=songs[-1]["position"], after_id=songs[-1]["id"])
+    return {"songs": songs, "next": next_url}
+
+
+@route("GET", r"/playlists/(\d+)/songs/stream", stream=True)
+def stream_playlist_songs(params, playlist_id, cursor):
+    songs = Database.get_playlist_songs_page(playlist_id, cursor, STREAM_BATCH_SIZE)
+    last = songs[-1] if len(songs) == STREAM_BATCH_SIZE else None
+    return songs, last and (last["position"], last["id"])
+
+
+@route("GET", r"/playlists/(\d+)/extend")
+def extend_playlist(params, playlist_id):
+    return Database.get_playlist_extension(playlist_id, _limit(params, Database.SIMILAR_LIMIT))
+
+
+@route("GET", r"/search")
+def search(params):
+    query = params.get("q", "")
+    fields = tuple(params.get("fields", ",".join(Database.SEARCH_FIELDS)).split(","))
+    limit = _limit(params, Database.SEARCH_LIMIT)
+    if params.get("fuzzy") in ("1", "true", "yes"):
+        return Database.search_songs_fuzzy(query, fields, limit)
+    return Database.search_songs(query, fields, limit)
+
+
+@route("POST", r"/playlists")
+def create_playlist(body):
+    return {"id": Database.create_playlist(str(body.get("name", "")))}
+
+
+@route("DELETE", r"/playlists/(\d+)")
+def delete_playlist(body, playlist_id):
+    Database.delete_playlist(playlist_id)
+    return {"deleted": playlist_id}
+
+
+@route("POST", r"/playlists/(\d+)/songs")
+def add_playlist_songs(body, playlist_id):
+    song_ids = _song_ids(body)
+    return {"added": Database.add_songs_to_playlist(_static_playlist(playlist_id), song_ids)}
+
+
+@route("DELETE", r"/playlists/(\d+)/songs")
+def remove_playlist_songs(body, playlist_id):
+    song_ids = _song_ids(body)
+    return {"removed": Database.remove_songs_from_playlist(_static_playlist(playlist_id), song_ids)}
+
+
+# ---------------------------------------------------------
+# SERVER
+# ---------------------------------------------------------
+
+class Server:
+    def __init__(self, workers=POOL_SIZE):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db")
+        self.slots = asyncio.Semaphore(workers * POOL_QUEUE)
+        self.cache = OrderedDict()  # target -> (data version, ETag, body)
+        self.data_version = Database.data_version_watcher()
+        # ETags must not repeat across restarts, where data_version restarts.
+        self.boot = format(time.time_ns(), "x")
+        self.maintenance = Maintenance().start()
+
+    async def run(self, fn, *args):
+        async with self.slots:
+            return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, reader, writer):
+        """Serves one request; returns whether to keep the connection open."""
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return False
+        except asyncio.LimitOverrunError:
+            await self._send(writer, 431, {"error": "Request head too large"}, keep_alive=False)
+            return False
+
+        request_line, *header_lines = head.decode("latin-1").rstrip("\r\n").split("\r\n")
+        try:
+            method, target, version = request_line.split(" ")
+        except ValueError:
+            await self._send(writer, 400, {"error": "Malformed request line"}, keep_alive=False)
+            return False
+        headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.0":
+            keep_alive = connection == "keep-alive"
+        else:
+            keep_alive = connection != "close"
+
+        length = headers.get("content-length") or "0"
+        if not length.isdigit():
+            await self._send(writer, 400, {"error": "Bad Content-Length"}, keep_alive=False)
+            return False
+        length = int(length)
+        if length > MAX_BODY_BYTES:
+            await self._send(writer, 413, {"error": "Request body too large"}, keep_alive=False)
+            return False
+        body = await reader.readexactly(length) if length else b""
+
+        try:
+            await self._dispatch(writer, method, target, headers, body, keep_alive)
+        except HttpError as e:
+            await self._send(writer, e.status, {"error": str(e)}, keep_alive)
+        except ValueError as e:
+            await self._send(writer, 400, {"error": str(e)}, keep_alive)
+        except sqlite3.IntegrityError as e:
+            await self._send(writer, 409, {"error": str(e)}, keep_alive)
+        except ConnectionError:
+            raise
+        except Exception:
+            log.exception("%s %s failed", method, target)
+            await self._send(writer, 500, {"error": "Internal server error"}, keep_alive)
+        return keep_alive
+
+    async def _dispatch(self, writer, method, target, headers, body, keep_alive):
+        url = urlsplit(target)
+        path = url.path.rstrip("/") or "/"
+        for route_method, pattern, handler, stream in ROUTES:
+            match = pattern.match(path)
+            if match is not None and route_method == method:
+                break
+        else:
+            allowed = any(pattern.match(path) for _, pattern, _, _ in ROUTES)
+            raise HttpError(405 if allowed else 404)
+        args = [int(group) for group in match.groups()]
+
+        if method != "GET":
+            try:
+                data = json.loads(body or b"{}")
+            except ValueError:
+                raise HttpError(400, "Body must be JSON") from None
+            if not isinstance(data, dict):
+                raise HttpError(400, "Body must be a JSON object")
+            result = await self.run(handler, data, *args)
+            await self._send(writer, 201 if method == "POST" else 200, result, keep_alive)
+            return
+
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        # Read before querying, so a commit racing the query can only make
+        # the cached copy look older than it is, never newer.
+        version = self.data_version()
+        etag = f'"{self.boot}-{version}"'
+        if headers.get("if-none-match") == etag:
+            await self._send(writer, 304, None, keep_alive, etag=etag)
+            return
+
+        if stream:
+            await self._stream(writer, handler, params, args, keep_alive, etag)
+            return
+
+        cached = self.cache.get(target)
+        if cached is not None and cached[0] == version:
+            self.cache.move_to_end(target)
+            await self._send_bytes(writer, 200, cached[2], keep_alive, etag=etag)
+            return
+
+        payload = _encode(await self.run(handler, params, *args))
+        if len(payload) <= MAX_CACHED_BYTES:
+            self.cache[target] = (version, etag, payload)
+            self.cache.move_to_end(target)
+            while len(self.cache) > RESPONSE_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        await self._send_bytes(writer, 200, payload, keep_alive, etag=etag)
+
+    async def _stream(self, writer, handler, params, args, keep_alive, etag):
+        """Sends a JSON array in chunks, one page per pool call."""
+        # Fetch the first page before committing to a 200, so bad
+        # parameters still get a proper error response.
+        rows, cursor = await self.run(handler, params, *args, None)
+        writer.write(_head(200, keep_alive, etag=etag, chunked=True))
+        separator = b"["
+        try:
+            while True:
+                if rows:
+                    chunk = separator + b",".join(_encode(row) for row in rows)
+                    separator = b","
+                    writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    # Waits while the client is slower than the database.
+                    await writer.drain()
+                if cursor is None:
+                    break
+                rows, cursor = await self.run(handler, params, *args, cursor)
+        except Exception as e:
+            if isinstance(e, ConnectionError):
+                raise
+            # The status line is gone; all that's left is to cut the response short.
+            log.exception("Stream failed")
+            raise ConnectionAbortedError from e
+        tail = b"]" if separator == b"," else b"[]"
+        writer.write(b"%x\r\n%s\r\n0\r\n\r\n" % (len(tail), tail))
+        await writer.drain()
+
+    async def _send(self, writer, status, result, keep_alive, etag=None):
+        await self._send_bytes(writer, status, b"" if result is None else _encode(result),
+                               keep_alive, etag)
+
+    @staticmethod
+    async def _send_bytes(writer, status, payload, keep_alive, etag=None):
+        writer.write(_head(status, keep_alive, etag=etag, length=len(payload)) + payload)
+        await writer.drain()
+
+    def close(self):
+        self.maintenance.stop()
+        self.pool.shutdown(wait=True)
+
+
+def _encode(result):
+    return json.dumps(result, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def _head(status, keep_alive, etag=None, length=None, chunked=False):
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+    if status != 304:
+        lines.append("Content-Type: application/json; charset=utf-8")
+    if chunked:
+        lines.append("Transfer-Encoding: chunked")
+    elif status != 304:
+        lines.append(f"Content-Length: {length}")
+    if etag is not None:
+        # Clients may keep the response but must revalidate it.
+        lines.append(f"ETag: {etag}")
+        lines.append("Cache-Control: no-cache")
+    lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, workers=POOL_SIZE):
+    server = Server(workers)
+    listener = await asyncio.start_server(server.handle_connection, host, port,
+                                          limit=MAX_HEAD_BYTES)
+    log.info("Serving on http://%s:%d/ with %d database threads", host, port, workers)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the music library as HTTP/JSON.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=POOL_SIZE,
+                        help="database threads (default %(default)s)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s: %(message)s")
+    Database.init_db()
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
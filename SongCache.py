@@ -0,0 +1,168 @@
+"""
+In-memory identity map of the songs table.
+
+SongCache holds one canonical dict per song id plus a sorted index of
+(sort key, id) pairs in the same order as the sort_name listings. Its
+CRUD wrappers write the one affected row through Database.py and then
+patch the index with bisect, so an edit costs a single row write and an
+O(log n) search instead of re-reading and re-sorting the whole table.
+
+It is also a VirtualList row source (len() and rows(start, count)).
+"""
+
+import threading
+from bisect import bisect_left, insort
+
+import Database
+
+# Above this many songs the cache is not loaded and the UI keeps paging
+# from SQLite instead, to bound memory use.
+MAX_CACHED_SONGS = 500_000
+
+
+def sort_key(song):
+    return (Database.sort_key(song["name"]), song["id"])
+
+
+class SongCache:
+    def __init__(self, max_songs=MAX_CACHED_SONGS):
+        self.max_songs = max_songs
+        self.records = {}   # id -> canonical song dict
+        self.index = []     # sorted [(sort key, id)]
+        self.loaded = False
+        self.generation = None  # Database song write count the cache matches
+        self._lock = threading.Lock()
+
+    # loading
+
+    def load(self):
+        """
+        Reads every song into the cache (call from a worker thread).
+        Returns False, leaving the cache unloaded, if the library is larger
+        than max_songs.
+        """
+        if Database.count_songs() > self.max_songs:
+            return False
+
+        while True:
+            generation = Database.get_song_write_count()
+            rows = Database.get_all_songs()
+            if Database.get_song_write_count() == generation:
+                break
+
+        records = {row["id"]: row for row in rows}
+        index = sorted(sort_key(row) for row in rows)
+        with self._lock:
+            self.records = records
+            self.index = index
+            self.generation = generation
+            self.loaded = True
+        return True
+
+    @property
+    def stale(self):
+        """True if songs were written without going through this cache."""
+        return not self.loaded or Database.get_song_write_count() != self.generation
+
+    # lookups
+
+    def __len__(self):
+        return len(self.index)
+
+    def rows(self, start, count):
+        with self._lock:
+            return [self.records[song_id] for _, song_id in self.index[start:start + count]]
+
+    def get(self, song_id):
+        return self.records.get(song_id)
+
+    def position(self, song_id):
+        """Index of a song in sorted order, or None if it is not cached."""
+        song = self.records.get(song_id)
+        if song is None:
+            return None
+        return bisect_left(self.index, sort_key(song))
+
+    def canonical(self, songs):
+        """Swaps rows from other queries for the cached record of the same id."""
+        return [self.records.get(song["id"], song) for song in songs]
+
+    # write-through CRUD
+
+    def create_song(self, name, artist="", genre=""):
+        before = Database.get_song_write_count()
+        song_id = Database.create_song(name, artist, genre)
+        song = Database.get_song(song_id)
+        with self._lock:
+            if self.loaded:
+                self.records[song_id] = song
+                insort(self.index, sort_key(song))
+            self._advance(before)
+        return song_id
+
+    def update_song(self, song_id, name, artist="", genre=""):
+        before = Database.get_song_write_count()
+        Database.update_song(song_id, name, artist, genre)
+        fresh = Database.get_song(song_id)
+        with self._lock:
+            song = self.records.get(song_id)
+            if song is not None:
+                self._remove_key(song)
+                if fresh is None:
+                    # Deleted by another writer since the update.
+                    del self.records[song_id]
+                else:
+                    # Mutate in place so every holder of the record sees the edit.
+                    song.update(fresh)
+                    insort(self.index, sort_key(song))
+            self._advance(before)
+
+    def delete_song(self, song_id):
+        before = Database.get_song_write_count()
+        Database.delete_song(song_id)
+        with self._lock:
+            song = self.records.pop(song_id, None)
+            if song is not None:
+                self._remove_key(song)
+            self._advance(before)
+
+    # changes made elsewhere
+
+    def apply(self, songs):
+        """
+        Patches in songs written by another process: {id: the song as
+        Database.get_song() returns it, or None if deleted}.
+        """
+        with self._lock:
+            if not self.loaded:
+                return
+            for song_id, fresh in songs.items():
+                song = self.records.get(song_id)
+                if song is not None:
+                    self._remove_key(song)
+                    if fresh is None:
+                        del self.records[song_id]
+                        continue
+                    song.update(fresh)
+                elif fresh is None:
+                    continue
+                else:
+                    song = self.records[song_id] = fresh
+                insort(self.index, sort_key(song))
+
+    def invalidate(self):
+        """Marks the cache stale, so the next refresh reloads it."""
+        with self._lock:
+            self.generation = None
+
+    def _remove_key(self, song):
+        key = sort_key(song)
+        i = bisect_left(self.index, key)
+        if i < len(self.index) and self.index[i] == key:
+            del self.index[i]
+
+    def _advance(self, before):
+        # Our write is the only one since the cache last matched the
+        # database; anything else leaves the cache marked stale.
+        if self.generation == before and Database.get_song_write_count() == before + 1:
+            self.generation = before + 1
@@ -0,0 +1,335 @@
+"""
+Streaming export and import of playlists and the whole library.
+
+Usage:
+    python Transfer.py export-playlist "Road Trip" road_trip.m3u8
+    python Transfer.py import-playlist road_trip.m3u8 --name "Road Trip"
+    python Transfer.py export-library backup/ --format csv
+    python Transfer.py import-library backup/
+
+Playlists are written as M3U8, JSON (an array of song objects) or CSV, and
+read back from the same formats (plus NDJSON). Songs are matched to the
+library by file path, else by name and artist; see
+Database.import_playlist.
+
+A library export is a directory holding songs.json (or songs.csv, both
+readable by Importer.py too), one file per playlist under playlists/, and
+playlists.json listing the playlist names and files.
+
+Rows are streamed in both directions, so memory use does not depend on
+the size of the library or of any playlist.
+"""
+
+import argparse
+import csv
+import json
+import re
+import sys
+from pathlib import Path
+
+from Database import (
+    init_db,
+    transaction,
+    get_all_playlists,
+    get_playlist_id,
+    iter_playlist_songs,
+    refresh_smart_playlists,
+    iter_songs,
+    import_playlist,
+    import_library,
+    TRANSFER_FIELDS,
+)
+from Importer import read_csv, read_json, read_ndjson
+
+FORMATS = {
+    ".m3u8": "m3u8",
+    ".m3u": "m3u8",
+    ".json": "json",
+    ".csv": "csv",
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+}
+
+EXTENSIONS = {"m3u8": ".m3u8", "json": ".json", "csv": ".csv"}
+
+
+def detect_format(path):
+    fmt = FORMATS.get(Path(path).suffix.lower())
+    if fmt is None:
+        raise ValueError(f"Cannot tell the format of {path}; pass --format.")
+    return fmt
+
+
+def _one_line(text):
+    return " ".join(str(text or "").splitlines())
+
+
+def _title(song):
+    # The separator is written even without an artist, so a name holding
+    # " - " is not read back as artist and name.
+    return f"{_one_line(song['artist'])} - {_one_line(song['name'])}"
+
+
+# ---------------------------------------------------------
+# WRITERS (consume an iterable of songs, return the count)
+# ---------------------------------------------------------
+
+def write_m3u8(f, songs, name=None):
+    f.write("#EXTM3U\n")
+    if name:
+        f.write(f"#PLAYLIST:{_one_line(name)}\n")
+    count = 0
+    for song in songs:
+        seconds = round(song["duration"]) if song["duration"] else -1
+        title = _title(song)
+        # Songs without a file get their title as the location; the reader
+        # recognizes it and matches them by name and artist instead.
+        f.write(f"#EXTINF:{seconds},{title}\n{song['path'] or title.strip()}\n")
+        count += 1
+    return count
+
+
+def write_json(f, songs, name=None):
+    f.write("[")
+    count = 0
+    for song in songs:
+        f.write(",\n" if count else "\n")
+        json.dump(song, f, ensure_ascii=False)
+        count += 1
+    f.write("\n]\n")
+    return count
+
+
+def write_csv(f, songs, name=None):
+    writer = csv.DictWriter(f, fieldnames=TRANSFER_FIELDS)
+    writer.writeheader()
+    count = 0
+    for song in songs:
+        writer.writerow(song)
+        count += 1
+    return count
+
+
+WRITERS = {
+    "m3u8": write_m3u8,
+    "json": write_json,
+    "csv": write_csv,
+}
+
+
+# ---------------------------------------------------------
+# READERS (generators, one song record at a time)
+# ---------------------------------------------------------
+
+def read_m3u8(f):
+    info = None  # from the #EXTINF line describing the next location
+    for line in f:
+        line = line.strip()
+        if line.startswith("#EXTINF:"):
+            length, _, title = line[len("#EXTINF:"):].partition(",")
+            # " - Name" for a song without an artist (see _title).
+            artist, sep, name = (" " + title if title.startswith("- ") else title).partition(" - ")
+            info = {"name": name, "artist": artist} if sep else {"name": title, "artist": ""}
+            info["title"] = title
+            try:
+                info["duration"] = max(float(length), 0) or None
+            except ValueError:
+                pass
+            continue
+        if not line or line.startswith("#"):
+            continue
+
+        if info is None:
+            yield {"name": Path(line).stem, "path": line}
+            continue
+        title = info.pop("title")
+        yield {**info, "path": None if line == title.strip() else line}
+        info = None
+
+
+def m3u8_playlist_name(f):
+    """The #PLAYLIST: name in an M3U8 header, or None."""
+    for line in f:
+        line = line.strip()
+        if line.startswith("#PLAYLIST:"):
+            return line[len("#PLAYLIST:"):].strip() or None
+        if line and not line.startswith("#"):
+            return None
+    return None
+
+
+READERS = {
+    "m3u8": read_m3u8,
+    "json": read_json,
+    "csv": read_csv,
+    "ndjson": read_ndjson,
+}
+
+
+def _records(reader, f):
+    # Unparseable lines come through as strings (see Importer.read_ndjson).
+    for record in reader(f):
+        if isinstance(record, dict):
+            yield record
+
+
+# ---------------------------------------------------------
+# PLAYLISTS
+# ---------------------------------------------------------
+
+def export_playlist(playlist_id, path, fmt=None, name=None):
+    """Writes one playlist to path. Returns the number of songs written."""
+    fmt = fmt or detect_format(path)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        return WRITERS[fmt](f, iter_playlist_songs(playlist_id), name=name)
+
+
+def import_playlist_file(path, name=None, fmt=None, on_missing=None):
+    """
+    Reads a playlist file into the playlist called name (default: the
+    M3U8 #PLAYLIST: name, else the file name). Returns
+    (playlist_id, added, missing) as Database.import_playlist does.
+    """
+    fmt = fmt or detect_format(path)
+    if name is None and fmt == "m3u8":
+        with open(path, encoding="utf-8-sig") as f:
+            name = m3u8_playlist_name(f)
+    name = name or Path(path).stem
+
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        return import_playlist(name, _records(READERS[fmt], f), on_missing=on_missing)
+
+
+# ---------------------------------------------------------
+# WHOLE LIBRARY
+# ---------------------------------------------------------
+
+def _file_name(index, name, fmt):
+    safe = re.sub(r"[^\w\- ]+", "_", name).strip()[:60] or "playlist"
+    return f"playlists/{index:04d} {safe}{EXTENSIONS[fmt]}"
+
+
+def export_library(directory, fmt="json", playlist_fmt="m3u8"):
+    """
+    Writes every song and playlist into directory (see the module
+    docstring), from one consistent snapshot. Returns (songs, playlists).
+    """
+    directory = Path(directory)
+    (directory / "playlists").mkdir(parents=True, exist_ok=True)
+
+    # One read transaction, so songs and playlists come from the same snapshot.
+    with transaction():
+        with open(directory / f"songs{EXTENSIONS[fmt]}", "w", newline="", encoding="utf-8") as f:
+            songs = WRITERS[fmt](f, iter_songs())
+
+        manifest = []
+        for index, playlist in enumerate(get_all_playlists(), start=1):
+            file_name = _file_name(index, playlist["name"], playlist_fmt)
+            export_playlist(playlist["id"], directory / file_name, playlist_fmt, playlist["name"])
+            manifest.append({"name": playlist["name"], "file": file_name})
+
+    with open(directory / "playlists.json", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    return songs, len(manifest)
+
+
+def import_library_dir(directory, progress=None, on_missing=None):
+    """
+    Reads a directory written by export_library(): adds the songs the
+    library does not have yet, then recreates each playlist. Returns
+    (songs added, songs matched, playlists).
+    """
+    directory = Path(directory)
+    songs_files = [directory / f"songs.{ext}" for ext in ("json", "csv", "ndjson")]
+    songs_file = next((p for p in songs_files if p.exists()), None)
+    if songs_file is None:
+        raise ValueError(f"No songs.json or songs.csv in {directory}.")
+
+    with open(songs_file, newline="", encoding="utf-8-sig") as f:
+        added, matched = import_library(
+            _records(READERS[detect_format(songs_file)], f), progress=progress
+        )
+
+    playlists = 0
+    manifest = directory / "playlists.json"
+    if manifest.exists():
+        with open(manifest, encoding="utf-8") as f:
+            for entry in read_json(f):
+                import_playlist_file(directory / entry["file"], name=entry["name"],
+                                     on_missing=on_missing)
+                playlists += 1
+    return added, matched, playlists
+
+
+# ---------------------------------------------------------
+# CLI
+# ---------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export or import playlists and the library.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser("export-playlist", help="write one playlist to a file")
+    cmd.add_argument("playlist", help="playlist name")
+    cmd.add_argument("file", help="M3U8, JSON or CSV file to write")
+    cmd.add_argument("--format", choices=sorted(WRITERS), help="override format detection")
+
+    cmd = commands.add_parser("import-playlist", help="read a playlist file")
+    cmd.add_argument("file", help="M3U8, JSON, NDJSON or CSV file to read")
+    cmd.add_argument("--name", help="playlist to add the songs to (default: from the file)")
+    cmd.add_argument("--format", choices=sorted(READERS), help="override format detection")
+
+    cmd = commands.add_parser("export-library", help="write all songs and playlists")
+    cmd.add_argument("directory")
+    cmd.add_argument("--format", choices=("json", "csv"), default="json",
+                     help="format of the songs file (default %(default)s)")
+    cmd.add_argument("--playlist-format", choices=sorted(WRITERS), default="m3u8",
+                     help="format of the playlist files (default %(default)s)")
+
+    cmd = commands.add_parser("import-library", help="read a directory from export-library")
+    cmd.add_argument("directory")
+
+    args = parser.parse_args(argv)
+
+    def on_missing(record):
+        artist = f"{record['artist']} - " if record.get("artist") else ""
+        print(f"Not in library: {artist}{record['name']} {record['path'] or ''}",
+              file=sys.stderr)
+
+    def progress(count):
+        print(f"\rRead {count:,} songs...", end="", file=sys.stderr, flush=True)
+
+    init_db()
+    if args.command.startswith("export"):
+        # Smart playlists are otherwise brought up to date by the app's
+        # or the server's Maintenance thread, which may not be running.
+        refresh_smart_playlists()
+    try:
+        if args.command == "export-playlist":
+            playlist_id = get_playlist_id(args.playlist)
+            if playlist_id is None:
+                print(f"No playlist called {args.playlist!r}.", file=sys.stderr)
+                return 1
+            count = export_playlist(playlist_id, args.file, args.format, args.playlist)
+            print(f"Exported {count:,} songs.", file=sys.stderr)
+
+        elif args.command == "import-playlist":
+            _, added, missing = import_playlist_file(args.file, args.name, args.format, on_missing)
+            print(f"Added {added:,} songs; {missing:,} not found in the library.", file=sys.stderr)
+
+        elif args.command == "export-library":
+            songs, playlists = export_library(args.directory, args.format, args.playlist_format)
+            print(f"Exported {songs:,} songs and {playlists:,} playlists.", file=sys.stderr)
+
+        else:
+            added, matched, playlists = import_library_dir(args.directory, progress, on_missing)
+            print(f"\nAdded {added:,} songs ({matched:,} already present) "
+                  f"and {playlists:,} playlists.", file=sys.stderr)
+    except (OSError, ValueError) as e:
+        print(f"\n{args.command} failed: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
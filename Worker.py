@@ -0,0 +1,125 @@
+"""
+Runs Database.py calls off the Tk thread.
+
+DbWorker executes functions on a small thread pool (each worker thread has
+its own connection from Database.get_connection) and delivers results back
+on the Tk thread by polling a queue with root.after(), so callbacks may
+touch widgets directly. The callbacks redraw what a write touched, so the
+threads note their writes (Database.record_own_changes) for ChangeFeed to
+skip.
+
+Requests submitted on the same channel supersede each other: a newer
+search cancels the older one, interrupting its query if it is running.
+"""
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from Database import get_connection, record_own_changes
+
+# How often the Tk thread checks for finished requests.
+POLL_MS = 15
+
+
+class Request:
+    """Handle for one submitted call; cancel() discards its result."""
+
+    def __init__(self, channel, on_done, on_error):
+        self.channel = channel
+        self.on_done = on_done
+        self.on_error = on_error
+        self.cancelled = False
+        self.future = None
+        self._conn = None  # set while the call is running
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self.future is not None:
+                self.future.cancel()
+            if self._conn is not None:
+                # Aborts the statement in progress on the worker thread.
+                self._conn.interrupt()
+
+
+class DbWorker:
+    def __init__(self, root, max_workers=2, poll_ms=POLL_MS):
+        self.root = root
+        self.poll_ms = poll_ms
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db",
+                                           initializer=record_own_changes)
+        self.results = queue.SimpleQueue()
+        self.channels = {}  # channel -> latest Request
+        self._after_id = self.root.after(self.poll_ms, self._poll)
+
+    def submit(self, fn, *args, channel=None, on_done=None, on_error=None, **kwargs):
+        """
+        Runs fn(*args, **kwargs) on a worker thread. on_done(result) or
+        on_error(exception) is then called on the Tk thread, unless the
+        request was cancelled or superseded on its channel first.
+        """
+        request = Request(channel, on_done, on_error)
+        if channel is not None:
+            previous = self.channels.get(channel)
+            if previous is not None:
+                previous.cancel()
+            self.channels[channel] = request
+
+        request.future = self.executor.submit(self._run, request, fn, args, kwargs)
+        return request
+
+    def cancel(self, channel):
+        request = self.channels.pop(channel, None)
+        if request is not None:
+            request.cancel()
+
+    def shutdown(self):
+        """Drops queued work and waits for calls already running."""
+        self.root.after_cancel(self._after_id)
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    # worker thread
+
+    def _run(self, request, fn, args, kwargs):
+        with request._lock:
+            if request.cancelled:
+                self.results.put((request, None, None))
+                return
+            request._conn = get_connection()
+        try:
+            result, error = fn(*args, **kwargs), None
+        except Exception as e:
+            result, error = None, e
+        finally:
+            with request._lock:
+                request._conn = None
+        self.results.put((request, result, error))
+
+    # Tk thread
+
+    def _poll(self):
+        while True:
+            try:
+                request, result, error = self.results.get_nowait()
+            except queue.Empty:
+                break
+
+            if request.channel is not None and self.channels.get(request.channel) is request:
+                del self.channels[request.channel]
+            if request.cancelled:
+                continue
+
+            try:
+                if error is not None:
+                    if request.on_error is None:
+                        raise error
+                    request.on_error(error)
+                elif request.on_done is not None:
+                    request.on_done(result)
+            except Exception as e:
+                # Report like any other Tk callback, and keep polling.
+                self.root.report_callback_exception(type(e), e, e.__traceback__)
+
+        self._after_id = self.root.after(self.poll_ms, self._poll)
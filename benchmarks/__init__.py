@@ -0,0 +1,9 @@
+"""
+Headless benchmarks for Database.py and the Main.py fetch_* helpers.
+
+    python -m benchmarks.run --scales 1000 10000 100000 --out results.json
+    python -m benchmarks.run --scales 10000 --baseline results.json
+
+See benchmarks/generator.py for the synthetic library and
+benchmarks/run.py for the timed cases.
+"""
@@ -0,0 +1,87 @@
+"""
+Deterministic synthetic music library.
+
+The same (size, seed) always produces the same songs and playlists, so
+timings from different runs are comparable. Artists and genres follow a
+Zipf-like distribution (a few very common, a long tail of rare ones) and
+playlist sizes are log-uniform, roughly like a real collection.
+"""
+
+import math
+import random
+from itertools import accumulate
+
+import Database
+
+SYLLABLES = (
+    "la", "mo", "ri", "ka", "zen", "tor", "bel", "an", "ve", "qui", "sta",
+    "ro", "nu", "dex", "shi", "fa", "gro", "li", "pon", "ter", "wa", "yel",
+    "cru", "mi", "sol", "do", "re", "vin", "hal", "ou",
+)
+
+GENRES = (
+    "Rock", "Pop", "Jazz", "Classical", "Hip-Hop", "Electronic", "Metal",
+    "Folk", "Blues", "Country", "Reggae", "Soul", "Funk", "Punk", "R&B",
+    "Ambient", "House", "Techno", "Indie", "Alternative", "Latin", "Gospel",
+    "Disco", "Grunge", "Ska", "Trance", "Soundtrack", "Opera", "Swing",
+    "Bossa Nova", "Drum & Bass", "Dubstep", "K-Pop", "Afrobeat", "Lo-Fi",
+    "Synthwave", "Shoegaze", "Bluegrass", "Flamenco", "Salsa",
+)
+
+# Largest playlist the generator makes.
+MAX_PLAYLIST_SIZE = 20_000
+
+
+def _zipf_weights(n, s):
+    return list(accumulate(1 / (k ** s) for k in range(1, n + 1)))
+
+
+def _word(rng, low=1, high=3):
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(low, high)))
+
+
+def generate_songs(n, seed=0):
+    """Yields n song dicts for Database.import_songs()."""
+    rng = random.Random(seed)
+
+    artists = [f"{_word(rng).title()} {_word(rng).title()}" for _ in range(max(10, n // 20))]
+    artist_weights = _zipf_weights(len(artists), 1.1)
+    genre_weights = _zipf_weights(len(GENRES), 1.3)
+
+    for _ in range(n):
+        title = " ".join(_word(rng) for _ in range(rng.randint(1, 4))).capitalize()
+        yield {
+            "name": title,
+            "artist": rng.choices(artists, cum_weights=artist_weights)[0],
+            "genre": rng.choices(GENRES, cum_weights=genre_weights)[0],
+        }
+
+
+def build_library(n_songs, seed=0, n_playlists=None):
+    """
+    Fills the database at Database.DB_PATH (expected to be empty) and
+    returns a summary dict used by the benchmark cases.
+    """
+    rng = random.Random(seed + 1)
+    Database.init_db()
+    Database.import_songs(generate_songs(n_songs, seed), batch_size=20_000)
+
+    if n_playlists is None:
+        n_playlists = max(5, min(2_000, n_songs // 1_000))
+
+    largest = min(n_songs, MAX_PLAYLIST_SIZE)
+    playlists = []
+    for k in range(n_playlists):
+        size = int(math.exp(rng.uniform(math.log(5), math.log(max(largest, 6)))))
+        playlist_id = Database.create_playlist(f"Playlist {k:05d}")
+        Database.add_songs_to_playlist(playlist_id, rng.sample(range(1, n_songs + 1), size))
+        playlists.append((playlist_id, size))
+
+    playlists.sort(key=lambda p: p[1])
+    return {
+        "songs": n_songs,
+        "seed": seed,
+        "playlists": len(playlists),
+        "largest_playlist": playlists[-1][0],
+        "median_playlist": playlists[len(playlists) // 2][0],
+    }
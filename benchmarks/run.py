@@ -0,0 +1,655 @@
+"""
+Times Database.py functions and the Main.py fetch_* helpers against
+synthetic libraries of several sizes and writes the results as JSON.
+
+Each case does its setup untimed and returns the call to time, so the
+numbers cover one call only. Results from two runs can be compared with
+--baseline (or --compare OLD NEW); a case whose median got slower than
+the threshold allows is reported and the exit status is 1.
+
+Runs headless: Main.py is imported for its fetch_* helpers but no Tk
+window is created.
+"""
+
+import argparse
+import fnmatch
+import json
+import platform
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import Database
+import Dedupe
+import Libraries
+from benchmarks.generator import build_library
+
+RESULTS_VERSION = 1
+
+DEFAULT_SCALES = (1_000, 10_000, 100_000)
+
+# Timed calls per case; the first WARMUP calls are discarded.
+REPEATS = 5
+WARMUP = 1
+
+# A case regresses when its median grows by more than this fraction...
+THRESHOLD = 0.25
+# ...and by more than this many milliseconds, so sub-millisecond noise on
+# small libraries is not reported.
+MIN_DELTA_MS = 0.5
+
+# Rows written by the bulk write cases.
+BATCH = 1_000
+
+
+# ----- cases ----- #
+
+CASES = []
+
+
+def case(fn):
+    CASES.append((fn.__name__, fn))
+    return fn
+
+
+class Context:
+    """State shared by the cases for one library."""
+
+    def __init__(self, library):
+        self.library = library
+        self.songs = library["songs"]
+        self.counter = 0
+
+    def unique(self, prefix):
+        self.counter += 1
+        return f"{prefix} {self.counter:06d}"
+
+    def song_ids(self, count, start=1):
+        step = max(1, self.songs // count)
+        return [1 + (start + i * step) % self.songs for i in range(min(count, self.songs))]
+
+    def middle_song(self):
+        page = Database.get_songs_page(offset=self.songs // 2, limit=1)
+        return page[0]
+
+
+@case
+def init_db(ctx):
+    return Database.init_db
+
+
+@case
+def count_songs(ctx):
+    return Database.count_songs
+
+
+@case
+def get_all_songs(ctx):
+    return Database.get_all_songs
+
+
+@case
+def get_song(ctx):
+    return lambda: Database.get_song(ctx.songs // 2)
+
+
+@case
+def get_songs_page_first(ctx):
+    return Database.get_songs_page
+
+
+@case
+def get_songs_page_after(ctx):
+    song = ctx.middle_song()
+    return lambda: Database.get_songs_page(after=(song["name"], song["id"]))
+
+
+@case
+def get_songs_page_before(ctx):
+    song = ctx.middle_song()
+    return lambda: Database.get_songs_page(before=(song["name"], song["id"]))
+
+
+@case
+def get_songs_page_offset(ctx):
+    return lambda: Database.get_songs_page(offset=ctx.songs // 2)
+
+
+@case
+def count_songs_genre(ctx):
+    return lambda: Database.count_songs(genre_id=1)
+
+
+@case
+def get_genres(ctx):
+    return Database.get_genres
+
+
+@case
+def get_artists(ctx):
+    return Database.get_artists
+
+
+@case
+def get_artists_in_genre(ctx):
+    return lambda: Database.get_artists(genre_id=1)
+
+
+@case
+def get_songs_page_genre(ctx):
+    return lambda: Database.get_songs_page(genre_id=1)
+
+
+@case
+def get_songs_page_artist(ctx):
+    # The most prolific artist: a facet large enough to walk by name.
+    artist = max(Database.get_artists(), key=lambda a: a["songs"])
+    return lambda: Database.get_songs_page(artist_id=artist["id"])
+
+
+@case
+def create_song(ctx):
+    name = ctx.unique("Bench song")
+    return lambda: Database.create_song(name, "Bench Artist", "Rock")
+
+
+@case
+def update_song(ctx):
+    song_id = ctx.songs // 3
+    name = ctx.unique("Renamed")
+    return lambda: Database.update_song(song_id, name, "Bench Artist", "Jazz")
+
+
+@case
+def delete_song(ctx):
+    song_id = Database.create_song(ctx.unique("Doomed"), "Bench Artist", "Pop")
+    return lambda: Database.delete_song(song_id)
+
+
+@case
+def import_songs(ctx):
+    rows = [{"name": ctx.unique("Imported"), "artist": "Bench Artist", "genre": "Folk"}
+            for _ in range(BATCH)]
+    return lambda: Database.import_songs(rows)
+
+
+@case
+def create_playlist(ctx):
+    name = ctx.unique("Bench playlist")
+    return lambda: Database.create_playlist(name)
+
+
+@case
+def delete_playlist(ctx):
+    playlist_id = Database.create_playlist(ctx.unique("Doomed playlist"))
+    Database.add_songs_to_playlist(playlist_id, ctx.song_ids(100))
+    return lambda: Database.delete_playlist(playlist_id)
+
+
+@case
+def add_song_to_playlist(ctx):
+    playlist_id = Database.create_playlist(ctx.unique("Single add"))
+    return lambda: Database.add_song_to_playlist(playlist_id, ctx.songs // 2)
+
+
+@case
+def remove_song_from_playlist(ctx):
+    playlist_id = ctx.library["largest_playlist"]
+    song_id = ctx.song_ids(1, start=ctx.counter)[0]
+    Database.add_song_to_playlist(playlist_id, song_id)
+    return lambda: Database.remove_song_from_playlist(playlist_id, song_id)
+
+
+@case
+def add_songs_to_playlist(ctx):
+    playlist_id = Database.create_playlist(ctx.unique("Bulk add"))
+    song_ids = ctx.song_ids(BATCH)
+    return lambda: Database.add_songs_to_playlist(playlist_id, song_ids)
+
+
+@case
+def remove_songs_from_playlist(ctx):
+    playlist_id = Database.create_playlist(ctx.unique("Bulk remove"))
+    song_ids = ctx.song_ids(BATCH)
+    Database.add_songs_to_playlist(playlist_id, song_ids)
+    return lambda: Database.remove_songs_from_playlist(playlist_id, song_ids)
+
+
+@case
+def insert_songs_at(ctx):
+    playlist_id = ctx.library["largest_playlist"]
+    song_ids = ctx.song_ids(10, start=ctx.counter)
+    Database.remove_songs_from_playlist(playlist_id, song_ids)
+    return lambda: Database.insert_songs_at(playlist_id, song_ids, 1)
+
+
+@case
+def move_song_in_playlist(ctx):
+    playlist_id = ctx.library["largest_playlist"]
+    songs = Database.get_connection().execute(
+        "SELECT song_id FROM playlist_songs WHERE playlist_id = ? ORDER BY position DESC LIMIT 1",
+        (playlist_id,),
+    ).fetchone()
+    return lambda: Database.move_song_in_playlist(playlist_id, songs["song_id"], 1)
+
+
+@case
+def renumber_playlist(ctx):
+    return lambda: Database.renumber_playlist(ctx.library["largest_playlist"])
+
+
+@case
+def get_playlists_for_song(ctx):
+    song_id = ctx.song_ids(1, start=ctx.songs // 2)[0]
+    return lambda: Database.get_playlists_for_song(song_id)
+
+
+@case
+def get_playlists_for_songs(ctx):
+    song_ids = ctx.song_ids(BATCH)
+    return lambda: Database.get_playlists_for_songs(song_ids)
+
+
+@case
+def merge_playlists(ctx):
+    target = Database.create_playlist(ctx.unique("Merged"))
+    sources = [ctx.library["median_playlist"], ctx.library["largest_playlist"]]
+    return lambda: Database.merge_playlists(target, sources)
+
+
+@case
+def copy_playlist(ctx):
+    name = ctx.unique("Copy")
+    return lambda: Database.copy_playlist(ctx.library["largest_playlist"], name)
+
+
+@case
+def search_songs_by_name(ctx):
+    return lambda: Database.search_songs_by_name("la")
+
+
+@case
+def search_songs_by_genre(ctx):
+    return lambda: Database.search_songs_by_genre("Jazz")
+
+
+@case
+def search_songs(ctx):
+    return lambda: Database.search_songs("la")
+
+
+@case
+def search_songs_unranked(ctx):
+    return lambda: Database.search_songs("la", ranked=False)
+
+
+@case
+def search_libraries(ctx):
+    # Just this library: the cost of the fan-out and merge over a search.
+    Libraries.close_workers()
+    return lambda: Libraries.search_songs("la")
+
+
+@case
+def search_songs_fuzzy(ctx):
+    Database.update_fuzzy_index()
+    return lambda: Database.search_songs_fuzzy("lamori")
+
+
+@case
+def update_fuzzy_index(ctx):
+    Database.update_fuzzy_index()
+    Database.import_songs({"name": ctx.unique("Fuzzy"), "artist": ctx.unique("Artist")}
+                          for _ in range(BATCH))
+    return Database.update_fuzzy_index
+
+
+@case
+def add_search_results_to_playlist(ctx):
+    playlist_id = Database.create_playlist(ctx.unique("Search results"))
+    return lambda: Database.add_search_results_to_playlist(playlist_id, "mo ri")
+
+
+def _scanned_rows(ctx, root):
+    return [
+        {"path": f"{root}/{i:06d}.mp3", "mtime": 1.0, "size": 1, "duration": 180.0,
+         "name": f"Scanned {i}", "artist": "Bench Artist", "genre": "Ambient"}
+        for i in range(BATCH)
+    ]
+
+
+@case
+def upsert_scanned_songs(ctx):
+    rows = _scanned_rows(ctx, f"/bench/{ctx.unique('upsert')}")
+    return lambda: Database.upsert_scanned_songs(rows)
+
+
+@case
+def get_file_index(ctx):
+    root = f"/bench/{ctx.unique('index')}"
+    Database.upsert_scanned_songs(_scanned_rows(ctx, root))
+    return lambda: Database.get_file_index(root)
+
+
+@case
+def delete_songs_by_paths(ctx):
+    rows = _scanned_rows(ctx, f"/bench/{ctx.unique('delete')}")
+    Database.upsert_scanned_songs(rows)
+    paths = [row["path"] for row in rows]
+    return lambda: Database.delete_songs_by_paths(paths)
+
+
+@case
+def iter_playlist_songs(ctx):
+    playlist_id = ctx.library["largest_playlist"]
+    return lambda: sum(1 for _ in Database.iter_playlist_songs(playlist_id))
+
+
+@case
+def import_playlist(ctx):
+    records = list(Database.iter_playlist_songs(ctx.library["largest_playlist"]))
+    name = ctx.unique("Imported")
+    return lambda: Database.import_playlist(name, records)
+
+
+@case
+def find_duplicates(ctx):
+    return Dedupe.find_duplicates
+
+
+@case
+def merge_songs(ctx):
+    survivor = Database.create_song(ctx.unique("Survivor"), "Bench Artist", "Pop")
+    duplicates = [Database.create_song(ctx.unique("Duplicate"), "Bench Artist", "Pop")
+                  for _ in range(BATCH // 10)]
+    Database.add_songs_to_playlist(ctx.library["median_playlist"], duplicates)
+    return lambda: Database.merge_songs(dict.fromkeys(duplicates, survivor))
+
+
+# Matches about a quarter of the generated library.
+SMART_RULES = {"match": "any", "rules": [
+    {"field": "genre", "op": "is one of", "value": ["Rock", "Jazz"]},
+    {"field": "name", "op": "starts with", "value": "La"},
+]}
+
+
+@case
+def create_smart_playlist(ctx):
+    return lambda: Database.create_smart_playlist(ctx.unique("Smart"), SMART_RULES)
+
+
+@case
+def refresh_smart_playlists(ctx):
+    Database.create_smart_playlist(ctx.unique("Smart"), SMART_RULES)
+    Database.refresh_smart_playlists()
+    Database.import_songs({"name": ctx.unique("Smart song"), "genre": "Rock"}
+                          for _ in range(BATCH))
+    return Database.refresh_smart_playlists
+
+
+@case
+def get_smart_playlist_songs_page(ctx):
+    playlist_id = Database.create_smart_playlist(ctx.unique("Smart"), SMART_RULES)
+    return lambda: Database.get_playlist_songs_page(playlist_id)
+
+
+@case
+def refresh_song_neighbors(ctx):
+    Database.refresh_song_neighbors()
+    playlist_id = Database.create_playlist(ctx.unique("Neighbors"))
+    Database.add_songs_to_playlist(playlist_id, ctx.song_ids(BATCH // 10))
+    return Database.refresh_song_neighbors
+
+
+@case
+def get_similar_songs(ctx):
+    Database.refresh_song_neighbors()
+    song_id = Database.get_playlist_songs_page(ctx.library["median_playlist"], limit=1)[0]["id"]
+    return lambda: Database.get_similar_songs(song_id)
+
+
+@case
+def get_playlist_extension(ctx):
+    Database.refresh_song_neighbors()
+    playlist_id = ctx.library["median_playlist"]
+    return lambda: Database.get_playlist_extension(playlist_id)
+
+
+@case
+def get_changes(ctx):
+    # What another process sees after BATCH // 10 edits elsewhere.
+    seq = Database.get_change_seq()
+    for song_id in ctx.song_ids(BATCH // 10):
+        Database.update_song(song_id, ctx.unique("Changed"), "Bench Artist", "Jazz")
+    return lambda: Database.get_changes(seq)
+
+
+def _main_module():
+    # Imported late so the Database-only cases run even without tkinter.
+    import Main
+    return Main
+
+
+@case
+def get_all_playlists(ctx):
+    return Database.get_all_playlists
+
+
+@case
+def open_largest_playlist(ctx):
+    # What the Playlists tab loads on opening one: the count and first page.
+    main_module = _main_module()
+    playlist_id = ctx.library["largest_playlist"]
+    return lambda: main_module.PlaylistSongSource(playlist_id).rows(0, Database.PAGE_SIZE)
+
+
+# ----- running ----- #
+
+def time_case(fn, ctx, repeats=REPEATS, warmup=WARMUP):
+    timings = []
+    rows = None
+    for i in range(warmup + repeats):
+        call = fn(ctx)
+        start = time.perf_counter()
+        result = call()
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            timings.append(elapsed * 1000)
+        if isinstance(result, list):
+            rows = len(result)
+    return {
+        "min_ms": round(min(timings), 4),
+        "median_ms": round(statistics.median(timings), 4),
+        "max_ms": round(max(timings), 4),
+        "repeats": repeats,
+        "rows": rows,
+    }
+
+
+def selected_cases(only=(), skip=()):
+    def matches(name, patterns):
+        return any(fnmatch.fnmatch(name, p) for p in patterns)
+
+    return [
+        (name, fn) for name, fn in CASES
+        if (not only or matches(name, only)) and not matches(name, skip)
+    ]
+
+
+def prepare_library(n_songs, seed, work_dir, cache_dir=None):
+    """
+    Points Database at a fresh copy of the synthetic library for n_songs.
+    Built libraries are kept in cache_dir (if given) and copied, since the
+    cases modify the database they run on.
+    """
+    work_path = Path(work_dir) / f"library-{n_songs}.db"
+    cached = Path(cache_dir) / f"library-{n_songs}-{seed}.db" if cache_dir else None
+    summary_path = cached.with_suffix(".json") if cached else None
+
+    Database.close_connection()
+    build_seconds = None
+    if cached is not None and cached.exists() and summary_path.exists():
+        library = json.loads(summary_path.read_text())
+    else:
+        target = cached or work_path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.unlink(missing_ok=True)
+        Database.DB_PATH = target
+        start = time.perf_counter()
+        library = build_library(n_songs, seed)
+        build_seconds = round(time.perf_counter() - start, 3)
+        # Fold the WAL back into the main file before copying it.
+        Database.get_connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        Database.close_connection()
+        if summary_path is not None:
+            summary_path.write_text(json.dumps(library))
+
+    if cached is not None:
+        shutil.copyfile(cached, work_path)
+    Database.DB_PATH = work_path
+    return library, build_seconds
+
+
+def run(scales=DEFAULT_SCALES, seed=0, repeats=REPEATS, only=(), skip=(),
+        cache_dir=None, progress=None):
+    cases = selected_cases(only, skip)
+    results = {
+        "version": RESULTS_VERSION,
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "seed": seed,
+            "repeats": repeats,
+        },
+        "scales": {},
+    }
+
+    original_path = Database.DB_PATH
+    try:
+        with tempfile.TemporaryDirectory(prefix="music-bench-") as work_dir:
+            for n_songs in scales:
+                library, build_seconds = prepare_library(n_songs, seed, work_dir, cache_dir)
+                ctx = Context(library)
+                scale = {"library": library, "build_seconds": build_seconds, "cases": {}}
+                for name, fn in cases:
+                    try:
+                        scale["cases"][name] = time_case(fn, ctx, repeats)
+                    except ImportError as e:
+                        scale["cases"][name] = {"skipped": str(e)}
+                    if progress:
+                        progress(n_songs, name, scale["cases"][name])
+                results["scales"][str(n_songs)] = scale
+                Database.close_connection()
+    finally:
+        Database.close_connection()
+        Database.DB_PATH = original_path
+    return results
+
+
+# ----- comparing ----- #
+
+def compare(baseline, current, threshold=THRESHOLD, min_delta_ms=MIN_DELTA_MS):
+    """
+    Returns [(scale, case, old_ms, new_ms)] for every case whose median
+    regressed past threshold between two results dicts. Cases missing
+    from either side are ignored.
+    """
+    regressions = []
+    for scale, data in current["scales"].items():
+        old_cases = baseline.get("scales", {}).get(scale, {}).get("cases", {})
+        for name, timing in data["cases"].items():
+            old = old_cases.get(name, {}).get("median_ms")
+            new = timing.get("median_ms")
+            if old is None or new is None:
+                continue
+            if new > old * (1 + threshold) and new - old > min_delta_ms:
+                regressions.append((scale, name, old, new))
+    return regressions
+
+
+def format_table(results, baseline=None):
+    lines = [f"{'songs':>9}  {'case':<32} {'median ms':>11} {'min ms':>10} {'rows':>8}  change"]
+    for scale, data in results["scales"].items():
+        old_cases = (baseline or {}).get("scales", {}).get(scale, {}).get("cases", {})
+        for name, timing in data["cases"].items():
+            if "skipped" in timing:
+                lines.append(f"{scale:>9}  {name:<32} skipped ({timing['skipped']})")
+                continue
+            change = ""
+            old = old_cases.get(name, {}).get("median_ms")
+            if old:
+                change = f"{(timing['median_ms'] - old) / old:+.0%}"
+            rows = "" if timing["rows"] is None else timing["rows"]
+            lines.append(
+                f"{scale:>9}  {name:<32} {timing['median_ms']:>11.3f} "
+                f"{timing['min_ms']:>10.3f} {rows:>8}  {change}"
+            )
+    return "\n".join(lines)
+
+
+def report_regressions(regressions, threshold):
+    if not regressions:
+        print(f"No regressions beyond {threshold:.0%}.")
+        return 0
+    print(f"{len(regressions)} regression(s) beyond {threshold:.0%}:")
+    for scale, name, old, new in regressions:
+        print(f"  {scale:>9}  {name:<32} {old:.3f} ms -> {new:.3f} ms ({(new - old) / old:+.0%})")
+    return 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the music organizer database.")
+    parser.add_argument("--scales", type=int, nargs="+", default=list(DEFAULT_SCALES),
+                        help="library sizes to benchmark (songs)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--only", nargs="+", default=(), metavar="PATTERN",
+                        help="run only cases matching these glob patterns")
+    parser.add_argument("--skip", nargs="+", default=(), metavar="PATTERN",
+                        help="skip cases matching these glob patterns")
+    parser.add_argument("--cache-dir", help="keep generated libraries here for later runs")
+    parser.add_argument("--out", help="write results JSON to this file")
+    parser.add_argument("--baseline", help="results JSON to check for regressions against")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="only compare two existing results files")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="allowed slowdown as a fraction (default %(default)s)")
+    parser.add_argument("--min-delta-ms", type=float, default=MIN_DELTA_MS)
+    parser.add_argument("--list", action="store_true", help="list the cases and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, _ in selected_cases(args.only, args.skip):
+            print(name)
+        return 0
+
+    if args.compare:
+        baseline, results = (json.loads(Path(p).read_text()) for p in args.compare)
+    else:
+        baseline = json.loads(Path(args.baseline).read_text()) if args.baseline else None
+
+        def progress(n_songs, name, timing):
+            if "median_ms" in timing:
+                print(f"{n_songs:>9}  {name:<32} {timing['median_ms']:>11.3f} ms", file=sys.stderr)
+
+        results = run(args.scales, args.seed, args.repeats, args.only, args.skip,
+                      args.cache_dir, progress)
+        if args.out:
+            Path(args.out).write_text(json.dumps(results, indent=2))
+
+    print(format_table(results, baseline))
+    if baseline is None:
+        return 0
+    return report_regressions(
+        compare(baseline, results, args.threshold, args.min_delta_ms), args.threshold
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
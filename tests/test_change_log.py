@@ -0,0 +1,117 @@
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import Database
+
+
+class ChangeLogTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory(prefix="music-test-")
+        self.original_path = Database.DB_PATH
+        Database.DB_PATH = Path(self.work_dir.name) / "music_organizer.db"
+        Database.init_db()
+
+        Database.import_songs({"name": f"Song {i:04}"} for i in range(200))
+        self.song_ids = [song["id"] for song in Database.get_songs_page(limit=200)]
+        self.playlist_id = Database.create_playlist("Mix")
+        self.other_id = Database.create_playlist("Other")
+
+    def tearDown(self):
+        Database.close_connection()
+        Database.DB_PATH = self.original_path
+        self.work_dir.cleanup()
+
+    def changes_since(self, seq, **kwargs):
+        new_seq, changes = Database.get_changes(seq, **kwargs)
+        self.assertEqual(new_seq, Database.get_change_seq())
+        return changes
+
+    def test_add_logs_one_entry_per_playlist(self):
+        seq = Database.get_change_seq()
+        Database.add_songs_to_playlist(self.playlist_id, self.song_ids[:150])
+
+        self.assertEqual(Database.get_change_seq() - seq, 1)
+        changes = self.changes_since(seq)
+        self.assertEqual(changes["playlist_songs"], {self.playlist_id})
+        self.assertEqual(changes["songs"], {})
+        self.assertEqual(changes["playlist_order"], set())
+
+    def test_each_transaction_is_logged(self):
+        Database.add_songs_to_playlist(self.playlist_id, self.song_ids[:10])
+        # A reader caught up with the first add still sees the second.
+        seq = Database.get_change_seq()
+        Database.add_songs_to_playlist(self.playlist_id, self.song_ids[10:20])
+        self.assertEqual(self.changes_since(seq)["playlist_songs"], {self.playlist_id})
+
+    def test_one_transaction_over_two_playlists(self):
+        seq = Database.get_change_seq()
+        with Database.transaction():
+            Database.add_songs_to_playlist(self.playlist_id, self.song_ids[:50])
+            Database.add_songs_to_playlist(self.other_id, self.song_ids[:50])
+            Database.remove_songs_from_playlist(self.playlist_id, self.song_ids[:10])
+
+        self.assertEqual(Database.get_change_seq() - seq, 2)
+        self.assertEqual(self.changes_since(seq)["playlist_songs"], {self.playlist_id, self.other_id})
+
+    def test_move(self):
+        Database.add_songs_to_playlist(self.playlist_id, self.song_ids[:20])
+        seq = Database.get_change_seq()
+        Database.move_song_in_playlist(self.playlist_id, self.song_ids[15], 0)
+
+        changes = self.changes_since(seq)
+        self.assertEqual(changes["playlist_songs"], {self.playlist_id})
+        self.assertEqual(changes["playlist_order"], set())
+
+    def test_renumber_is_not_a_change_of_songs(self):
+        Database.add_songs_to_playlist(self.playlist_id, self.song_ids[:20])
+        seq = Database.get_change_seq()
+        Database.renumber_playlist(self.playlist_id)
+
+        changes = self.changes_since(seq)
+        self.assertEqual(changes["playlist_songs"], set())
+        self.assertEqual(changes["playlist_order"], {self.playlist_id})
+
+    def test_move_that_renumbers_is_still_a_change(self):
+        Database.add_songs_to_playlist(self.playlist_id, self.song_ids[:2])
+        seq = Database.get_change_seq()
+        renumbered = False
+        for song_id in self.song_ids[2:40]:
+            Database.add_song_to_playlist(self.playlist_id, song_id)
+            _, moved_renumbered = Database.move_song_in_playlist(self.playlist_id, song_id, 1)
+            renumbered |= moved_renumbered
+        self.assertTrue(renumbered)
+        self.assertEqual(self.changes_since(seq)["playlist_songs"], {self.playlist_id})
+
+    def test_deleting_a_song_logs_its_playlists(self):
+        Database.add_songs_to_playlist(self.playlist_id, self.song_ids[:5])
+        Database.add_songs_to_playlist(self.other_id, self.song_ids[:5])
+        seq = Database.get_change_seq()
+        Database.delete_song(self.song_ids[2])
+
+        changes = self.changes_since(seq)
+        self.assertEqual(changes["songs"], {self.song_ids[2]: None})
+        self.assertEqual(changes["playlist_songs"], {self.playlist_id, self.other_id})
+
+    def test_own_changes_are_skipped(self):
+        seq = Database.get_change_seq()
+        with ThreadPoolExecutor(1, initializer=Database.record_own_changes) as own:
+            own.submit(Database.add_songs_to_playlist, self.playlist_id, self.song_ids[:5]).result()
+            own.submit(Database.close_connection).result()
+        Database.update_song(self.song_ids[0], "Renamed", "", "")
+
+        changes = self.changes_since(seq, skip_own=True)
+        self.assertEqual(changes["playlist_songs"], set())
+        self.assertEqual(set(changes["songs"]), {self.song_ids[0]})
+        self.assertEqual(self.changes_since(seq)["playlist_songs"], {self.playlist_id})
+
+    def test_reader_too_far_behind_reloads(self):
+        seq = Database.get_change_seq()
+        Database.add_songs_to_playlist(self.playlist_id, self.song_ids[:5])
+        Database.add_songs_to_playlist(self.other_id, self.song_ids[:5])
+        self.assertIsNone(Database.get_changes(seq, limit=1)[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
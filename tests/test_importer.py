@@ -0,0 +1,40 @@
+import io
+import json
+import unittest
+
+from Importer import read_json
+
+
+class ReadJsonTest(unittest.TestCase):
+    def songs(self, n):
+        return [{"name": f"Song {i}", "artist": "Ärtist \"quoted\"", "genre": "Rock, [live]"}
+                for i in range(n)]
+
+    def test_elements_straddling_chunks(self):
+        songs = self.songs(50)
+        text = json.dumps(songs, indent=2, ensure_ascii=False)
+        # Chunks much shorter than one element: every element straddles several.
+        for chunk_size in (1, 7, 16, 64, len(text)):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(list(read_json(io.StringIO(text), chunk_size)), songs)
+
+    def test_empty_array(self):
+        self.assertEqual(list(read_json(io.StringIO(" [ ] "), chunk_size=1)), [])
+
+    def test_truncated_array(self):
+        text = json.dumps(self.songs(3))[:-1]
+        with self.assertRaises(ValueError):
+            list(read_json(io.StringIO(text), chunk_size=8))
+
+    def test_truncated_element(self):
+        text = json.dumps(self.songs(3))[:-10]
+        with self.assertRaises(ValueError):
+            list(read_json(io.StringIO(text), chunk_size=8))
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            list(read_json(io.StringIO('{"name": "Song"}')))
+
+
+if __name__ == "__main__":
+    unittest.main()
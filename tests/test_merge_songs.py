@@ -0,0 +1,70 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import Database
+
+
+class MergeSongsTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory(prefix="music-test-")
+        self.original_path = Database.DB_PATH
+        Database.DB_PATH = Path(self.work_dir.name) / "music_organizer.db"
+        Database.init_db()
+
+        self.song_ids = [Database.create_song(f"Song {i}", "Artist", "Rock") for i in range(5)]
+
+    def tearDown(self):
+        Database.close_connection()
+        Database.DB_PATH = self.original_path
+        self.work_dir.cleanup()
+
+    def playlist_order(self, playlist_id):
+        return [row[0] for row in Database.get_connection().execute(
+            "SELECT song_id FROM playlist_songs WHERE playlist_id = ? ORDER BY position, song_id",
+            (playlist_id,)
+        )]
+
+    def test_duplicate_is_repointed_in_place(self):
+        first, duplicate, last, survivor = self.song_ids[:4]
+        playlist_id = Database.create_playlist("Mix")
+        Database.add_songs_to_playlist(playlist_id, [first, duplicate, last])
+
+        self.assertEqual(Database.merge_songs({duplicate: survivor}), 1)
+        self.assertEqual(self.playlist_order(playlist_id), [first, survivor, last])
+        self.assertIsNone(Database.get_song(duplicate))
+
+    def test_playlist_holding_both_keeps_the_survivor_once(self):
+        # Re-pointing would repeat the survivor (UNIQUE (playlist_id, song_id)):
+        # the duplicate's entry goes instead, and the survivor keeps its place.
+        survivor, middle, duplicate = self.song_ids[:3]
+        playlist_id = Database.create_playlist("Both")
+        Database.add_songs_to_playlist(playlist_id, [survivor, middle, duplicate])
+
+        self.assertEqual(Database.merge_songs({duplicate: survivor}), 1)
+        self.assertEqual(self.playlist_order(playlist_id), [survivor, middle])
+
+    def test_several_duplicates_of_one_song(self):
+        survivor, one, two = self.song_ids[:3]
+        mixed = Database.create_playlist("Mixed")
+        Database.add_songs_to_playlist(mixed, [one, two])
+
+        self.assertEqual(Database.merge_songs({one: survivor, two: survivor}), 2)
+        self.assertEqual(self.playlist_order(mixed), [survivor])
+
+    def test_merging_into_a_duplicate_is_refused(self):
+        a, b, c = self.song_ids[:3]
+        playlist_id = Database.create_playlist("Kept")
+        Database.add_songs_to_playlist(playlist_id, [a, b])
+
+        with self.assertRaises(ValueError):
+            Database.merge_songs({a: b, b: c})
+        with self.assertRaises(ValueError):
+            Database.merge_songs({a: max(self.song_ids) + 1})
+        # Nothing changed.
+        self.assertEqual(self.playlist_order(playlist_id), [a, b])
+        self.assertEqual(Database.count_songs(), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+import Database
+
+# The schema as it was before MIGRATIONS existed (user_version 0).
+BASELINE_SCHEMA = """
+CREATE TABLE songs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    artist TEXT,
+    genre TEXT
+);
+CREATE TABLE playlists (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE playlist_songs (
+    playlist_id INTEGER NOT NULL,
+    song_id INTEGER NOT NULL,
+    PRIMARY KEY (playlist_id, song_id),
+    FOREIGN KEY (playlist_id) REFERENCES playlists(id) ON DELETE CASCADE,
+    FOREIGN KEY (song_id) REFERENCES songs(id) ON DELETE CASCADE
+);
+"""
+
+
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory(prefix="music-test-")
+        self.original_path = Database.DB_PATH
+        Database.DB_PATH = Path(self.work_dir.name) / "music_organizer.db"
+
+        conn = sqlite3.connect(Database.DB_PATH)
+        conn.executescript(BASELINE_SCHEMA)
+        conn.executemany(
+            "INSERT INTO songs (name, artist, genre) VALUES (?, ?, ?)",
+            [("Help!", "The Beatles", "Rock"), ("So What", "Miles Davis", "Jazz"),
+             ("Yesterday", "The Beatles", "Rock"), ("Untitled", None, None)]
+        )
+        conn.execute("INSERT INTO playlists (name) VALUES ('Mix')")
+        conn.executemany("INSERT INTO playlist_songs VALUES (1, ?)", [(3,), (1,), (4,)])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        Database.close_connection()
+        Database.DB_PATH = self.original_path
+        self.work_dir.cleanup()
+
+    def test_baseline_database_is_brought_up_to_date(self):
+        Database.init_db()
+
+        self.assertEqual(Database.get_schema_version(), Database.SCHEMA_VERSION)
+        self.assertEqual(Database.count_songs(), 4)
+        self.assertEqual(
+            [(song["name"], song["artist"], song["genre"]) for song in Database.get_songs_page()],
+            [("Help!", "The Beatles", "Rock"), ("So What", "Miles Davis", "Jazz"),
+             ("Untitled", "", ""), ("Yesterday", "The Beatles", "Rock")]
+        )
+        playlist_id = Database.get_playlist_id("Mix")
+        self.assertEqual(Database.count_playlist_songs(playlist_id), 3)
+        self.assertEqual(
+            sorted(song["id"] for song in Database.get_playlist_songs_page(playlist_id)), [1, 3, 4]
+        )
+        self.assertEqual(
+            {row["name"]: row["songs"] for row in Database.get_artists()},
+            {"The Beatles": 2, "Miles Davis": 1}
+        )
+
+    def test_migrated_database_takes_writes_and_logs_them(self):
+        Database.init_db()
+        seq = Database.get_change_seq()
+
+        song_id = Database.create_song("Blue in Green", "Miles Davis", "Jazz")
+        playlist_id = Database.get_playlist_id("Mix")
+        Database.add_songs_to_playlist(playlist_id, [song_id])
+
+        _, changes = Database.get_changes(seq)
+        self.assertEqual(set(changes["songs"]), {song_id})
+        self.assertEqual(changes["playlist_songs"], {playlist_id})
+
+    def test_init_db_again_changes_nothing(self):
+        Database.init_db()
+        Database.init_db()
+        self.assertEqual(Database.get_schema_version(), Database.SCHEMA_VERSION)
+        self.assertEqual(Database.count_songs(), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
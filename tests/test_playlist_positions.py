@@ -0,0 +1,75 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import Database
+
+
+class PlaylistPositionsTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory(prefix="music-test-")
+        self.original_path = Database.DB_PATH
+        Database.DB_PATH = Path(self.work_dir.name) / "music_organizer.db"
+        Database.init_db()
+
+    def tearDown(self):
+        Database.close_connection()
+        Database.DB_PATH = self.original_path
+        self.work_dir.cleanup()
+
+    def make_songs(self, n):
+        Database.import_songs({"name": f"Song {i:06}"} for i in range(n))
+        return [row[0] for row in Database.get_connection().execute("SELECT id FROM songs ORDER BY id")]
+
+    def playlist_order(self, playlist_id):
+        return [row[0] for row in Database.get_connection().execute(
+            "SELECT song_id FROM playlist_songs WHERE playlist_id = ? ORDER BY position, song_id",
+            (playlist_id,)
+        )]
+
+    def test_insert_more_songs_than_the_gap_mid_playlist(self):
+        count = Database.POSITION_GAP + 1000
+        song_ids = self.make_songs(count + 2)
+        playlist_id = Database.create_playlist("Big")
+        Database.add_songs_to_playlist(playlist_id, [song_ids[0], song_ids[-1]])
+
+        self.assertEqual(Database.insert_songs_at(playlist_id, song_ids[1:-1], 1), count)
+        self.assertEqual(self.playlist_order(playlist_id), song_ids)
+
+    def test_moves_into_one_spot_keep_order(self):
+        song_ids = self.make_songs(40)
+        playlist_id = Database.create_playlist("Moves")
+        Database.add_songs_to_playlist(playlist_id, song_ids[:2])
+
+        # Every song dropped between the first two halves the room left there.
+        expected = song_ids[:2]
+        renumbered = False
+        for song_id in song_ids[2:]:
+            Database.add_song_to_playlist(playlist_id, song_id)
+            _, moved_renumbered = Database.move_song_in_playlist(playlist_id, song_id, 1)
+            renumbered |= moved_renumbered
+            expected.insert(1, song_id)
+            self.assertEqual(self.playlist_order(playlist_id), expected)
+        self.assertTrue(renumbered)
+
+    def test_crowded_playlist_is_renumbered_in_the_background(self):
+        # Twelve halvings of the gap: crowded, but not yet full.
+        song_ids = self.make_songs(14)
+        playlist_id = Database.create_playlist("Crowded")
+        Database.add_songs_to_playlist(playlist_id, song_ids[:2])
+        for song_id in song_ids[2:]:
+            Database.insert_songs_at(playlist_id, [song_id], 1)
+        order = self.playlist_order(playlist_id)
+
+        self.assertEqual(Database.renumber_pending_playlists(), 1)
+        self.assertEqual(self.playlist_order(playlist_id), order)
+        positions = [row[0] for row in Database.get_connection().execute(
+            "SELECT position FROM playlist_songs WHERE playlist_id = ? ORDER BY position",
+            (playlist_id,)
+        )]
+        self.assertEqual(positions, [Database.POSITION_GAP * (n + 1) for n in range(len(order))])
+        self.assertEqual(Database.renumber_pending_playlists(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import Database
+
+
+def rules(*rules, match="all"):
+    return {"match": match, "rules": [dict(zip(("field", "op", "value"), rule)) for rule in rules]}
+
+
+class SmartRulesTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory(prefix="music-test-")
+        self.original_path = Database.DB_PATH
+        Database.DB_PATH = Path(self.work_dir.name) / "music_organizer.db"
+        Database.init_db()
+
+        Database.upsert_scanned_songs([
+            {"path": f"/music/{name}.mp3", "name": name, "artist": artist, "genre": genre,
+             "mtime": 1, "size": 1000, "duration": duration}
+            for name, artist, genre, duration in [
+                ("Help!", "The Beatles", "Rock", 139.0),
+                ("100% Pure", "Someone", "Pop", 200.0),
+                ("100 Percent", "Someone", "Pop", 250.0),
+                ("So_What", "Miles Davis", "Jazz", 545.0),
+                ("So What", "Miles Davis", "jazz", 560.0),
+            ]
+        ])
+        Database.create_song("No Artist", "", "")
+        self.names = {song["id"]: song["name"] for song in Database.get_songs_page()}
+        self.playlists = 0
+
+    def tearDown(self):
+        Database.close_connection()
+        Database.DB_PATH = self.original_path
+        self.work_dir.cleanup()
+
+    def matching(self, smart_rules):
+        self.playlists += 1
+        playlist_id = Database.create_smart_playlist(f"Smart {self.playlists}", smart_rules)
+        return {self.names[row[0]] for row in Database.get_connection().execute(
+            "SELECT song_id FROM playlist_songs WHERE playlist_id = ?", (playlist_id,)
+        )}
+
+    def test_text_operators(self):
+        self.assertEqual(self.matching(rules(("genre", "is", "JAZZ"))), {"So_What", "So What"})
+        self.assertEqual(self.matching(rules(("artist", "starts with", "the "))), {"Help!"})
+        self.assertEqual(self.matching(rules(("genre", "is one of", "rock, pop"))),
+                         {"Help!", "100% Pure", "100 Percent"})
+
+    def test_like_wildcards_are_literal(self):
+        self.assertEqual(self.matching(rules(("name", "contains", "%"))), {"100% Pure"})
+        self.assertEqual(self.matching(rules(("name", "contains", "_"))), {"So_What"})
+
+    def test_negation_keeps_songs_without_the_field(self):
+        self.assertEqual(self.matching(rules(("artist", "is not", "Someone"))),
+                         {"Help!", "So_What", "So What", "No Artist"})
+        self.assertEqual(self.matching(rules(("path", "does not contain", "So"))),
+                         {"Help!", "100% Pure", "100 Percent", "No Artist"})
+
+    def test_numbers_and_matching_any(self):
+        self.assertEqual(self.matching(rules(("duration", "greater than", "540"))),
+                         {"So_What", "So What"})
+        self.assertEqual(
+            self.matching(rules(("duration", "less than", 150), ("artist", "is", "someone"),
+                                match="any")),
+            {"Help!", "100% Pure", "100 Percent"}
+        )
+
+    def test_new_songs_are_added_by_maintenance(self):
+        playlist_id = Database.create_smart_playlist("Jazz", rules(("genre", "is", "jazz")))
+        song_id = Database.create_song("Blue in Green", "Miles Davis", "Jazz")
+        Database.refresh_smart_playlists()
+        self.assertIn(song_id, [song["id"] for song in Database.get_playlist_songs_page(playlist_id)])
+
+    def test_invalid_rules_are_refused(self):
+        for invalid in [
+            {"match": "all", "rules": []},
+            rules(("genre", "is"), match="some"),
+            rules(("colour", "is", "red")),
+            rules(("duration", "contains", "3")),
+            rules(("duration", "is", "long")),
+            rules(("added", "after", "yesterday")),
+            rules(("genre", "is one of", " , ")),
+            {"rules": ["genre is jazz"]},
+        ]:
+            with self.subTest(rules=invalid), self.assertRaises(ValueError):
+                Database.create_smart_playlist("Invalid", invalid)
+        self.assertIsNone(Database.get_playlist_id("Invalid"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import Database
+import Transfer
+
+
+class M3u8RoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory(prefix="music-test-")
+        self.original_path = Database.DB_PATH
+        Database.DB_PATH = Path(self.work_dir.name) / "music_organizer.db"
+        Database.init_db()
+
+    def tearDown(self):
+        Database.close_connection()
+        Database.DB_PATH = self.original_path
+        self.work_dir.cleanup()
+
+    def playlist_songs(self, playlist_id):
+        return [(song["name"], song["artist"], song["path"], song["duration"])
+                for song in Database.iter_playlist_songs(playlist_id)]
+
+    def test_export_then_import_gives_the_same_playlist(self):
+        Database.upsert_scanned_songs([
+            {"path": f"/music/{name}.mp3", "name": name, "artist": artist, "genre": "Rock",
+             "mtime": 1, "size": 1000, "duration": duration}
+            for name, artist, duration in [
+                ("Help!", "The Beatles", 139.0),
+                ("Ünïcödé Song", "Sigur Rós", 301.5),
+                ("Live - 1969", "The Who", None),
+            ]
+        ])
+        # Songs without a file are matched by name and artist.
+        Database.create_song("No File", "Somebody", "Jazz")
+        Database.create_song("Has - Dash", "", "Jazz")
+        song_ids = [song["id"] for song in Database.get_songs_page()]
+
+        playlist_id = Database.create_playlist("Road Trip")
+        Database.add_songs_to_playlist(playlist_id, song_ids[::-1])
+        path = Path(self.work_dir.name) / "road_trip.m3u8"
+
+        self.assertEqual(Transfer.export_playlist(playlist_id, path, name="Road Trip"), 5)
+        missing = []
+        copy_id, added, missed = Transfer.import_playlist_file(path, name="Copy",
+                                                               on_missing=missing.append)
+
+        self.assertEqual((added, missed, missing), (5, 0, []))
+        self.assertEqual(self.playlist_songs(copy_id), self.playlist_songs(playlist_id))
+        self.assertEqual(Database.count_songs(), 5)
+
+    def test_playlist_name_is_read_from_the_header(self):
+        song_id = Database.create_song("Only", "One", "Pop")
+        playlist_id = Database.create_playlist("Named")
+        Database.add_songs_to_playlist(playlist_id, [song_id])
+        path = Path(self.work_dir.name) / "export.m3u8"
+        Transfer.export_playlist(playlist_id, path, name="Named Again")
+
+        copy_id, added, _ = Transfer.import_playlist_file(path)
+        self.assertEqual(copy_id, Database.get_playlist_id("Named Again"))
+        self.assertEqual(added, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()